@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of the cost of logging in the request path, at INFO and at DEBUG level.
+
+There are `--routes` routes with path values and `--filters` filters, which are all matched against every request, as
+in a server with many controllers. The time of routing a request, which is finding its controller and filters, is
+measured in the process. Then the client sends `--requests` requests to the server, and the requests per second are
+printed. The logs are written to /dev/null.
+
+    python benchmarks/bench_request_logging.py --mode threading --requests 5000
+    python benchmarks/bench_request_logging.py --mode coroutine --routes 50 --filters 20
+"""
+
+import argparse
+import http.client
+import logging
+import os
+import sys
+import threading
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import simple_http_server.logger as logger  # noqa: E402
+import simple_http_server.server as server  # noqa: E402
+from simple_http_server import ControllerFunction, FilterContex, request_filter, request_map  # noqa: E402
+from simple_http_server.http_server import RoutingConf  # noqa: E402
+
+
+def _register(routes: int, filters: int):
+    for i in range(routes):
+        request_map(f"/bench/route{i}/{{name}}")(lambda name: name)
+    request_map("/bench/hello/{name}")(lambda name: f"hello, {name}")
+
+    def _pass(ctx: FilterContex):
+        ctx.do_chain()
+    for i in range(filters):
+        request_filter(regexp=f"^/bench/filter{i}/.*$")(_pass)
+
+
+def _routing_conf(routes: int, filters: int) -> RoutingConf:
+    conf = RoutingConf()
+    for i in range(routes):
+        conf.map_controller(ControllerFunction(url=f"/bench/route{i}/{{name}}", func=lambda name: name))
+    conf.map_controller(ControllerFunction(url="/bench/hello/{name}", func=lambda name: name))
+    for i in range(filters):
+        conf.map_filter({"url_pattern": f"^/bench/filter{i}/.*$", "func": lambda ctx: ctx.do_chain()})
+    return conf
+
+
+def _measure_routing(conf: RoutingConf) -> float:
+    def route():
+        conf.get_url_controller("bench/hello/world", "GET")
+        conf.get_matched_filters("/bench/hello/world")
+    number = 2000
+    return min(timeit.repeat(route, number=number, repeat=5)) / number
+
+
+def _measure(port: int, requests: int) -> float:
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    begin = time.time()
+    for i in range(requests):
+        conn.request("GET", f"/bench/hello/{i}")
+        res = conn.getresponse()
+        res.read()
+    elapsed = time.time() - begin
+    conn.close()
+    return requests / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["threading", "coroutine"], default="threading")
+    parser.add_argument("--port", type=int, default=9093)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--routes", type=int, default=20)
+    parser.add_argument("--filters", type=int, default=10)
+    args = parser.parse_args()
+
+    logger.set_handler(logging.StreamHandler(open(os.devnull, "w")))
+    conf = _routing_conf(args.routes, args.filters)
+    print(f"routes={args.routes} filters={args.filters}")
+    for level in ("INFO", "DEBUG"):
+        logger.set_level(level)
+        cost = _measure_routing(conf)
+        logger.flush()
+        print(f"{level:>8}: {cost * 1e6:10.1f} us to route a request")
+
+    logger.set_level("INFO")
+    _register(args.routes, args.filters)
+    threading.Thread(target=server.start, kwargs={"port": args.port, "prefer_coroutine": args.mode == "coroutine"},
+                     daemon=True).start()
+    while not server.is_ready():
+        time.sleep(0.1)
+
+    print(f"mode={args.mode} requests={args.requests}")
+    _measure(args.port, min(args.requests, 500))
+    for level in ("INFO", "DEBUG", "INFO"):
+        logger.set_level(level)
+        rate = _measure(args.port, args.requests)
+        logger.flush()
+        print(f"{level:>8}: {rate:10.0f} req/s")
+
+    server.stop()
+
+
+if __name__ == "__main__":
+    main()
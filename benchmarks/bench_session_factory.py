@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of creating and looking up local sessions in many threads.
+
+Every thread creates `--sessions` sessions and looks each of them up `--lookups` times, which is how the threads of
+`ThreadingMixInHTTPServer` use the session factory. The sessions created per second are printed for every number of
+threads and shards.
+
+    python benchmarks/bench_session_factory.py --threads 1 8 64 256 --shards 1 16
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from simple_http_server._http_session_local_impl import LocalSessionFactory  # noqa: E402
+
+
+def _work(factory: LocalSessionFactory, sessions: int, lookups: int, start: threading.Barrier):
+    start.wait()
+    for _ in range(sessions):
+        session = factory.get_session(None, create=True)
+        for _ in range(lookups):
+            factory.get_session(session.id)
+
+
+def _measure(shards: int, threads: int, sessions: int, lookups: int) -> float:
+    factory = LocalSessionFactory(shards=shards)
+    start = threading.Barrier(threads + 1)
+    workers = [threading.Thread(target=_work, args=(factory, sessions, lookups, start)) for _ in range(threads)]
+    for w in workers:
+        w.start()
+    start.wait()
+    begin = time.time()
+    for w in workers:
+        w.join()
+    return threads * sessions / (time.time() - begin)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 8, 64, 256])
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 16])
+    parser.add_argument("--total", type=int, default=200000, help="sessions created in every run")
+    parser.add_argument("--lookups", type=int, default=4)
+    args = parser.parse_args()
+
+    gil = getattr(sys, "_is_gil_enabled", lambda: True)()
+    print(f"python {sys.version.split()[0]}, GIL {'enabled' if gil else 'disabled'}, lookups={args.lookups}")
+    print(f"{'threads':>8}" + "".join(f"{f'shards={s}':>16}" for s in args.shards))
+    for threads in args.threads:
+        rates = [_measure(shards, threads, max(1, args.total // threads), args.lookups) for shards in args.shards]
+        print(f"{threads:>8}" + "".join(f"{rate:14.0f}/s" for rate in rates))
+
+
+if __name__ == "__main__":
+    main()
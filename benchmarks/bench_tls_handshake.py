@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of new TLS connections per second.
+
+Every request is sent in a new connection, so the handshake cost dominates. Some clients that connect but never
+start the handshake can be added with `--stalled`, they should not slow down the others.
+
+    python benchmarks/bench_tls_handshake.py --mode threading --clients 8 --seconds 5 --stalled 4
+    python benchmarks/bench_tls_handshake.py --mode coroutine --resume
+
+A self-signed certificate is generated with the `openssl` command if `--certfile` and `--keyfile` are not given.
+"""
+
+import argparse
+import os
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import simple_http_server.server as server  # noqa: E402
+from simple_http_server import request_map  # noqa: E402
+from simple_http_server.logger import set_level  # noqa: E402
+
+
+@request_map("/bench/tls")
+def bench_tls():
+    return "ok"
+
+
+def _generate_cert(dir: str):
+    certfile = os.path.join(dir, "cert.pem")
+    keyfile = os.path.join(dir, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                    "-subj", "/CN=127.0.0.1", "-keyout", keyfile, "-out", certfile],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return certfile, keyfile
+
+
+def _request(ctx: ssl.SSLContext, port: int, session: ssl.SSLSession = None):
+    with socket.create_connection(("127.0.0.1", port)) as sock:
+        with ctx.wrap_socket(sock, server_hostname="127.0.0.1", session=session) as tls:
+            tls.sendall(b"GET /bench/tls HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n\r\n")
+            while tls.recv(4096):
+                pass
+            # TLS 1.3 tickets arrive after the handshake, so read the session after the response.
+            return tls.session, tls.session_reused
+
+
+def _client(ctx: ssl.SSLContext, port: int, deadline: float, resume: bool, results: list):
+    count = 0
+    resumed = 0
+    session = None
+    while time.time() < deadline:
+        session, reused = _request(ctx, port, session if resume else None)
+        resumed += reused
+        count += 1
+    results.append((count, resumed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["threading", "coroutine"], default="threading")
+    parser.add_argument("--port", type=int, default=9443)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--stalled", type=int, default=0, help="clients that never start the TLS handshake")
+    parser.add_argument("--resume", action="store_true", help="resume TLS sessions in clients")
+    parser.add_argument("--tickets", type=int, default=None, help="`ssl_session_tickets` of the server")
+    parser.add_argument("--certfile")
+    parser.add_argument("--keyfile")
+    args = parser.parse_args()
+
+    set_level("ERROR")
+    tmp_dir = tempfile.TemporaryDirectory()
+    certfile, keyfile = (args.certfile, args.keyfile) if args.certfile else _generate_cert(tmp_dir.name)
+
+    threading.Thread(target=server.start, kwargs={
+        "port": args.port, "ssl": True, "certfile": certfile, "keyfile": keyfile,
+        "prefer_coroutine": args.mode == "coroutine", "ssl_session_tickets": args.tickets,
+        "ssl_handshake_timeout": args.seconds + 5}, daemon=True).start()
+    while not server.is_ready():
+        time.sleep(0.1)
+
+    stalled = [socket.create_connection(("127.0.0.1", args.port)) for _ in range(args.stalled)]
+
+    ctx = ssl.create_default_context()
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    results = []
+    deadline = time.time() + args.seconds
+    clients = [threading.Thread(target=_client, args=(ctx, args.port, deadline, args.resume, results))
+               for _ in range(args.clients)]
+    begin = time.time()
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    elapsed = time.time() - begin
+
+    total = sum(r[0] for r in results)
+    resumed = sum(r[1] for r in results)
+    print(f"mode={args.mode} clients={args.clients} stalled={args.stalled} resume={args.resume} tickets={args.tickets}")
+    print(f"{total} connections in {elapsed:.2f}s, {total / elapsed:.1f} conn/s, {resumed} sessions resumed")
+
+    for sock in stalled:
+        sock.close()
+    server.stop()
+    tmp_dir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
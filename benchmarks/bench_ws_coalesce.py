@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of sending many small websocket messages with and without write coalescing.
+
+The handler sends `--messages` messages of `--size` bytes for every request of the client, the client reads the raw
+frames from the socket, so the cost of parsing them in the client is small.
+
+    python benchmarks/bench_ws_coalesce.py --mode threading --messages 10000 --rounds 20
+    python benchmarks/bench_ws_coalesce.py --mode coroutine --size 64 --delay 0.001
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+import websocket
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import simple_http_server.server as server  # noqa: E402
+from simple_http_server import WebsocketSession, websocket_handler  # noqa: E402
+from simple_http_server.logger import set_level  # noqa: E402
+
+
+class BenchTicksHandler:
+
+    def on_text_message(self, session: WebsocketSession, message: str):
+        count, size = map(int, message.split(","))
+        payload = "x" * size
+        for _ in range(count):
+            session.send(payload)
+        session.flush()
+
+
+def _round(ws: websocket.WebSocket, messages: int, size: int):
+    ws.send(f"{messages},{size}")
+    # Frames of small text messages have a 2-byte header.
+    left = messages * (size + 2)
+    while left > 0:
+        data = ws.sock.recv(min(left, 1 << 20))
+        if not data:
+            raise ConnectionError("Connection is closed.")
+        left -= len(data)
+
+
+def _measure(port: int, endpoint: str, messages: int, size: int, rounds: int) -> float:
+    ws = websocket.WebSocket()
+    ws.connect(f"ws://127.0.0.1:{port}{endpoint}")
+    _round(ws, messages, size)
+    begin = time.time()
+    for _ in range(rounds):
+        _round(ws, messages, size)
+    elapsed = time.time() - begin
+    ws.close()
+    return messages * rounds / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["threading", "coroutine"], default="threading")
+    parser.add_argument("--port", type=int, default=9092)
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--size", type=int, default=32, help="should be less than 126 bytes")
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--delay", type=float, default=0, help="`coalesce_delay` of the coalescing handler")
+    args = parser.parse_args()
+    assert args.size < 126
+
+    set_level("ERROR")
+    websocket_handler(endpoint="/bench/ws")(type("BenchPlain", (BenchTicksHandler,), {}))
+    websocket_handler(endpoint="/bench/ws_coalesce", coalesce_writes=True,
+                      coalesce_delay=args.delay)(type("BenchCoalesce", (BenchTicksHandler,), {}))
+    threading.Thread(target=server.start, kwargs={"port": args.port, "prefer_coroutine": args.mode == "coroutine"},
+                     daemon=True).start()
+    while not server.is_ready():
+        time.sleep(0.1)
+
+    print(f"mode={args.mode} messages={args.messages} size={args.size} rounds={args.rounds} delay={args.delay}")
+    for name, endpoint in (("plain", "/bench/ws"), ("coalesce", "/bench/ws_coalesce")):
+        rate = _measure(args.port, endpoint, args.messages, args.size, args.rounds)
+        print(f"{name:>10}: {rate:12.0f} msg/s")
+
+    server.stop()
+
+
+if __name__ == "__main__":
+    main()
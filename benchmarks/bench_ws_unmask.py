@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of unmasking websocket payloads from 10 B to 16 MB.
+
+    python benchmarks/bench_ws_unmask.py
+
+The byte-by-byte loop, which was used before, is only measured up to 1 MB, it takes too long for bigger payloads.
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import simple_http_server.websocket_request_handler as ws_handler  # noqa: E402
+
+SIZES = [10, 100, 1 << 10, 10 << 10, 100 << 10, 1 << 20, 4 << 20, 16 << 20]
+
+LOOP_MAX_SIZE = 1 << 20
+
+
+def unmask_loop(payload: bytes, masks: bytes) -> bytes:
+    message_bytes = bytearray()
+    for message_byte in payload:
+        message_byte ^= masks[len(message_bytes) % 4]
+        message_bytes.append(message_byte)
+    return message_bytes
+
+
+def unmask_bigint(payload: bytes, masks: bytes) -> bytes:
+    numpy = ws_handler.numpy
+    ws_handler.numpy = None
+    try:
+        return ws_handler._unmask(payload, masks)
+    finally:
+        ws_handler.numpy = numpy
+
+
+def unmask_default(payload: bytes, masks: bytes) -> bytes:
+    return ws_handler._unmask(payload, masks)
+
+
+def _measure(func, payload: bytes, masks: bytes) -> float:
+    number = max(1, (1 << 20) // max(len(payload), 1000))
+    return min(timeit.repeat(lambda: func(payload, masks), number=number, repeat=3)) / number
+
+
+def _format_size(size: int) -> str:
+    for unit in ("B", "KB", "MB"):
+        if size < 1024 or unit == "MB":
+            return f"{size:g} {unit}"
+        size /= 1024
+
+
+def main():
+    masks = os.urandom(4)
+    print(f"numpy: {'available' if ws_handler.numpy is not None else 'not available'}")
+    print(f"{'size':>8} {'loop':>12} {'bigint':>12} {'default':>12} {'MB/s':>10}")
+    for size in SIZES:
+        payload = os.urandom(size)
+        loop = _measure(unmask_loop, payload, masks) if size <= LOOP_MAX_SIZE else None
+        bigint = _measure(unmask_bigint, payload, masks)
+        default = _measure(unmask_default, payload, masks)
+        loop_txt = f"{loop * 1e6:10.1f}us" if loop is not None else f"{'-':>12}"
+        print(f"{_format_size(size):>8} {loop_txt} {bigint * 1e6:10.1f}us {default * 1e6:10.1f}us "
+              f"{size / default / (1 << 20):10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -42,6 +42,9 @@ _logger = get_logger("simple_http_server.__init__")
 
 class Session:
 
+    # The expiry time in the session cookie that was last sent to the client.
+    _cookie_expires: float = 0
+
     def __init__(self):
         self.max_inactive_interval: int = 30 * 60
 
@@ -81,9 +84,55 @@ class Session:
 
 class SessionFactory:
 
+    # The session cookie is set again when its expiry time is moved by this many seconds, but not more than half of
+    # the max inactive interval of the session.
+    cookie_refresh_interval: float = 60
+
+    # Whether `get_session` may block on I/O, if so, it is called in an executor in coroutine mode.
+    blocking: bool = True
+
     def get_session(self, session_id: str, create: bool = False) -> Session:
         return None
 
+    def cookie_refresh_threshold(self, session: Session) -> float:
+        return min(self.cookie_refresh_interval, session.max_inactive_interval / 2)
+
+    def session_cookie_value(self, session: Session) -> str:
+        """
+        The value of the session cookie in the response, return None if the cookie does not need to be set again.
+        """
+        expires = session.last_accessed_time + session.max_inactive_interval
+        if abs(expires - session._cookie_expires) < self.cookie_refresh_threshold(session):
+            return None
+        session._cookie_expires = expires
+        return session.id
+
+
+class AsyncSessionFactory(SessionFactory):
+    """
+    The coroutine version of `SessionFactory`, for the session storages that are accessed with asyncio.
+
+    The session is loaded by awaiting `get_session` before the controller that has a `Session` argument is called, the
+    filters and the controllers can also get it by `await request.get_session_async()`. After the controller, `save`
+    is awaited for the valid session that is used in the request, and `invalidate` for the invalidated one, so the
+    session objects can only keep the changes in memory until then.
+    """
+
+    blocking: bool = False
+
+    async def get_session(self, session_id: str, create: bool = False) -> Session:
+        return None
+
+    async def save(self, session: Session) -> None:
+        """
+        Called at the end of every request that uses the session, the unchanged sessions can be skipped, or only their
+        last accessed time is written.
+        """
+        pass
+
+    async def invalidate(self, session: Session) -> None:
+        pass
+
 
 class Cookies(http.cookies.SimpleCookie):
     EXPIRE_DATE_FORMAT = "%a, %d %b %Y %H:%M:%S GMT"
@@ -136,6 +185,13 @@ class Request:
         # This is abstract method
         return None
 
+    async def get_session_async(self, create: bool = False) -> Session:
+        """
+        Get the session without blocking the event loop, the `get_session` of an `AsyncSessionFactory` is awaited, and
+        a blocking `SessionFactory` is called in an executor in coroutine mode.
+        """
+        return None
+
 
 class MultipartFile:
     """Multipart file"""
@@ -202,6 +258,10 @@ class ParamStringValue(str):
         obj = super().__new__(cls, default)
         return obj
 
+    def __getnewargs__(self):
+        # str will only give its value back when pickling, which will be taken as `name` in `__new__`.
+        return self.name, str(self)
+
 
 class Parameter(ParamStringValue):
     pass
@@ -221,6 +281,9 @@ class PathValue(str):
         obj = super().__new__(cls, _value)
         return obj
 
+    def __getnewargs__(self):
+        return self.name, str(self)
+
 
 class Parameters(list):
 
@@ -271,6 +334,9 @@ class RegGroup(str):
         obj = super().__new__(cls, val)
         return obj
 
+    def __getnewargs_ex__(self):
+        return (self.group,), {"_value": str(self)}
+
 
 class Header(ParamStringValue):
     pass
@@ -484,6 +550,31 @@ class WebsocketSession:
     def send(self, message: str):
         pass
 
+    def send_binary(self, message: bytes):
+        pass
+
+    async def send_async(self, message: Union[str, bytes]):
+        """ Send a text(str) or binary(bytes) message, wait if the send queue of the session is full. """
+        pass
+
+    @property
+    def send_queue_stats(self) -> Dict[str, int]:
+        return {}
+
+    def flush(self):
+        """ Write the queued messages now, without waiting for the coalescing delay. """
+        pass
+
+    @property
+    def channels(self) -> List[str]:
+        return []
+
+    def join(self, channel: str):
+        pass
+
+    def leave(self, channel: str):
+        pass
+
     def send_pone(self, message: str):
         pass
 
@@ -508,10 +599,54 @@ class WebsocketHandler:
     def on_text_message(self, session: WebsocketSession = None, message: str = ""):
         pass
 
+    def on_binary_message(self, session: WebsocketSession = None, message: bytes = b""):
+        pass
+
     def on_close(self, session: WebsocketSession = None, reason: str = ""):
         pass
 
 
+class WebsocketHandlerOptions:
+
+    def __init__(self, max_message_size: int = 16 * 1024 * 1024,
+                 max_frame_size: int = 16 * 1024 * 1024,
+                 permessage_deflate: bool = False,
+                 deflate_min_size: int = 128,
+                 deflate_no_context_takeover: bool = False,
+                 deflate_max_window_bits: int = 15,
+                 send_queue_size: int = 1024 * 1024,
+                 send_queue_policy: str = "block",
+                 ping_interval: float = 0,
+                 ping_timeout: float = 10,
+                 idle_timeout: float = 0,
+                 coalesce_writes: bool = False,
+                 coalesce_delay: float = 0) -> None:
+        # Messages bigger than this will not be reassembled, the connection will be closed instead.
+        self.max_message_size: int = max_message_size
+        # The connection is closed when a frame claims a bigger payload, before the payload is read.
+        self.max_frame_size: int = max_frame_size
+        # Compress messages with the permessage-deflate extension if the client supports it.
+        self.permessage_deflate: bool = permessage_deflate
+        # Smaller messages are sent uncompressed, compressing them costs more than it saves.
+        self.deflate_min_size: int = deflate_min_size
+        self.deflate_no_context_takeover: bool = deflate_no_context_takeover
+        self.deflate_max_window_bits: int = deflate_max_window_bits
+        # The byte budget of the outbound queue of every session, and what to do when it is exceeded:
+        # "block", "drop_oldest" or "disconnect".
+        self.send_queue_size: int = send_queue_size
+        self.send_queue_policy: str = send_queue_policy
+        # Send a ping when nothing is received in `ping_interval` seconds, and close the connection if still nothing
+        # is received `ping_timeout` seconds after it. Connections that receive nothing in `idle_timeout` seconds
+        # are closed too. 0 disables them.
+        self.ping_interval: float = ping_interval
+        self.ping_timeout: float = ping_timeout
+        self.idle_timeout: float = idle_timeout
+        # Join the queued frames into one write. With a delay, frames sent in this period are joined too, call
+        # `session.flush()` to send the urgent ones at once.
+        self.coalesce_writes: bool = coalesce_writes
+        self.coalesce_delay: float = coalesce_delay
+
+
 def _get_class_of_method(method_defind):
     vals = vars(sys.modules[method_defind.__module__])
     for attr in method_defind.__qualname__.split('.')[:-1]:
@@ -543,10 +678,14 @@ class ControllerFunction:
                  regexp: str = "",
                  method: str = "",
                  ctr_obj: object = None,
-                 func: Callable = None) -> None:
+                 func: Callable = None,
+                 run_in_process: bool = False,
+                 process_timeout: float = None) -> None:
         self.__url: str = url
         self.__regexp = regexp
         self.__method: str = method
+        self.run_in_process: bool = run_in_process
+        self.process_timeout: float = process_timeout
         self.singletion: bool = False
         self.ctr_obj_init_args = None
         self.ctr_obj_init_kwargs = None
@@ -560,6 +699,7 @@ class ControllerFunction:
             assert self.url or self.regexp, "you should set one of url and regexp"
             assert not (self.url and self.regexp), "you can only set one of url and regexp, not both"
             assert self.func is not None and (inspect.isfunction(self.func) or inspect.ismethod(self.func))
+            assert not (self.run_in_process and inspect.iscoroutinefunction(self.func)), "coroutine controllers cannot run in the process pool"
             return True
         except AssertionError as ae:
             _logger.warn(f"[{self._url}|{self.regexp}] => {self.func} configurate error: {ae}")
@@ -591,14 +731,14 @@ class ControllerFunction:
     def ctrl_object(self) -> object:
         if not self.singletion:
             obj = self._create_ctrl_obj()
-            _logger.debug(f"singleton: create a object -> {obj}")
+            _logger.debug("singleton: create a object -> %s", obj)
             return obj
 
         if self.__ctr_obj is None:
             self.__ctr_obj = self._create_ctrl_obj()
-            _logger.debug(f"object does not exist, create one -> {self.__ctr_obj} ")
+            _logger.debug("object does not exist, create one -> %s ", self.__ctr_obj)
         else:
-            _logger.debug(f"object[{self.__ctr_obj}] exists, return. ")
+            _logger.debug("object[%s] exists, return. ", self.__ctr_obj)
         return self.__ctr_obj
 
     def _create_ctrl_obj(self) -> object:
@@ -623,10 +763,14 @@ _ctrl_singletons = {}
 
 _ws_handlers = {}
 
+_ws_handler_options: Dict[str, WebsocketHandlerOptions] = {}
+
 _error_page = OrderedDict()
 
 _session_facory: SessionFactory = None
 
+_process_pool_size: int = None
+
 
 def controller(*anno_args, singleton: bool = True, args: List[Any] = [], kwargs: Dict[str, Any] = {}):
     def map(ctr_obj_class):
@@ -638,7 +782,8 @@ def controller(*anno_args, singleton: bool = True, args: List[Any] = [], kwargs:
     return map
 
 
-def request_map(*anno_args, url: str = "", regexp: str = "", method: Union[str, list, tuple] = "") -> Callable:
+def request_map(*anno_args, url: str = "", regexp: str = "", method: Union[str, list, tuple] = "",
+                run_in_process: bool = False, process_timeout: float = None) -> Callable:
     _url = url
     len_args = len(anno_args)
     assert len_args <= 1
@@ -665,7 +810,8 @@ def request_map(*anno_args, url: str = "", regexp: str = "", method: Union[str,
 
         for mth in mths:
             _logger.debug(f"map url {_url} with method[{mth}] to function {ctrl}. ")
-            _request_mappings.append(ControllerFunction(url=_url, regexp=regexp, method=mth, func=ctrl))
+            _request_mappings.append(ControllerFunction(url=_url, regexp=regexp, method=mth, func=ctrl,
+                                                        run_in_process=run_in_process, process_timeout=process_timeout))
         # return the original function, so you can use a decoration chain
         return ctrl
 
@@ -698,25 +844,83 @@ def filter_map(regexp: str = "", filter_function: Callable = None) -> Callable:
     return map
 
 
-def set_session_factory(session_factory: SessionFactory):
+def set_session_factory(session_factory: Union[SessionFactory, AsyncSessionFactory]):
     global _session_facory
     _session_facory = session_factory
 
 
+def set_process_pool_size(max_workers: int):
+    """ Set the worker number of the process pool which runs the `run_in_process` controllers, default is the cpu count. """
+    global _process_pool_size
+    assert max_workers is None or max_workers > 0
+    _process_pool_size = max_workers
+
+
 def _get_singletion(clz, args, kwargs):
     if clz not in _ctrl_singletons:
         _ctrl_singletons[clz] = _create_object(clz, args, kwargs)
     return _ctrl_singletons[clz]
 
 
-def websocket_handler(endpoint=""):
+def websocket_handler(endpoint="",
+                      max_message_size: int = 16 * 1024 * 1024,
+                      max_frame_size: int = 16 * 1024 * 1024,
+                      permessage_deflate: bool = False,
+                      deflate_min_size: int = 128,
+                      deflate_no_context_takeover: bool = False,
+                      deflate_max_window_bits: int = 15,
+                      send_queue_size: int = 1024 * 1024,
+                      send_queue_policy: str = "block",
+                      ping_interval: float = 0,
+                      ping_timeout: float = 10,
+                      idle_timeout: float = 0,
+                      coalesce_writes: bool = False,
+                      coalesce_delay: float = 0):
+    assert 9 <= deflate_max_window_bits <= 15, "deflate_max_window_bits should be between 9 and 15"
+    assert send_queue_policy in ("block", "drop_oldest", "disconnect"), \
+        "send_queue_policy should be one of block, drop_oldest and disconnect"
+
     def map(ws_class):
         _ws_handlers[endpoint] = ws_class
+        _ws_handler_options[endpoint] = WebsocketHandlerOptions(max_message_size=max_message_size,
+                                                                max_frame_size=max_frame_size,
+                                                                permessage_deflate=permessage_deflate,
+                                                                deflate_min_size=deflate_min_size,
+                                                                deflate_no_context_takeover=deflate_no_context_takeover,
+                                                                deflate_max_window_bits=deflate_max_window_bits,
+                                                                send_queue_size=send_queue_size,
+                                                                send_queue_policy=send_queue_policy,
+                                                                ping_interval=ping_interval,
+                                                                ping_timeout=ping_timeout,
+                                                                idle_timeout=idle_timeout,
+                                                                coalesce_writes=coalesce_writes,
+                                                                coalesce_delay=coalesce_delay)
         return ws_class
 
     return map
 
 
+def websocket_broadcast(channel: str, message: Union[str, bytes],
+                        max_buffer_size: int = 1024 * 1024, close_slow_consumers: bool = False) -> int:
+    """
+    Send a message to all the websocket sessions that joined the channel, the frame is encoded only once.
+
+    Sessions whose write buffer exceeds `max_buffer_size` are skipped, or closed if `close_slow_consumers` is set.
+    Return the number of sessions the message is sent to. It can be called in any thread.
+    """
+    from .websocket_request_handler import websocket_channels
+    return websocket_channels.publish(channel, message, max_buffer_size=max_buffer_size,
+                                      close_slow_consumers=close_slow_consumers)
+
+
+def websocket_reaper_stats() -> Dict[str, int]:
+    """
+    Return the counters of the websocket heartbeat: the watched sessions, the pings sent and the sessions reaped.
+    """
+    from .websocket_request_handler import websocket_reaper
+    return websocket_reaper.stats
+
+
 def error_message(*anno_args):
     len_args = len(anno_args)
     arg_func = None
@@ -768,10 +972,12 @@ def _get_request_mappings():
             if not ctr_fun.method and methods:
                 for mth in methods:
                     _logger.debug(f"map url {full_url} included [{clz_url}] with method[{mth}] to function {ctr_fun.func}. ")
-                    mappings.append(ControllerFunction(url=full_url, regexp=ctr_fun.regexp, method=mth, func=ctr_fun.func))
+                    mappings.append(ControllerFunction(url=full_url, regexp=ctr_fun.regexp, method=mth, func=ctr_fun.func,
+                                                       run_in_process=ctr_fun.run_in_process, process_timeout=ctr_fun.process_timeout))
             else:
                 _logger.debug(f"map url {full_url} included [{clz_url}] with method[{ctr_fun.method}] to function {ctr_fun.func}. ")
-                mappings.append(ControllerFunction(url=full_url, regexp=ctr_fun.regexp, method=ctr_fun.method, func=ctr_fun.func))
+                mappings.append(ControllerFunction(url=full_url, regexp=ctr_fun.regexp, method=ctr_fun.method, func=ctr_fun.func,
+                                                   run_in_process=ctr_fun.run_in_process, process_timeout=ctr_fun.process_timeout))
         else:
             mappings.append(ctr_fun)
 
@@ -798,10 +1004,18 @@ def _get_session_factory() -> SessionFactory:
     return _session_facory
 
 
+def _get_process_pool_size() -> int:
+    return _process_pool_size
+
+
 def _get_websocket_handlers() -> Dict[str, Type]:
     return _ws_handlers
 
 
+def _get_websocket_handler_options() -> Dict[str, WebsocketHandlerOptions]:
+    return _ws_handler_options
+
+
 def _get_error_pages() -> Dict[str, Callable]:
     _logger.debug(f"error pages:: {_error_page}")
     return _error_page
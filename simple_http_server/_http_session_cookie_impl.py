@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2018 Keijack Wu
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import time
+import uuid
+import zlib
+
+from typing import Any, Dict, List, Tuple, Union
+from threading import RLock
+from simple_http_server import Session, SessionFactory
+from simple_http_server.logger import get_logger
+
+_logger = get_logger("simple_http_server.http_session_cookie")
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+class CookieSessionImpl(Session):
+
+    def __init__(self, id: str, creation_time: float, last_accessed_time: float, factory: "CookieSessionFactory",
+                 attrs: Dict[str, Any] = None, max_inactive_interval: int = None, is_new: bool = True):
+        self.__id = id
+        self.__creation_time = creation_time
+        self.__last_accessed_time = last_accessed_time
+        self.__is_new = is_new
+        self.__attr_lock = RLock()
+        self.__attrs: Dict[str, Any] = attrs or {}
+        self.__factory = factory
+        self.__max_inactive_interval: int = 0
+        super().__init__()
+        if max_inactive_interval is not None:
+            self.__max_inactive_interval = max_inactive_interval
+        # A new session always needs a cookie, a session read from a cookie only needs one after it is changed.
+        self.changed: bool = is_new
+
+    @property
+    def id(self) -> str:
+        return self.__id
+
+    @property
+    def creation_time(self) -> float:
+        return self.__creation_time
+
+    @property
+    def last_accessed_time(self) -> float:
+        return self.__last_accessed_time
+
+    @property
+    def is_new(self) -> bool:
+        return self.__is_new
+
+    @property
+    def max_inactive_interval(self) -> int:
+        return self.__max_inactive_interval
+
+    @max_inactive_interval.setter
+    def max_inactive_interval(self, interval: int):
+        if interval != self.__max_inactive_interval:
+            self.__max_inactive_interval = interval
+            self.changed = True
+
+    @property
+    def attribute_names(self) -> Tuple:
+        return tuple(self.__attrs.keys())
+
+    def get_attribute(self, name: str) -> Any:
+        return self.__attrs.get(name)
+
+    def set_attribute(self, name: str, value: Any) -> None:
+        with self.__attr_lock:
+            missing = object()
+            old_value = self.__attrs.get(name, missing)
+            self.__attrs[name] = value
+            try:
+                # Encode it here, so the controller knows that the value cannot be kept in the cookie.
+                self.__factory.encode(self)
+            except (TypeError, ValueError):
+                if old_value is missing:
+                    del self.__attrs[name]
+                else:
+                    self.__attrs[name] = old_value
+                raise
+            self.changed = True
+
+    def _dump(self) -> Dict[str, Any]:
+        with self.__attr_lock:
+            return {
+                "id": self.__id,
+                "c": self.__creation_time,
+                "a": self.__last_accessed_time,
+                "m": self.__max_inactive_interval,
+                "d": self.__attrs
+            }
+
+    def _touch(self, last_accessed_time: float):
+        self.__last_accessed_time = last_accessed_time
+
+    def invalidate(self) -> None:
+        self.__last_accessed_time = 0
+        self.__is_new = False
+
+
+class CookieSessionFactory(SessionFactory):
+    """
+    Sessions are kept in the session cookie itself, so nothing is stored in the server, and any server that has the
+    keys can read the sessions without a shared store.
+
+    The cookie is `<key id>.<payload>.<HMAC-SHA256 signature>`. The payload is the JSON of the session, it is compressed
+    with zlib when it is longer than `compress_min_size` bytes. Note that the payload is signed but not encrypted, so the
+    client can read the attributes, do not put secrets in them. The attributes must be JSON serializable.
+
+    The first key of `keys` signs the cookies, all the keys are accepted when the cookies are verified. To rotate the
+    keys, put the new key at the front, and remove the old one after the sessions signed by it have expired.
+
+    The `Set-Cookie` header is only sent when the session is new or has been changed, or when the cookie was written
+    more than `cookie_refresh_interval` seconds ago, so that the expiry time of an active session is extended.
+
+    A `ValueError` is raised by `set_attribute` when the cookie would be longer than `max_size`, browsers drop the
+    cookies that are longer than 4096 bytes.
+    """
+
+    blocking: bool = False
+
+    def __init__(self, keys: List[Union[str, bytes]],
+                 max_size: int = 4000,
+                 compress_min_size: int = 256,
+                 max_inactive_interval: int = 30 * 60):
+        if not keys:
+            raise ValueError("At least one key is required to sign the session cookies.")
+        self.__keys: Dict[str, bytes] = {}
+        for key in keys:
+            key = key.encode() if isinstance(key, str) else key
+            self.__keys.setdefault(hashlib.sha256(key).hexdigest()[:8], key)
+        self.__sign_key_id: str = next(iter(self.__keys))
+        self.max_size: int = max_size
+        self.compress_min_size: int = compress_min_size
+        self.max_inactive_interval: int = max_inactive_interval
+
+    def _sign(self, key: bytes, data: str) -> str:
+        return _b64encode(hmac.new(key, data.encode(), hashlib.sha256).digest())
+
+    def encode(self, session: CookieSessionImpl) -> str:
+        data = json.dumps(session._dump(), separators=(",", ":")).encode()
+        if len(data) >= self.compress_min_size:
+            payload = "z" + _b64encode(zlib.compress(data))
+        else:
+            payload = "j" + _b64encode(data)
+        signed = f"{self.__sign_key_id}.{payload}"
+        value = f"{signed}.{self._sign(self.__keys[self.__sign_key_id], signed)}"
+        if len(value) > self.max_size:
+            raise ValueError(f"Session cookie is {len(value)} bytes, which is longer than {self.max_size} bytes.")
+        return value
+
+    def decode(self, value: str) -> CookieSessionImpl:
+        if not value.isascii():
+            # A valid cookie is always base64url, and `hmac.compare_digest` does not accept non-ASCII strings.
+            return None
+        parts = value.split(".")
+        if len(parts) != 3 or parts[0] not in self.__keys:
+            return None
+        key_id, payload, signature = parts
+        if not hmac.compare_digest(signature, self._sign(self.__keys[key_id], f"{key_id}.{payload}")):
+            _logger.warning("Session cookie with an invalid signature is ignored.")
+            return None
+        try:
+            data = _b64decode(payload[1:])
+            if payload[0] == "z":
+                data = zlib.decompress(data)
+            obj = json.loads(data)
+            session = CookieSessionImpl(obj["id"], obj["c"], obj["a"], self, attrs=obj["d"],
+                                        max_inactive_interval=obj["m"], is_new=False)
+        except (ValueError, KeyError, TypeError, zlib.error):
+            _logger.warning("Session cookie cannot be decoded, ignore it.")
+            return None
+        # Signed by an old key, sign it with the current one.
+        session.changed = key_id != self.__sign_key_id
+        return session
+
+    def _create_session(self) -> CookieSessionImpl:
+        now = time.time()
+        return CookieSessionImpl(uuid.uuid4().hex, now, now, self, max_inactive_interval=self.max_inactive_interval)
+
+    def get_session(self, session_id: str, create: bool = False) -> CookieSessionImpl:
+        session = self.decode(session_id) if session_id else None
+        if session and session.is_valid:
+            return session
+        elif create:
+            return self._create_session()
+        else:
+            return None
+
+    def session_cookie_value(self, session: CookieSessionImpl) -> str:
+        if not session.changed and time.time() - session.last_accessed_time < self.cookie_refresh_threshold(session):
+            return None
+        # The expiry of the session starts again whenever the cookie is written.
+        session._touch(time.time())
+        try:
+            return self.encode(session)
+        except (TypeError, ValueError) as e:
+            _logger.error(f"Cannot write session [{session.id}] to cookie: {e}")
+            return None
@@ -22,10 +22,13 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import heapq
+import sys
 import threading
 import uuid
 import time
 
+from collections import OrderedDict
 from typing import Any, Dict, List, Tuple
 from threading import RLock
 from simple_http_server import Session, SessionFactory
@@ -33,7 +36,11 @@ from simple_http_server.logger import get_logger
 
 _logger = get_logger("simple_http_server.http_session_local")
 
+# The cleaning thread sleeps until the first session expires, but not longer than the max interval.
 _SESSION_TIME_CLEANING_INTERVAL = 60
+_SESSION_TIME_CLEANING_MIN_INTERVAL = 1
+# Release the lock after popping this number of expired sessions, so the requests will not wait too long.
+_SESSION_TIME_CLEANING_BATCH = 1000
 
 
 def _get_from_dict(adict: Dict[str, Any], key: str) -> Any:
@@ -47,46 +54,163 @@ def _get_from_dict(adict: Dict[str, Any], key: str) -> Any:
 
 
 class LocalSessionHolder:
-
-    def __init__(self):
-        self.__sessions: Dict[str, Session] = {}
+    """
+    Sessions are indexed by their expiry time in a heap, so the cleaning only visits the expired ones.
+
+    Accessing a session does not touch the heap. When an entry is popped, the expiry is computed again, and the entry
+    is pushed back if the session was accessed since it was scheduled. So a session is rescheduled at most once
+    every `max_inactive_interval`.
+
+    If `max_sessions` or `max_bytes` (the approximate size of the attributes of all sessions) is set, the sessions are
+    kept in the order of access, and the least recently accessed ones are evicted when a limit is exceeded.
+    """
+
+    def __init__(self, clean_in_bg: bool = True, max_sessions: int = 0, max_bytes: int = 0):
+        self.__sessions: Dict[str, Session] = OrderedDict()
+        self.max_sessions: int = max_sessions
+        self.max_bytes: int = max_bytes
+        self.__lru: bool = bool(max_sessions or max_bytes)
+        self.bytes: int = 0
+        self.expired: int = 0
+        self.evicted_by_count: int = 0
+        self.evicted_by_bytes: int = 0
+        # (expiry time, session id)
+        self.__expiry_heap: List[Tuple[float, str]] = []
+        # The expiry time of the live entry of every session, other entries of the session in the heap are stale.
+        self.__scheduled: Dict[str, float] = {}
         self.__session_lock = RLock()
-        self.__started = False
-        self.__clearing_thread = threading.Thread(target=self._clear_time_out_session_in_bg, daemon=True)
+        # A shard of `ShardedLocalSessionHolder` is cleaned by the thread of the sharded holder, it has no thread.
+        self.clean_in_bg: bool = clean_in_bg
+        self.__clearing_thread: threading.Thread = None
+
+    def __len__(self) -> int:
+        return len(self.__sessions)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "sessions": len(self.__sessions),
+            "bytes": self.bytes,
+            "expired": self.expired,
+            "evicted_by_count": self.evicted_by_count,
+            "evicted_by_bytes": self.evicted_by_bytes
+        }
 
     def _start_cleaning(self):
-        if not self.__started:
-            self.__started = True
+        if self.clean_in_bg and self.__clearing_thread is None:
+            self.__clearing_thread = threading.Thread(target=self._clear_time_out_session_in_bg, daemon=True)
             self.__clearing_thread.start()
 
     def _clear_time_out_session_in_bg(self):
         while True:
-            time.sleep(_SESSION_TIME_CLEANING_INTERVAL)
+            time.sleep(self._next_cleaning_delay())
             self._clear_time_out_session()
 
-    def _clear_time_out_session(self):
-        timeout_sessions: List[Session] = []
-        for v in self.__sessions.values():
-            if not v.is_valid:
-                timeout_sessions.append(v)
-        for session in timeout_sessions:
-            session.invalidate()
+    def _next_cleaning_delay(self) -> float:
+        with self.__session_lock:
+            if not self.__expiry_heap:
+                return _SESSION_TIME_CLEANING_INTERVAL
+            delay = self.__expiry_heap[0][0] - time.time()
+        return min(max(delay, _SESSION_TIME_CLEANING_MIN_INTERVAL), _SESSION_TIME_CLEANING_INTERVAL)
+
+    def _schedule(self, session: Session):
+        expiry = session.last_accessed_time + session.max_inactive_interval
+        self.__scheduled[session.id] = expiry
+        heapq.heappush(self.__expiry_heap, (expiry, session.id))
+
+    def reschedule(self, session: Session):
+        """
+        Schedule the session again if it expires earlier than it is scheduled, when its `max_inactive_interval` is
+        shortened, for example. Later expiry does not need rescheduling.
+        """
+        with self.__session_lock:
+            if self.__sessions.get(session.id) is not session:
+                return
+            if session.last_accessed_time + session.max_inactive_interval < self.__scheduled[session.id]:
+                self._schedule(session)
+
+    def _clear_time_out_session(self, now: float = None) -> int:
+        """
+        Remove the expired sessions and return the number of them.
+        """
+        now = now or time.time()
+        cleared = 0
+        while True:
+            with self.__session_lock:
+                for _ in range(_SESSION_TIME_CLEANING_BATCH):
+                    if not self.__expiry_heap or self.__expiry_heap[0][0] > now:
+                        return cleared
+                    expiry, session_id = heapq.heappop(self.__expiry_heap)
+                    if self.__scheduled.get(session_id) != expiry:
+                        # The session is removed or rescheduled.
+                        continue
+                    session = self.__sessions[session_id]
+                    if session.last_accessed_time + session.max_inactive_interval > now:
+                        # Accessed after it was scheduled.
+                        self._schedule(session)
+                        continue
+                    _logger.debug(f"Session[#{session_id}] is expired.")
+                    self._remove(session_id)
+                    self.expired += 1
+                    cleared += 1
+
+    def _remove(self, session_id: str) -> Session:
+        session = self.__sessions.pop(session_id)
+        # The entry in the heap becomes stale, it will be skipped when it is popped.
+        self.__scheduled.pop(session_id, None)
+        self.bytes -= getattr(session, "attributes_size", 0)
+        return session
+
+    def account(self, session: Session, delta: int):
+        """
+        Count the size change of the attributes of a session, and evict sessions if the byte budget is exceeded.
+        """
+        with self.__session_lock:
+            if self.__sessions.get(session.id) is not session:
+                return
+            self.bytes += delta
+            if delta > 0:
+                self._evict(keep=session)
+
+    def _evict(self, keep: Session):
+        while True:
+            if self.max_sessions and len(self.__sessions) > self.max_sessions:
+                by_count = True
+            elif self.max_bytes and self.bytes > self.max_bytes:
+                by_count = False
+            else:
+                return
+            # The least recently accessed session, but never the one that is being used.
+            victim = next((sid for sid, sess in self.__sessions.items() if sess is not keep), None)
+            if victim is None:
+                return
+            _logger.debug(f"Session[#{victim}] is evicted.")
+            self._remove(victim)._set_last_accessed_time(0)
+            if by_count:
+                self.evicted_by_count += 1
+            else:
+                self.evicted_by_bytes += 1
 
     def clean_session(self, session_id: str):
         if session_id in self.__sessions:
-            try:
-                _logger.debug("session[#%s] is being cleaned" % session_id)
-                sess = self.__sessions[session_id]
-                if not sess.is_valid:
-                    del self.__sessions[session_id]
-            except KeyError:
-                _logger.debug("Session[#%s] in session cache is already deleted. " % session_id)
+            with self.__session_lock:
+                try:
+                    _logger.debug("session[#%s] is being cleaned" % session_id)
+                    sess = self.__sessions[session_id]
+                    if not sess.is_valid:
+                        self._remove(session_id)
+                except KeyError:
+                    _logger.debug("Session[#%s] in session cache is already deleted. " % session_id)
 
     def get_session(self, session_id: str) -> Session:
         if not session_id:
             return None
         sess: Session = _get_from_dict(self.__sessions, session_id)
         if sess and sess.is_valid:
+            if self.__lru:
+                with self.__session_lock:
+                    if session_id in self.__sessions:
+                        self.__sessions.move_to_end(session_id)
             return sess
         else:
             return None
@@ -94,23 +218,91 @@ class LocalSessionHolder:
     def cache_session(self,  session: Session):
         if not session:
             return None
-        sess: Session = _get_from_dict(self.__sessions, session.id)
-
-        if sess:
-            if session is sess:
-                return
-            sess.invalidate()
         with self.__session_lock:
+            sess: Session = _get_from_dict(self.__sessions, session.id)
+            if sess:
+                if session is sess:
+                    return
+                sess.invalidate()
             self.__sessions[session.id] = session
+            self.bytes += getattr(session, "attributes_size", 0)
+            self._schedule(session)
+            self._evict(keep=session)
             self._start_cleaning()
 
             return session
 
 
+def _share(limit: int, shards: int, idx: int) -> int:
+    return limit // shards + (1 if idx < limit % shards else 0)
+
+
+class ShardedLocalSessionHolder:
+    """
+    Sessions are spread into shards by the hash of their ids, every shard has its own dict, lock and expiry heap, so
+    the threads working on different sessions seldom wait for each other. All shards are cleaned in one thread.
+    """
+
+    def __init__(self, shards: int = 16, max_sessions: int = 0, max_bytes: int = 0):
+        assert shards > 0
+        # The limits are divided into the shards, and the sum of the shard limits is never more than the limits. Every
+        # shard should get at least 1, for 0 means no limit, so there are not more shards than a limit.
+        for limit in (max_sessions, max_bytes):
+            if limit > 0:
+                shards = min(shards, limit)
+        self.shards: List[LocalSessionHolder] = [
+            LocalSessionHolder(clean_in_bg=False, max_sessions=_share(max_sessions, shards, idx),
+                               max_bytes=_share(max_bytes, shards, idx))
+            for idx in range(shards)]
+        self.__started = False
+        self.__start_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self.shards)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        stats = {}
+        for shard in self.shards:
+            for k, v in shard.stats.items():
+                stats[k] = stats.get(k, 0) + v
+        return stats
+
+    def shard_of(self, session_id: str) -> LocalSessionHolder:
+        return self.shards[hash(session_id) % len(self.shards)]
+
+    def _start_cleaning(self):
+        if self.__started:
+            return
+        with self.__start_lock:
+            if self.__started:
+                return
+            self.__started = True
+        threading.Thread(target=self._clear_time_out_session_in_bg, daemon=True).start()
+
+    def _clear_time_out_session_in_bg(self):
+        while True:
+            time.sleep(min(shard._next_cleaning_delay() for shard in self.shards))
+            self._clear_time_out_session()
+
+    def _clear_time_out_session(self, now: float = None) -> int:
+        return sum(shard._clear_time_out_session(now) for shard in self.shards)
+
+    def get_session(self, session_id: str) -> Session:
+        if not session_id:
+            return None
+        return self.shard_of(session_id).get_session(session_id)
+
+    def cache_session(self, session: Session):
+        if not session:
+            return None
+        self._start_cleaning()
+        return self.shard_of(session.id).cache_session(session)
+
+
 class LocalSessionImpl(Session):
 
     def __init__(self, id: str, creation_time: float, session_holder: LocalSessionHolder):
-        super().__init__()
         self.__id = id
         self.__creation_time = creation_time
         self.__last_accessed_time = creation_time
@@ -118,6 +310,9 @@ class LocalSessionImpl(Session):
         self.__attr_lock = RLock()
         self.__attrs = {}
         self.__session_holder = session_holder
+        self.__max_inactive_interval: int = 0
+        self.__attributes_size: int = 0
+        super().__init__()
 
     @property
     def id(self) -> str:
@@ -135,6 +330,17 @@ class LocalSessionImpl(Session):
     def is_new(self) -> bool:
         return self.__is_new
 
+    @property
+    def max_inactive_interval(self) -> int:
+        return self.__max_inactive_interval
+
+    @max_inactive_interval.setter
+    def max_inactive_interval(self, interval: int):
+        shortened = interval < self.__max_inactive_interval
+        self.__max_inactive_interval = interval
+        if shortened:
+            self.__session_holder.reschedule(self)
+
     def _set_last_accessed_time(self, last_acessed_time: float):
         self.__last_accessed_time = last_acessed_time
         self.__is_new = False
@@ -146,9 +352,19 @@ class LocalSessionImpl(Session):
     def get_attribute(self, name: str) -> Any:
         return _get_from_dict(self.__attrs, name)
 
+    @property
+    def attributes_size(self) -> int:
+        """The approximate size of the attributes in bytes, the objects referred by the values are not counted."""
+        return self.__attributes_size
+
     def set_attribute(self, name: str, value: Any) -> None:
         with self.__attr_lock:
+            delta = sys.getsizeof(name) + sys.getsizeof(value)
+            if name in self.__attrs:
+                delta -= sys.getsizeof(name) + sys.getsizeof(self.__attrs[name])
             self.__attrs[name] = value
+            self.__attributes_size += delta
+        self.__session_holder.account(self, delta)
 
     def invalidate(self) -> None:
         self._set_last_accessed_time(0)
@@ -157,16 +373,26 @@ class LocalSessionImpl(Session):
 
 class LocalSessionFactory(SessionFactory):
 
-    def __init__(self):
-        self.__session_holder = LocalSessionHolder()
-        self.__session_lock = RLock()
+    blocking: bool = False
+
+    def __init__(self, shards: int = 16, max_sessions: int = 0, max_bytes: int = 0):
+        """
+        `max_sessions` and `max_bytes` limit the number of sessions and the approximate size of their attributes, the
+        least recently accessed sessions are evicted when they are exceeded. 0 means no limit.
+        """
+        self.__session_holder = ShardedLocalSessionHolder(shards, max_sessions=max_sessions, max_bytes=max_bytes)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return self.__session_holder.stats
 
     def _create_local_session(self, session_id: str) -> Session:
         if session_id:
             sid = session_id
         else:
             sid = uuid.uuid4().hex
-        return LocalSessionImpl(sid, time.time(), self.__session_holder)
+        # The session talks to its own shard directly when it is invalidated or rescheduled.
+        return LocalSessionImpl(sid, time.time(), self.__session_holder.shard_of(sid))
 
     def get_session(self, session_id: str, create: bool = False) -> Session:
         sess: LocalSessionImpl = self.__session_holder.get_session(session_id)
@@ -175,8 +401,7 @@ class LocalSessionFactory(SessionFactory):
             return sess
         if not create:
             return None
-        with self.__session_lock:
-            session = self._create_local_session(session_id)
-            self.__session_holder.cache_session(session)
-            return session
+        session = self._create_local_session(session_id)
+        self.__session_holder.cache_session(session)
+        return session
 
@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2018 Keijack Wu
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import mmap
+import os
+import pickle
+import struct
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Tuple
+from simple_http_server import Session, SessionFactory
+from simple_http_server.logger import get_logger
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, the table can only be shared by the threads of one process.
+    fcntl = None
+
+_logger = get_logger("simple_http_server.http_session_shm")
+
+_MAGIC = b"PSHS"
+
+_VERSION = 2
+
+# magic, version, buckets, slots of every bucket, size of a slot.
+_HEADER = struct.Struct("<4sIIII")
+
+_HEADER_SIZE = 64
+
+# used, creation time, last accessed time, max inactive interval, size of the attributes, id, the expiry time in the
+# session cookie that was last sent.
+_SLOT = struct.Struct("<B7xddiI64sd")
+
+_LAST_ACCESSED_TIME = struct.Struct("<d")
+
+_LAST_ACCESSED_TIME_OFFSET = 16
+
+_ID_OFFSET = 32
+
+_COOKIE_EXPIRES = struct.Struct("<d")
+
+_COOKIE_EXPIRES_OFFSET = 96
+
+_MAX_ID_SIZE = 64
+
+
+class ShmSessionImpl(Session):
+
+    def __init__(self, id: str, creation_time: float, last_accessed_time: float, factory: "ShmSessionFactory",
+                 attrs: Dict[str, Any] = None, max_inactive_interval: int = None, is_new: bool = True,
+                 cookie_expires: float = 0):
+        self.__id = id
+        self.__creation_time = creation_time
+        self.__last_accessed_time = last_accessed_time
+        self.__is_new = is_new
+        self.__attrs: Dict[str, Any] = attrs or {}
+        self.__cookie_expires: float = cookie_expires
+        # Not to write the default interval set by `Session.__init__` to the table.
+        self.__factory: ShmSessionFactory = None
+        self.__max_inactive_interval: int = 0
+        super().__init__()
+        if max_inactive_interval is not None:
+            self.__max_inactive_interval = max_inactive_interval
+        self.__factory = factory
+
+    @property
+    def id(self) -> str:
+        return self.__id
+
+    @property
+    def creation_time(self) -> float:
+        return self.__creation_time
+
+    @property
+    def last_accessed_time(self) -> float:
+        return self.__last_accessed_time
+
+    @property
+    def is_new(self) -> bool:
+        return self.__is_new
+
+    @property
+    def max_inactive_interval(self) -> int:
+        return self.__max_inactive_interval
+
+    @max_inactive_interval.setter
+    def max_inactive_interval(self, interval: int):
+        changed = interval != self.__max_inactive_interval
+        self.__max_inactive_interval = interval
+        if changed and self.__factory:
+            self._updated(self.__factory._update(self))
+
+    @property
+    def _cookie_expires(self) -> float:
+        return self.__cookie_expires
+
+    @_cookie_expires.setter
+    def _cookie_expires(self, expires: float):
+        # A new session object is built for every request, so it is kept in the table.
+        self.__cookie_expires = expires
+        self.__factory._set_cookie_expires(self, expires)
+
+    @property
+    def attribute_names(self) -> Tuple:
+        return tuple(self.__attrs.keys())
+
+    def get_attribute(self, name: str) -> Any:
+        return self.__attrs.get(name)
+
+    def set_attribute(self, name: str, value: Any) -> None:
+        attrs = self.__factory._update(self, {name: value})
+        if attrs is None:
+            self.__attrs[name] = value
+        self._updated(attrs)
+
+    def _updated(self, attrs: Dict[str, Any]):
+        if attrs is None:
+            # Invalidated by another process, or evicted, it should not be brought back.
+            self.__last_accessed_time = 0
+            self.__is_new = False
+        else:
+            self.__attrs = attrs
+
+    def invalidate(self) -> None:
+        self.__last_accessed_time = 0
+        self.__is_new = False
+        self.__factory._invalidate(self)
+
+
+class ShmSessionFactory(SessionFactory):
+    """
+    Sessions are stored in a hash table in a memory mapped file, so they can be shared by the processes that serve
+    the same port, without an external service.
+
+    The table has `capacity` slots of `slot_size` bytes, which are grouped in buckets of `bucket_slots` slots. A session
+    is always put in the bucket of the hash of its id. When the bucket is full, the expired or the least recently
+    accessed session in it is evicted. Every bucket has its own lock, which is a `fcntl` lock of one byte of the file
+    between the processes, and a thread lock in the process.
+
+    The attributes are pickled, and they must fit in a slot, `set_attribute` raises a `ValueError` otherwise. Setting an
+    attribute updates the session in the table at once, other attributes changed by other processes are kept. A session
+    that has been invalidated or evicted in the meantime is not written back, it becomes invalid instead.
+
+    With a `path`, all the processes that open the same file share the sessions, put it in `/dev/shm` on Linux to keep
+    it in memory, and only in a place that is not writable by others. Without a path, a temporary file is used, which
+    is shared with the child processes that are forked after the factory is created.
+    """
+
+    blocking: bool = False
+
+    def __init__(self, path: str = None,
+                 capacity: int = 10000,
+                 slot_size: int = 1024,
+                 bucket_slots: int = 8,
+                 max_inactive_interval: int = 30 * 60):
+        if slot_size <= _SLOT.size:
+            raise ValueError(f"Slot size must be larger than {_SLOT.size} bytes.")
+        self.path: str = path
+        self.slot_size: int = slot_size
+        self.bucket_slots: int = bucket_slots
+        self.buckets: int = max(1, -(-capacity // bucket_slots))
+        self.capacity: int = self.buckets * bucket_slots
+        self.max_inactive_interval: int = max_inactive_interval
+        self.__thread_locks: List[threading.Lock] = [threading.Lock() for _ in range(self.buckets)]
+        size = _HEADER_SIZE + self.capacity * slot_size
+
+        header = _HEADER.pack(_MAGIC, _VERSION, self.buckets, bucket_slots, slot_size)
+        if path:
+            self.__file = open(os.open(path, os.O_RDWR | os.O_CREAT, 0o600), "r+b")
+        else:
+            self.__file = tempfile.TemporaryFile(prefix="simple_http_server_sessions_")
+        self.__fd = self.__file.fileno()
+        # Only one of the processes that open the file at the same time initializes it.
+        with self._file_lock(0):
+            self.__file.seek(0)
+            existing_header = self.__file.read(_HEADER.size)
+            if existing_header[:4] != _MAGIC:
+                self.__file.truncate(size)
+                self.__file.seek(0)
+                self.__file.write(header)
+                self.__file.flush()
+                existing_header = header
+        if existing_header != header:
+            self.__file.close()
+            raise ValueError(f"Session table [{path}] is created with another version, capacity or slot size.")
+        self.__mm = mmap.mmap(self.__fd, size)
+
+    @contextmanager
+    def _file_lock(self, index: int) -> Iterator[None]:
+        if fcntl is None:
+            yield
+            return
+        # One byte for a lock, it does not need to be in the file.
+        fcntl.lockf(self.__fd, fcntl.LOCK_EX, 1, index)
+        try:
+            yield
+        finally:
+            fcntl.lockf(self.__fd, fcntl.LOCK_UN, 1, index)
+
+    def _lock_bucket(self, bucket: int):
+        # The `fcntl` locks are owned by the process, so the threads must be excluded by a thread lock.
+        self.__thread_locks[bucket].acquire()
+        if fcntl is not None:
+            try:
+                fcntl.lockf(self.__fd, fcntl.LOCK_EX, 1, bucket + 1)
+            except BaseException:
+                self.__thread_locks[bucket].release()
+                raise
+
+    def _unlock_bucket(self, bucket: int):
+        if fcntl is not None:
+            fcntl.lockf(self.__fd, fcntl.LOCK_UN, 1, bucket + 1)
+        self.__thread_locks[bucket].release()
+
+    def _bucket_of(self, id: bytes) -> int:
+        # The hash of str is randomized in every process.
+        return zlib.crc32(id) % self.buckets
+
+    def _slot_offset(self, bucket: int, slot: int) -> int:
+        return _HEADER_SIZE + (bucket * self.bucket_slots + slot) * self.slot_size
+
+    def _find(self, bucket: int, id: bytes) -> Tuple[int, tuple]:
+        padded_id = id.ljust(_MAX_ID_SIZE, b"\x00")
+        mm = self.__mm
+        for slot in range(self.bucket_slots):
+            offset = self._slot_offset(bucket, slot)
+            if mm[offset] and mm[offset + _ID_OFFSET:offset + _COOKIE_EXPIRES_OFFSET] == padded_id:
+                return offset, _SLOT.unpack_from(mm, offset)
+        return -1, None
+
+    def _allocate(self, bucket: int, now: float) -> int:
+        lru_offset, lru_time = -1, None
+        for slot in range(self.bucket_slots):
+            offset = self._slot_offset(bucket, slot)
+            used, _, last_accessed_time, max_inactive_interval, _, _, _ = _SLOT.unpack_from(self.__mm, offset)
+            if not used or last_accessed_time + max_inactive_interval <= now:
+                return offset
+            if lru_time is None or last_accessed_time < lru_time:
+                lru_offset, lru_time = offset, last_accessed_time
+        _logger.debug(f"Session bucket[#{bucket}] is full, evict the least recently accessed session.")
+        return lru_offset
+
+    def _write(self, offset: int, session: ShmSessionImpl, id: bytes, attrs: Dict[str, Any], last_accessed_time: float,
+               cookie_expires: float = 0):
+        data = pickle.dumps(attrs)
+        if _SLOT.size + len(data) > self.slot_size:
+            raise ValueError(f"Attributes of session[#{session.id}] are {len(data)} bytes, "
+                             f"which do not fit in a slot of {self.slot_size} bytes.")
+        self.__mm[offset + _SLOT.size:offset + _SLOT.size + len(data)] = data
+        _SLOT.pack_into(self.__mm, offset, 1, session.creation_time, last_accessed_time,
+                        session.max_inactive_interval, len(data), id, cookie_expires)
+
+    def _load_attributes(self, offset: int, record: tuple) -> Dict[str, Any]:
+        start = offset + _SLOT.size
+        return pickle.loads(self.__mm[start:start + record[4]])
+
+    def _update(self, session: ShmSessionImpl, attrs: Dict[str, Any] = {}) -> Dict[str, Any]:
+        """
+        Update the session in the table, and return its attributes, or None if it is no longer in the table.
+        """
+        id = session.id.encode()
+        bucket = self._bucket_of(id)
+        self._lock_bucket(bucket)
+        try:
+            offset, record = self._find(bucket, id)
+            if not record:
+                return None
+            new_attrs = self._load_attributes(offset, record)
+            new_attrs.update(attrs)
+            # Another process may have accessed it later.
+            self._write(offset, session, id, new_attrs, max(record[2], session.last_accessed_time), record[6])
+            return new_attrs
+        finally:
+            self._unlock_bucket(bucket)
+
+    def _set_cookie_expires(self, session: ShmSessionImpl, expires: float):
+        id = session.id.encode()
+        bucket = self._bucket_of(id)
+        self._lock_bucket(bucket)
+        try:
+            offset, record = self._find(bucket, id)
+            if record:
+                _COOKIE_EXPIRES.pack_into(self.__mm, offset + _COOKIE_EXPIRES_OFFSET, expires)
+        finally:
+            self._unlock_bucket(bucket)
+
+    def _invalidate(self, session: ShmSessionImpl):
+        id = session.id.encode()
+        bucket = self._bucket_of(id)
+        self._lock_bucket(bucket)
+        try:
+            offset, record = self._find(bucket, id)
+            if record:
+                self.__mm[offset] = 0
+        finally:
+            self._unlock_bucket(bucket)
+
+    def _create_session(self) -> ShmSessionImpl:
+        now = time.time()
+        session = ShmSessionImpl(uuid.uuid4().hex, now, now, self, max_inactive_interval=self.max_inactive_interval)
+        id = session.id.encode()
+        bucket = self._bucket_of(id)
+        self._lock_bucket(bucket)
+        try:
+            self._write(self._allocate(bucket, now), session, id, {}, now)
+        finally:
+            self._unlock_bucket(bucket)
+        return session
+
+    def _get_session(self, session_id: str) -> ShmSessionImpl:
+        id = session_id.encode()
+        if len(id) > _MAX_ID_SIZE:
+            return None
+        bucket = self._bucket_of(id)
+        now = time.time()
+        self._lock_bucket(bucket)
+        try:
+            offset, record = self._find(bucket, id)
+            if not record:
+                return None
+            _, creation_time, last_accessed_time, max_inactive_interval, _, _, cookie_expires = record
+            if last_accessed_time + max_inactive_interval <= now:
+                self.__mm[offset] = 0
+                return None
+            _LAST_ACCESSED_TIME.pack_into(self.__mm, offset + _LAST_ACCESSED_TIME_OFFSET, now)
+            attrs = self._load_attributes(offset, record)
+        except Exception:
+            _logger.exception(f"Cannot load the attributes of session[#{session_id}].")
+            return None
+        finally:
+            self._unlock_bucket(bucket)
+        return ShmSessionImpl(session_id, creation_time, now, self, attrs=attrs,
+                              max_inactive_interval=max_inactive_interval, is_new=False, cookie_expires=cookie_expires)
+
+    def get_session(self, session_id: str, create: bool = False) -> ShmSessionImpl:
+        session = self._get_session(session_id) if session_id else None
+        if session:
+            return session
+        elif create:
+            return self._create_session()
+        else:
+            return None
+
+    def __len__(self) -> int:
+        now = time.time()
+        count = 0
+        for bucket in range(self.buckets):
+            for slot in range(self.bucket_slots):
+                used, _, last_accessed_time, max_inactive_interval, _, _, _ = _SLOT.unpack_from(
+                    self.__mm, self._slot_offset(bucket, slot))
+                if used and last_accessed_time + max_inactive_interval > now:
+                    count += 1
+        return count
+
+    def close(self):
+        self.__mm.close()
+        self.__file.close()
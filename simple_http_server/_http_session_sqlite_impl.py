@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2018 Keijack Wu
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import atexit
+import pickle
+import sqlite3
+import threading
+import time
+import uuid
+
+from collections import OrderedDict
+from typing import Any, Dict, List, Set, Tuple
+from threading import RLock
+from simple_http_server import Session, SessionFactory
+from simple_http_server.logger import get_logger
+
+_logger = get_logger("simple_http_server.http_session_sqlite")
+
+_CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    creation_time REAL NOT NULL,
+    last_accessed_time REAL NOT NULL,
+    max_inactive_interval INTEGER NOT NULL,
+    expiry_time REAL NOT NULL,
+    attributes BLOB NOT NULL,
+    cookie_expires REAL NOT NULL DEFAULT 0
+)
+"""
+
+_CREATE_EXPIRY_INDEX = "CREATE INDEX IF NOT EXISTS sessions_expiry_time ON sessions (expiry_time)"
+
+
+class SqliteSessionImpl(Session):
+
+    def __init__(self, id: str, creation_time: float, last_accessed_time: float, factory: "SqliteSessionFactory",
+                 attrs: Dict[str, Any] = None, max_inactive_interval: int = None, is_new: bool = True,
+                 cookie_expires: float = 0):
+        self.__id = id
+        self.__creation_time = creation_time
+        self.__last_accessed_time = last_accessed_time
+        self.__is_new = is_new
+        self.__cookie_expires: float = cookie_expires
+        self.__attr_lock = RLock()
+        self.__attrs: Dict[str, Any] = attrs or {}
+        # Not to mark the session dirty for the default interval set by `Session.__init__`.
+        self.__factory: SqliteSessionFactory = None
+        self.__max_inactive_interval: int = 0
+        super().__init__()
+        if max_inactive_interval is not None:
+            self.__max_inactive_interval = max_inactive_interval
+        self.__factory = factory
+        # When the session is loaded from the database, it is used to decide whether to reload it.
+        self.loaded_time: float = time.time()
+
+    @property
+    def id(self) -> str:
+        return self.__id
+
+    @property
+    def creation_time(self) -> float:
+        return self.__creation_time
+
+    @property
+    def last_accessed_time(self) -> float:
+        return self.__last_accessed_time
+
+    @property
+    def is_new(self) -> bool:
+        return self.__is_new
+
+    @property
+    def max_inactive_interval(self) -> int:
+        return self.__max_inactive_interval
+
+    @max_inactive_interval.setter
+    def max_inactive_interval(self, interval: int):
+        changed = interval != self.__max_inactive_interval
+        self.__max_inactive_interval = interval
+        if changed and self.__factory:
+            self.__factory._mark_dirty(self)
+
+    @property
+    def _cookie_expires(self) -> float:
+        return self.__cookie_expires
+
+    @_cookie_expires.setter
+    def _cookie_expires(self, expires: float):
+        # The session is loaded again after `cache_ttl`, so it is kept in the database.
+        self.__cookie_expires = expires
+        self.__factory._mark_touched(self)
+
+    def _set_last_accessed_time(self, last_acessed_time: float):
+        self.__last_accessed_time = last_acessed_time
+        self.__is_new = False
+
+    @property
+    def attribute_names(self) -> Tuple:
+        return tuple(self.__attrs.keys())
+
+    def get_attribute(self, name: str) -> Any:
+        return self.__attrs.get(name)
+
+    def set_attribute(self, name: str, value: Any) -> None:
+        with self.__attr_lock:
+            self.__attrs[name] = value
+        self.__factory._mark_dirty(self)
+
+    def _dump_attributes(self) -> bytes:
+        with self.__attr_lock:
+            return pickle.dumps(self.__attrs)
+
+    def invalidate(self) -> None:
+        self._set_last_accessed_time(0)
+        self.__factory._invalidate(self)
+
+
+class SqliteSessionFactory(SessionFactory):
+    """
+    Sessions are stored in a SQLite database, so they survive restarts, and can be shared by the worker processes.
+
+    Sessions are cached in memory after they are read (read-through). Changes are written in batches by a background
+    thread every `flush_interval` seconds (write-behind), so the requests do not wait for the disk. This includes new
+    attributes, new sessions, access times and invalidation. The database is in WAL mode, so the processes can read
+    while one of them is writing. Expired sessions are deleted by the index of the expiry time.
+
+    With several processes, a cached session may be changed by another process. So it is loaded again if it has been
+    cached for more than `cache_ttl` seconds. When two processes change the same session at the same time, the last
+    write wins. The attributes are pickled, so only put the database in a place that is not writable by others.
+    """
+
+    def __init__(self, path: str = "sessions.db",
+                 flush_interval: float = 1,
+                 cache_size: int = 10000,
+                 cache_ttl: float = 5,
+                 cleaning_interval: float = 60):
+        self.path: str = path
+        self.flush_interval: float = flush_interval
+        self.cache_size: int = cache_size
+        self.cache_ttl: float = cache_ttl
+        self.cleaning_interval: float = cleaning_interval
+        self.__local = threading.local()
+        self.__lock = RLock()
+        self.__cache: Dict[str, SqliteSessionImpl] = OrderedDict()
+        # Sessions whose attributes are changed, and sessions that are only accessed.
+        self.__dirty: Dict[str, SqliteSessionImpl] = {}
+        self.__touched: Dict[str, SqliteSessionImpl] = {}
+        self.__deleted: Set[str] = set()
+        self.__last_cleaning: float = time.time()
+        self.__stopped = threading.Event()
+        self.__writer: threading.Thread = None
+
+        conn = self._connect()
+        with conn:
+            conn.execute(_CREATE_TABLE)
+            conn.execute(_CREATE_EXPIRY_INDEX)
+            # The databases created by the older versions do not have this column.
+            if "cookie_expires" not in [r[1] for r in conn.execute("PRAGMA table_info(sessions)")]:
+                conn.execute("ALTER TABLE sessions ADD COLUMN cookie_expires REAL NOT NULL DEFAULT 0")
+        conn.close()
+        atexit.register(self.close)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # Durable enough in WAL mode, the database will not be corrupted, only the last transactions may be lost.
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        # A sqlite3 connection can only be used in the thread that creates it.
+        conn = getattr(self.__local, "conn", None)
+        if conn is None:
+            conn = self.__local.conn = self._connect()
+        return conn
+
+    def _load(self, session_id: str, now: float) -> SqliteSessionImpl:
+        row = self._conn.execute(
+            "SELECT creation_time, last_accessed_time, max_inactive_interval, attributes, cookie_expires FROM sessions "
+            "WHERE id = ? AND expiry_time > ?", (session_id, now)).fetchone()
+        if not row:
+            return None
+        creation_time, last_accessed_time, max_inactive_interval, attributes, cookie_expires = row
+        try:
+            attrs = pickle.loads(attributes)
+        except Exception:
+            _logger.exception(f"Cannot load the attributes of session[#{session_id}].")
+            return None
+        return SqliteSessionImpl(session_id, creation_time, last_accessed_time, self, attrs=attrs,
+                                 max_inactive_interval=max_inactive_interval, is_new=False,
+                                 cookie_expires=cookie_expires)
+
+    def _cache(self, session: SqliteSessionImpl):
+        with self.__lock:
+            self.__cache[session.id] = session
+            self.__cache.move_to_end(session.id)
+            while len(self.__cache) > self.cache_size:
+                sid, _ = self.__cache.popitem(last=False)
+                _logger.debug(f"Session[#{sid}] is removed from the cache.")
+
+    def _get_cached(self, session_id: str, now: float) -> SqliteSessionImpl:
+        with self.__lock:
+            session = self.__cache.get(session_id)
+            if session is None:
+                return None
+            # Sessions with pending changes are newer than the database.
+            stale = now - session.loaded_time > self.cache_ttl \
+                and session_id not in self.__dirty and session_id not in self.__touched
+            if stale or not session.is_valid:
+                del self.__cache[session_id]
+                return None
+            self.__cache.move_to_end(session_id)
+            return session
+
+    def get_session(self, session_id: str, create: bool = False) -> Session:
+        now = time.time()
+        session: SqliteSessionImpl = None
+        if session_id and session_id not in self.__deleted:
+            session = self._get_cached(session_id, now)
+            if session is None:
+                session = self._load(session_id, now)
+                if session:
+                    self._cache(session)
+        if session:
+            session._set_last_accessed_time(now)
+            self._mark_touched(session)
+            return session
+        if not create:
+            return None
+        session = SqliteSessionImpl(session_id or uuid.uuid4().hex, now, now, self)
+        self._cache(session)
+        self._mark_dirty(session)
+        return session
+
+    def _start_writer(self):
+        if self.__writer is None and not self.__stopped.is_set():
+            self.__writer = threading.Thread(target=self._write_behind, name="sqlite-session-writer", daemon=True)
+            self.__writer.start()
+
+    def _mark_dirty(self, session: SqliteSessionImpl):
+        with self.__lock:
+            self.__dirty[session.id] = session
+            self.__touched.pop(session.id, None)
+            self.__deleted.discard(session.id)
+            self._start_writer()
+
+    def _mark_touched(self, session: SqliteSessionImpl):
+        with self.__lock:
+            if session.id not in self.__dirty:
+                self.__touched[session.id] = session
+            self._start_writer()
+
+    def _invalidate(self, session: SqliteSessionImpl):
+        with self.__lock:
+            self.__cache.pop(session.id, None)
+            self.__dirty.pop(session.id, None)
+            self.__touched.pop(session.id, None)
+            self.__deleted.add(session.id)
+            self._start_writer()
+
+    def _write_behind(self):
+        while not self.__stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                _logger.exception("Error occurs when writing sessions to the database.")
+
+    def flush(self):
+        """
+        Write the pending changes to the database in one transaction, and delete the expired sessions from time to time.
+        """
+        with self.__lock:
+            dirty, self.__dirty = list(self.__dirty.values()), {}
+            touched, self.__touched = list(self.__touched.values()), {}
+            deleted, self.__deleted = list(self.__deleted), set()
+        rows: List[Tuple] = []
+        for session in dirty:
+            try:
+                rows.append((session.id, session.creation_time, session.last_accessed_time,
+                             session.max_inactive_interval, session.last_accessed_time + session.max_inactive_interval,
+                             session._dump_attributes(), session._cookie_expires))
+            except Exception:
+                _logger.exception(f"Cannot save the attributes of session[#{session.id}].")
+        now = time.time()
+        try:
+            with self._conn as conn:
+                if deleted:
+                    conn.executemany("DELETE FROM sessions WHERE id = ?", [(sid,) for sid in deleted])
+                if rows:
+                    conn.executemany("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+                if touched:
+                    conn.executemany("UPDATE sessions SET last_accessed_time = ?, expiry_time = ?, cookie_expires = ? "
+                                     "WHERE id = ?",
+                                     [(s.last_accessed_time, s.last_accessed_time + s.max_inactive_interval,
+                                       s._cookie_expires, s.id) for s in touched])
+                if now - self.__last_cleaning >= self.cleaning_interval:
+                    self.__last_cleaning = now
+                    self._delete_expired(now, conn)
+        except Exception:
+            # For example, the database is locked by other processes, keep the changes to write them next time.
+            self._restore(dirty, touched, deleted)
+            raise
+
+    def _restore(self, dirty: List[SqliteSessionImpl], touched: List[SqliteSessionImpl], deleted: List[str]):
+        """
+        Put the changes that fail to be written back to the pending ones, the changes made since then are newer.
+        """
+        with self.__lock:
+            for sid in deleted:
+                if sid not in self.__dirty:
+                    self.__deleted.add(sid)
+            for session in dirty:
+                if session.id not in self.__dirty and session.id not in self.__deleted:
+                    self.__dirty[session.id] = session
+                    self.__touched.pop(session.id, None)
+            for session in touched:
+                if session.id not in self.__dirty and session.id not in self.__touched \
+                        and session.id not in self.__deleted:
+                    self.__touched[session.id] = session
+
+    def _delete_expired(self, now: float, conn: sqlite3.Connection = None) -> int:
+        if conn is None:
+            with self._conn as conn:
+                return self._delete_expired(now, conn)
+        cursor = conn.execute("DELETE FROM sessions WHERE expiry_time <= ?", (now,))
+        if cursor.rowcount:
+            _logger.debug(f"{cursor.rowcount} expired sessions are deleted.")
+        return cursor.rowcount
+
+    def close(self):
+        """
+        Stop the writing thread and write the pending changes, it is called at exit automatically.
+        """
+        if self.__stopped.is_set():
+            return
+        self.__stopped.set()
+        if self.__writer:
+            self.__writer.join()
+        self.flush()
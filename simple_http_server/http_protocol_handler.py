@@ -29,13 +29,15 @@ import email.message
 import socketserver
 import asyncio
 import socket
+import ssl
+import threading
 
 import simple_http_server.__utils as utils
 
 from typing import Any, Dict
 from http import HTTPStatus
 from urllib.parse import unquote
-from asyncio.streams import StreamReader, StreamWriter
+from asyncio.streams import StreamReader, StreamReaderProtocol, StreamWriter
 from http import HTTPStatus
 
 from simple_http_server import version as __version__
@@ -52,12 +54,92 @@ _logger = get_logger("simple_http_server.base_request_handler")
 
 class RequestWriter:
 
+    # Writes are done in the event loop, `drain` should be awaited for the backpressure.
+    is_async = True
+
     def __init__(self, writer: StreamWriter) -> None:
         self.writer: StreamWriter = writer
+        # Created in the event loop thread, the writer can only be used in this thread.
+        self.loop = asyncio.get_event_loop()
+        self.loop_thread_id: int = threading.get_ident()
 
     def send(self, data: bytes):
         self.writer.write(data)
 
+    async def drain(self):
+        await self.writer.drain()
+
+    @property
+    def buffer_size(self) -> int:
+        return self.writer.transport.get_write_buffer_size()
+
+
+class SocketRequestWriter:
+    """
+    Writes to the socket in threading mode, it blocks until all the data is sent.
+    """
+
+    is_async = False
+
+    def __init__(self, sock: socket.socket) -> None:
+        self.sock: socket.socket = sock
+        self.lock = threading.Lock()
+
+    def send(self, data: bytes):
+        with self.lock:
+            self.sock.sendall(data)
+
+    @property
+    def buffer_size(self) -> int:
+        # The kernel buffer is not counted.
+        return 0
+
+
+class WebsocketEventLoop:
+    """
+    An event loop running in a daemon thread. In threading mode, websocket connections can be handed over to it after
+    the upgrade, so idle sessions do not hold a thread each. The thread is started when it is used the first time.
+    """
+
+    def __init__(self) -> None:
+        self.loop: asyncio.AbstractEventLoop = None
+        self.__thread: threading.Thread = None
+        self.__lock = threading.Lock()
+
+    def _start(self) -> asyncio.AbstractEventLoop:
+        with self.__lock:
+            if self.loop is None:
+                started = threading.Event()
+                self.__thread = threading.Thread(target=self._run, args=(started,), name="websocket-event-loop", daemon=True)
+                self.__thread.start()
+                started.wait()
+            return self.loop
+
+    def _run(self, started: threading.Event):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.loop = loop
+        started.set()
+        try:
+            loop.run_forever()
+            tasks = asyncio.all_tasks(loop) if hasattr(asyncio, "all_tasks") else asyncio.Task.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        finally:
+            loop.close()
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._start())
+
+    def stop(self, timeout: float = 1):
+        with self.__lock:
+            loop, thread = self.loop, self.__thread
+            self.loop = self.__thread = None
+        if loop:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join(timeout)
+
 
 class HttpProtocolHandler:
 
@@ -78,7 +160,8 @@ class HttpProtocolHandler:
         for v in HTTPStatus.__members__.values()
     }
 
-    def __init__(self, reader: StreamReader, writer: StreamWriter, request_writer=None, routing_conf=None) -> None:
+    def __init__(self, reader: StreamReader, writer: StreamWriter, request_writer=None, routing_conf=None,
+                 websocket_loop: WebsocketEventLoop = None) -> None:
         self.routing_conf = routing_conf
         self.reader: StreamReader = reader
         self.writer: StreamWriter = writer
@@ -86,6 +169,13 @@ class HttpProtocolHandler:
             writer)
 
         self.close_connection = True
+        # Set when the server is shutting down, the connection will be closed after the current request.
+        self.shutting_down = False
+        # Whether a request is being handled.
+        self.is_processing = False
+        self.ws_handler: WebsocketRequestHandler = None
+        # In threading mode, websocket connections are handed over to this loop if it is set.
+        self.websocket_loop: WebsocketEventLoop = websocket_loop
 
         self.requestline = ''
         self.request_version = ''
@@ -98,6 +188,7 @@ class HttpProtocolHandler:
 
     async def parse_request(self):
         raw_requestline = await self.reader.readline()
+        self.is_processing = len(raw_requestline) > 0
         if len(raw_requestline) > _MAXLINE:
             self.requestline = ''
             self.request_version = ''
@@ -145,7 +236,7 @@ class HttpProtocolHandler:
                     f"Invalid HTTP version {base_version_number}")
                 return False
             self.request_version = version
-            _logger.info(f"request version: {self.request_version}")
+            _logger.debug("request version: %s", self.request_version)
         if not 2 <= len(words) <= 3:
             self.send_error(
                 HTTPStatus.BAD_REQUEST,
@@ -186,7 +277,7 @@ class HttpProtocolHandler:
             return False
 
         conntype = self.headers.get('Connection', "")
-        _logger.debug(f"connection type:: {conntype}")
+        _logger.debug("connection type:: %s", conntype)
         if conntype.lower() == 'close':
             self.close_connection = True
         elif (conntype.lower() == 'keep-alive' and
@@ -360,22 +451,37 @@ class HttpProtocolHandler:
         self.log_message(format, *args)
 
     def log_message(self, format, *args):
-        _logger.info(f"{format % args}")
+        # Formatted in the logging thread.
+        _logger.info(format, *args)
+
+    def close(self):
+        """Close the connection, the blocking or awaiting reading will be ended. It can be called in any thread."""
+        if self.request_writer.is_async and threading.get_ident() != self.request_writer.loop_thread_id:
+            self.request_writer.loop.call_soon_threadsafe(self.writer.close)
+        else:
+            self.writer.close()
 
     async def handle_request(self):
+        try:
+            await self._handle_request()
+        finally:
+            self.is_processing = False
+
+    async def _handle_request(self):
         parse_request_success = await self.parse_request()
         if not parse_request_success:
             return
 
         if self.request_version == "HTTP/1.1" and self.command == "GET" and "Upgrade" in self.headers and self.headers["Upgrade"] == "websocket":
             _logger.debug("This is a websocket connection. ")
-            ws_handler = WebsocketRequestHandler(self)
-            await ws_handler.handle_request()
-            self.writer.write_eof()
+            self.is_processing = False
+            if self.websocket_loop and self.reader.hand_over(self):
+                return
+            await self.handle_websocket()
             return
 
         await self.handle_http_request()
-        while not self.close_connection:
+        while not self.close_connection and not self.shutting_down:
             _logger.debug("Keep-Alive, read next request. ")
             parse_request_success = await self.parse_request()
             if not parse_request_success:
@@ -383,6 +489,11 @@ class HttpProtocolHandler:
                 return
             await self.handle_http_request()
 
+    async def handle_websocket(self):
+        self.ws_handler = WebsocketRequestHandler(self)
+        await self.ws_handler.handle_request()
+        self.writer.write_eof()
+
     async def handle_http_request(self):
         try:
             http_request_handler = HTTPRequestHandler(self)
@@ -393,6 +504,8 @@ class HttpProtocolHandler:
             self.log_error("Request timed out: %r", e)
             self.close_connection = True
             return
+        finally:
+            self.is_processing = False
 
 
 class SocketServerStreamRequestHandlerWraper(socketserver.StreamRequestHandler):
@@ -406,16 +519,88 @@ class SocketServerStreamRequestHandlerWraper(socketserver.StreamRequestHandler):
     async def read(self, n: int = -1):
         return self.rfile.read(n)
 
+    async def readexactly(self, n: int):
+        data = self.rfile.read(n)
+        if len(data) < n:
+            raise asyncio.IncompleteReadError(data, n)
+        return data
+
+    async def readinto(self, buffer) -> int:
+        return self.rfile.readinto(buffer)
+
     def write(self, data: bytes):
         self.wfile.write(data)
 
     def write_eof(self):
         self.wfile.flush()
 
+    def feed_eof(self):
+        """Like `StreamReader.feed_eof`, end the blocking reading, but the socket can still be written."""
+        try:
+            self.request.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
+
+    def close(self):
+        try:
+            # Shutting down the socket will wake up the thread that is blocked in reading it.
+            self.request.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def hand_over(self, handler: HttpProtocolHandler) -> bool:
+        """
+        Hand the websocket connection over to the shared event loop, and this thread will return to the pool. TLS
+        connections cannot be moved from the `SSLSocket` to asyncio, they are still served in this thread.
+        """
+        if isinstance(self.request, ssl.SSLSocket):
+            return False
+        # The bytes that have been read ahead into the buffer, the client may send frames right after the upgrade.
+        self.request.setblocking(False)
+        buffered = self.rfile.peek()
+        # Detach the file descriptor, so the socket will not be closed when this handler finishes.
+        sock = socket.socket(fileno=self.request.detach())
+        self.handed_over = True
+        handler.websocket_loop.submit(self._serve_websocket(handler, sock, buffered))
+        return True
+
+    async def _serve_websocket(self, handler: HttpProtocolHandler, sock: socket.socket, buffered: bytes):
+        loop = asyncio.get_event_loop()
+        reader = StreamReader(limit=_MAXLINE)
+        if buffered:
+            reader.feed_data(buffered)
+        protocol = StreamReaderProtocol(reader)
+        try:
+            transport, _ = await loop.connect_accepted_socket(lambda: protocol, sock=sock)
+        except OSError as e:
+            _logger.debug(f"Cannot hand the websocket connection over: {e}")
+            sock.close()
+            self.server.connections.remove(handler)
+            return
+        writer = StreamWriter(transport, protocol, reader, loop)
+        handler.reader = reader
+        handler.writer = writer
+        handler.request_writer = RequestWriter(writer)
+        try:
+            await handler.handle_websocket()
+        except Exception:
+            _logger.exception("Error occurs when handling the websocket connection.")
+        finally:
+            writer.close()
+            self.server.connections.remove(handler)
+
     def handle(self) -> None:
+        self.handed_over = False
         handler: HttpProtocolHandler = HttpProtocolHandler(
-            self, self, request_writer=self.request, routing_conf=self.server)
-        asyncio.run(handler.handle_request())
+            self, self, request_writer=SocketRequestWriter(self.request), routing_conf=self.server,
+            websocket_loop=getattr(self.server, "websocket_loop", None))
+        self.server.connections.add(handler)
+        try:
+            asyncio.run(handler.handle_request())
+        finally:
+            if not self.handed_over:
+                # Otherwise, the connection is removed when the websocket session ends in the shared loop.
+                self.server.connections.remove(handler)
 
     def finish(self) -> None:
         _logger.debug("Finish a socket connection.")
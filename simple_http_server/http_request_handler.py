@@ -25,17 +25,23 @@ SOFTWARE.
 
 import asyncio
 import os
+import signal
+import sys
+import multiprocessing
 import json
 import inspect
 import threading
+import time
 import http.cookies as cookies
 import datetime
 
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from typing import Any, Callable, Dict, List, Union
 
 from simple_http_server import FilterContex, ModelDict, Environment, RegGroup, RegGroups, HttpError, StaticFile, \
     Headers, Redirect, Response, Cookies, Cookie, JSONBody, Header, Parameters, PathValue, \
-    Parameter, MultipartFile, Request, Session, ControllerFunction, _get_session_factory, \
+    Parameter, MultipartFile, Request, Session, AsyncSessionFactory, ControllerFunction, _get_session_factory, _get_process_pool_size, \
     DEFAULT_ENCODING, SESSION_COOKIE_NAME
 import simple_http_server.__utils as utils
 
@@ -44,6 +50,71 @@ from .__utils import get_function_args, get_function_kwargs
 
 _logger = get_logger("simple_http_server.http_request_handler")
 
+_process_pool: ProcessPoolExecutor = None
+# Every worker of the pool puts its pid here when it starts, so that it can be terminated when shutting down.
+_process_pool_pids: multiprocessing.SimpleQueue = None
+_process_pool_lock = threading.Lock()
+
+
+def _put_worker_pid(pids: multiprocessing.SimpleQueue):
+    pids.put(os.getpid())
+
+
+def _new_process_pool() -> ProcessPoolExecutor:
+    global _process_pool_pids
+    _process_pool_pids = multiprocessing.SimpleQueue()
+    return ProcessPoolExecutor(max_workers=_get_process_pool_size(), initializer=_put_worker_pid,
+                               initargs=(_process_pool_pids,))
+
+
+def _submit_to_process_pool(func: Callable, args: List = [], kwargs: Dict = {}):
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = _new_process_pool()
+        try:
+            return _process_pool.submit(func, *args, **kwargs)
+        except BrokenProcessPool:
+            # A worker process died abruptly, replace the whole pool.
+            _logger.warning("Process pool is broken, create a new one.")
+            _process_pool = _new_process_pool()
+            return _process_pool.submit(func, *args, **kwargs)
+
+
+def _is_process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError:
+        return False
+
+
+def _shutdown_process_pool(timeout: float = 10):
+    global _process_pool, _process_pool_pids
+    with _process_pool_lock:
+        if _process_pool is None:
+            return
+        if sys.version_info >= (3, 9):
+            _process_pool.shutdown(wait=False, cancel_futures=True)
+        else:
+            _process_pool.shutdown(wait=False)
+        pids: List[int] = []
+        while not _process_pool_pids.empty():
+            pids.append(_process_pool_pids.get())
+        _process_pool, _process_pool_pids = None, None
+    if os.name == "nt":
+        # `os.kill` terminates the process on Windows, it cannot be used to check whether the process is alive.
+        return
+    # The forked workers hold a copy of the listening socket, wait for them to exit to release the port, but a running
+    # call cannot be stopped, so the workers that do not exit in time are terminated.
+    deadline = time.time() + timeout
+    for pid in pids:
+        while _is_process_alive(pid) and time.time() < deadline:
+            time.sleep(0.05)
+        if _is_process_alive(pid):
+            _logger.warning(f"Process pool worker[#{pid}] does not exit in {timeout} seconds, terminate it.")
+            os.kill(pid, signal.SIGTERM)
+
 
 class RequestWrapper(Request):
 
@@ -53,6 +124,8 @@ class RequestWrapper(Request):
         self._path = ""
         self.__session = None
         self._socket_req = None
+        # Whether the request is handled in the event loop of a `CoroutineHTTPServer`.
+        self._coroutine_mode: bool = False
         self._coroutine_objects = []
 
     def get_session(self, create: bool = False) -> Session:
@@ -60,9 +133,36 @@ class RequestWrapper(Request):
             sid = self.cookies[SESSION_COOKIE_NAME].value if SESSION_COOKIE_NAME in self.cookies.keys(
             ) else ""
             session_fac = _get_session_factory()
+            if isinstance(session_fac, AsyncSessionFactory):
+                raise HttpError(500, None, "Session factory is async, get the session by `await request.get_session_async()`.")
             self.__session = session_fac.get_session(sid, create)
         return self.__session
 
+    async def get_session_async(self, create: bool = False) -> Session:
+        if not self.__session:
+            sid = self.cookies[SESSION_COOKIE_NAME].value if SESSION_COOKIE_NAME in self.cookies.keys(
+            ) else ""
+            session_fac = _get_session_factory()
+            if isinstance(session_fac, AsyncSessionFactory):
+                self.__session = await session_fac.get_session(sid, create)
+            elif session_fac.blocking and self._coroutine_mode:
+                self.__session = await asyncio.get_event_loop().run_in_executor(None, session_fac.get_session, sid, create)
+            else:
+                self.__session = session_fac.get_session(sid, create)
+        return self.__session
+
+    def _should_get_session_async(self) -> bool:
+        if self.__session:
+            return False
+        session_fac = _get_session_factory()
+        return isinstance(session_fac, AsyncSessionFactory) or (session_fac.blocking and self._coroutine_mode)
+
+    def _get_loaded_session(self) -> Session:
+        """
+        The session that has been got by the filters or the controller, it is not looked up here.
+        """
+        return self.__session
+
     def _put_coroutine_task(self, coroutine_object):
         self._coroutine_objects.append(coroutine_object)
 
@@ -149,18 +249,34 @@ class FilterContexImpl(FilterContex):
         return ctr_res
 
     def _do_res(self, ctr_res):
-        session = self.request.get_session()
-        if session and session.is_valid:
+        # Only the sessions used in this request are refreshed, other requests do not need to look them up.
+        session = self.request._get_loaded_session()
+        session_fac = _get_session_factory()
+        if session and isinstance(session_fac, AsyncSessionFactory):
+            self.request._put_coroutine_task(self._save_session_and_do_res(session_fac, session, ctr_res))
+        else:
+            self._do_session_cookie_and_res(session, ctr_res)
+
+    async def _save_session_and_do_res(self, session_fac: AsyncSessionFactory, session: Session, ctr_res):
+        if session.is_valid:
+            await session_fac.save(session)
+        else:
+            await session_fac.invalidate(session)
+        self._do_session_cookie_and_res(session, ctr_res)
+
+    def _do_session_cookie_and_res(self, session: Session, ctr_res):
+        cookie_value = _get_session_factory().session_cookie_value(session) if session and session.is_valid else None
+        if cookie_value is not None:
             exp = datetime.datetime.utcfromtimestamp(
                 session.last_accessed_time + session.max_inactive_interval)
             sck = Cookies()
-            sck[SESSION_COOKIE_NAME] = session.id
+            sck[SESSION_COOKIE_NAME] = cookie_value
             sck[SESSION_COOKIE_NAME]["httponly"] = True
             sck[SESSION_COOKIE_NAME]["path"] = "/"
             sck[SESSION_COOKIE_NAME]["expires"] = exp.strftime(
                 Cookies.EXPIRE_DATE_FORMAT)
             self.response.cookies.update(sck)
-        elif session and SESSION_COOKIE_NAME in self.request.cookies:
+        elif session and not session.is_valid and SESSION_COOKIE_NAME in self.request.cookies:
             exp = datetime.datetime.utcfromtimestamp(0)
             sck = Cookies()
             sck[SESSION_COOKIE_NAME] = session.id
@@ -206,8 +322,40 @@ class FilterContexImpl(FilterContex):
         ctr_res = await self._run_ctrl_fun()
         self._do_res(ctr_res)
 
+    async def _do_request_in_process(self):
+        args = self.__prepare_args()
+        kwargs = self.__prepare_kwargs() or {}
+        for arg in list(args) + list(kwargs.values()):
+            if isinstance(arg, (Request, Response, Session)):
+                raise HttpError(500, None, f"Argument of type {type(arg)} cannot be sent to the process pool.")
+
+        timeout = self.__controller.process_timeout
+        future = _submit_to_process_pool(self.__controller.func, args, kwargs)
+        try:
+            ctr_res = await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            # A call that is not started yet is dropped, a running one cannot be stopped, the worker will be reused after
+            # it finishes.
+            future.cancel()
+            raise HttpError(504, None, f"Controller does not finish in {timeout} seconds.")
+        self._do_res(ctr_res)
+
+    async def _get_session_and_do_request(self):
+        await self.request.get_session_async(True)
+        self._do_request()
+
+    def __has_session_arg(self) -> bool:
+        func = self.__controller.func
+        return any(arg_type == Session for _, arg_type in get_function_args(func)) \
+            or any((type(v) if v is not None else t) == Session for _, v, t in get_function_kwargs(func))
+
     def _do_request(self):
-        if asyncio.iscoroutinefunction(self.__controller.func):
+        if self.request._should_get_session_async() and self.__has_session_arg():
+            # Get the session before the controller is called, which gets the session synchronously.
+            self.request._put_coroutine_task(self._get_session_and_do_request())
+        elif self.__controller.run_in_process:
+            self.request._put_coroutine_task(self._do_request_in_process())
+        elif asyncio.iscoroutinefunction(self.__controller.func):
             self.request._put_coroutine_task(self._do_request_async())
         else:
             self._do_request_sync()
@@ -539,6 +687,9 @@ class HTTPRequestHandler:
         self.send_error = http_protocol_handler.send_error
         self.writer = http_protocol_handler.writer
         self.environment: Dict[str, Any] = environment
+        # The WSGI handler has no request writer, it runs every request in its own event loop.
+        request_writer = getattr(http_protocol_handler, "request_writer", None)
+        self.coroutine_mode: bool = request_writer is not None and request_writer.is_async
 
     async def handle_request(self):
         mth = self.method.upper()
@@ -559,7 +710,7 @@ class HTTPRequestHandler:
             try:
                 ctx.do_chain()
                 if req._coroutine_objects:
-                    _logger.debug(f"wait all the objects in waiting list.")
+                    _logger.debug("wait all the objects in waiting list.")
                     while req._coroutine_objects:
                         await req._coroutine_objects.pop(0)
             except HttpError as e:
@@ -571,6 +722,7 @@ class HTTPRequestHandler:
     async def __prepare_request(self, method) -> RequestWrapper:
         path = self.request_path
         req = RequestWrapper()
+        req._coroutine_mode = self.coroutine_mode
         req.environment = self.environment or {}
         req.path = "/" + path
         req._path = path
@@ -25,26 +25,30 @@ SOFTWARE.
 
 
 import json
+import logging
 import socket
 import os
 import re
 
 import threading
 import asyncio
+import functools
+import time
 
 from asyncio.base_events import Server
 from asyncio.streams import StreamReader, StreamWriter
-from ssl import PROTOCOL_TLS_SERVER, SSLContext
+from ssl import OP_NO_TICKET, PROTOCOL_TLS_SERVER, SSLContext
 from collections import OrderedDict
 from socketserver import ThreadingMixIn, TCPServer
-from time import sleep
 from urllib.parse import unquote
 
-from typing import Any, Callable, Dict, List, Tuple
+from typing import Any, Callable, Dict, List, Set, Tuple
 
-from simple_http_server import ControllerFunction, StaticFile
-from .http_protocol_handler import HttpProtocolHandler, SocketServerStreamRequestHandlerWraper
+from simple_http_server import ControllerFunction, StaticFile, WebsocketHandlerOptions
+from .http_protocol_handler import HttpProtocolHandler, SocketServerStreamRequestHandlerWraper, WebsocketEventLoop
+from .websocket_request_handler import CLOSE_GOING_AWAY
 from .wsgi_request_handler import WSGIRequestHandler
+from .prefork_server import PreforkMaster
 
 from .__utils import remove_url_first_slash, get_function_args, get_function_kwargs, get_path_reg_pattern
 from .logger import get_logger
@@ -52,6 +56,23 @@ from .logger import get_logger
 _logger = get_logger("simple_http_server.http_server")
 
 
+def _create_server_socket(host: str, port: int, reuse_port: bool = False, listen: bool = True, backlog: int = 100) -> socket.socket:
+    family, type, proto, _, addr = socket.getaddrinfo(host or None, port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE)[0]
+    sock = socket.socket(family, type, proto)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            assert hasattr(socket, "SO_REUSEPORT"), "SO_REUSEPORT is not supported on this platform."
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(addr)
+        if listen:
+            sock.listen(backlog)
+    except:
+        sock.close()
+        raise
+    return sock
+
+
 class RoutingConf:
 
     HTTP_METHODS = ["OPTIONS", "GET", "HEAD",
@@ -75,6 +96,7 @@ class RoutingConf:
 
         self.ws_mapping = OrderedDict()
         self.ws_path_val_mapping = OrderedDict()
+        self.ws_handler_options: Dict[Any, WebsocketHandlerOptions] = {}
 
         self.error_page_mapping = {}
 
@@ -133,7 +155,7 @@ class RoutingConf:
 
     def _res_(self, path, res_pre, res_dir):
         fpath = os.path.join(res_dir, path.replace(res_pre, ""))
-        _logger.debug(f"static file. {path} :: {fpath}")
+        _logger.debug("static file. %s :: %s", path, fpath)
         fext = os.path.splitext(fpath)[1]
         ext = fext.lower()
         if ext in (".html", ".htm", ".xhtml"):
@@ -190,19 +212,22 @@ class RoutingConf:
         return None, {}, ()
 
     def __try_get_from_regexp(self, path, method):
+        # Checked once, the loops below run for every request.
+        debug = _logger.isEnabledFor(logging.DEBUG)
         for regex, ctrl in self.method_regexp_mapping[method].items():
             m = re.match(regex, path)
-            _logger.debug(
-                f"regexp::pattern::[{regex}] => path::[{path}] match? {m is not None}")
+            if debug:
+                _logger.debug(f"regexp::pattern::[{regex}] => path::[{path}] match? {m is not None}")
             if m:
                 return ctrl, tuple([unquote(v) for v in m.groups()])
         return None
 
     def __try_get_from_path_val(self, path, method):
+        debug = _logger.isEnabledFor(logging.DEBUG)
         for patterns, val in self.path_val_url_mapping[method].items():
             m = re.match(patterns, path)
-            _logger.debug(
-                f"url with path value::pattern::[{patterns}] => path::[{path}] match? {m is not None}")
+            if debug:
+                _logger.debug(f"url with path value::pattern::[{patterns}] => path::[{path}] match? {m is not None}")
             if m:
                 fun, path_names = val
                 path_values = {}
@@ -229,16 +254,17 @@ class RoutingConf:
 
     def _get_matched_filters(self, path):
         available_filters = []
+        debug = _logger.isEnabledFor(logging.DEBUG)
         for regexp, val in self.filter_mapping.items():
             m = re.match(regexp, path)
-            _logger.debug(f"filter:: [{regexp}], path:: [{path}] match? {m is not None}")
+            if debug:
+                _logger.debug(f"filter:: [{regexp}], path:: [{path}] match? {m is not None}")
             if m:
                 available_filters.append(val)
         return available_filters
 
-    
-
-    def map_websocket_handler(self, endpoint, handler_class):
+    def map_websocket_handler(self, endpoint, handler_class, options: WebsocketHandlerOptions = None):
+        self.ws_handler_options[handler_class] = options or WebsocketHandlerOptions()
         url = remove_url_first_slash(endpoint)
         path_pattern, path_names = get_path_reg_pattern(url)
         if path_pattern is None:
@@ -247,16 +273,21 @@ class RoutingConf:
             self.ws_path_val_mapping[path_pattern] = (
                 handler_class, path_names)
 
+    def get_websocket_handler_options(self, handler_class) -> WebsocketHandlerOptions:
+        return self.ws_handler_options.get(handler_class) or WebsocketHandlerOptions()
+
     def get_websocket_handler(self, path):
         if path in self.ws_mapping:
             return self.ws_mapping[path], {}
         return self.__try_get_ws_handler_from_path_val(path)
 
     def __try_get_ws_handler_from_path_val(self, path):
+        debug = _logger.isEnabledFor(logging.DEBUG)
         for patterns, val in self.ws_path_val_mapping.items():
             m = re.match(patterns, path)
-            _logger.debug(
-                f"websocket endpoint with path value::pattern::[{patterns}] => path::[{path}] match? {m is not None}")
+            if debug:
+                _logger.debug(
+                    f"websocket endpoint with path value::pattern::[{patterns}] => path::[{path}] match? {m is not None}")
             if m:
                 clz, path_names = val
                 path_values = {}
@@ -352,6 +383,24 @@ class RoutingConf:
             return func()
 
 
+def _config_session_tickets(ssl_ctx: SSLContext, tickets: int) -> None:
+    """
+    Resumed sessions skip the certificate verifying and key exchanging, which are the most expensive parts of
+    a handshake. `tickets` is the number of TLS 1.3 tickets sent after a handshake, 0 disables session tickets.
+    """
+    # `num_tickets` is available since Python 3.8, the default number of tickets of OpenSSL is used before it.
+    has_num_tickets = hasattr(ssl_ctx, "num_tickets")
+    if tickets > 0:
+        ssl_ctx.options &= ~OP_NO_TICKET
+        if has_num_tickets:
+            ssl_ctx.num_tickets = tickets
+    else:
+        # Clients can still resume sessions by the server side session cache of TLS 1.2.
+        ssl_ctx.options |= OP_NO_TICKET
+        if has_num_tickets:
+            ssl_ctx.num_tickets = 0
+
+
 class HTTPServer(TCPServer, RoutingConf):
 
     allow_reuse_address = 1    # Seems to make sense in testing environment
@@ -363,69 +412,271 @@ class HTTPServer(TCPServer, RoutingConf):
         self.server_name = socket.getfqdn(host)
         self.server_port = port
 
-    def __init__(self, addr, res_conf={}):
-        TCPServer.__init__(self, addr, SocketServerStreamRequestHandlerWraper)
+    def __init__(self, addr, res_conf={}, bind_and_activate=True):
+        TCPServer.__init__(self, addr, SocketServerStreamRequestHandlerWraper, bind_and_activate=bind_and_activate)
         RoutingConf.__init__(self, res_conf)
 
+    def use_socket(self, sock: socket.socket):
+        """Replace the listening socket, the new socket should be bound and listening."""
+        self.socket.close()
+        self.socket = sock
+        self.server_address = sock.getsockname()
+
+
+class ConnectionTracker:
+    """Alive connections of a server, which will be drained when the server is shutting down."""
+
+    def __init__(self) -> None:
+        self.__connections: Set[HttpProtocolHandler] = set()
+        self.__lock = threading.Lock()
+
+    @property
+    def connections(self) -> List[HttpProtocolHandler]:
+        with self.__lock:
+            return list(self.__connections)
+
+    def add(self, conn: HttpProtocolHandler) -> None:
+        with self.__lock:
+            self.__connections.add(conn)
+
+    def remove(self, conn: HttpProtocolHandler) -> None:
+        with self.__lock:
+            self.__connections.discard(conn)
+
+    def start_draining(self) -> List[HttpProtocolHandler]:
+        """Close the idle connections, ask websocket clients to close, and return the connections with in-flight requests."""
+        conns = self.connections
+        in_flight = [c for c in conns if c.is_processing]
+        for conn in conns:
+            conn.shutting_down = True
+            if conn.ws_handler and conn.ws_handler.handshake_done:
+                try:
+                    conn.ws_handler.close("Server is shutting down.", CLOSE_GOING_AWAY)
+                except OSError:
+                    conn.close()
+            elif not conn.is_processing:
+                conn.close()
+        return in_flight
+
+    def is_drained(self, in_flight: List[HttpProtocolHandler]) -> bool:
+        if any(c.is_processing for c in in_flight):
+            return False
+        return not any(c.ws_handler for c in self.connections)
+
+    def abort(self, in_flight: List[HttpProtocolHandler]) -> Dict[str, int]:
+        """Close all the left connections and return the shutdown statistics."""
+        aborted = len([c for c in in_flight if c.is_processing])
+        for conn in self.connections:
+            conn.close()
+        return {"drained": len(in_flight) - aborted, "aborted": aborted}
+
+
+def _log_shutdown_stats(stats: Dict[str, int]) -> None:
+    _logger.info(f"Server is shutted down, {stats['drained']} in-flight requests are drained, {stats['aborted']} are aborted.")
+
 
 class ThreadingMixInHTTPServer(ThreadingMixIn, HTTPServer):
 
+    # The connections are tracked and drained in `shutdown`, so do not join the threads when closing.
+    daemon_threads = True
+    block_on_close = False
+
+    def __init__(self, addr, res_conf={}, bind_and_activate=True, shutdown_timeout: float = 10,
+                 ssl: SSLContext = None, ssl_handshake_timeout: float = 10, websocket_event_loop: bool = False):
+        super().__init__(addr, res_conf, bind_and_activate=bind_and_activate)
+        self.shutdown_timeout: float = shutdown_timeout
+        # The TLS handshake is done in the connection thread, so a slow client will not block accepting.
+        self.ssl: SSLContext = ssl
+        self.ssl_handshake_timeout: float = ssl_handshake_timeout
+        self.connections: ConnectionTracker = ConnectionTracker()
+        # Websocket connections are served in one event loop thread instead of a thread each.
+        self.websocket_loop: WebsocketEventLoop = WebsocketEventLoop() if websocket_event_loop else None
+        self.shutdown_finished: threading.Event = threading.Event()
+        self.__serving_thread: threading.Thread = None
+
+    @property
+    def ready(self) -> bool:
+        # The socket is listening since the server is created.
+        return True
+
     def start(self):
+        self.__serving_thread = threading.current_thread()
         self.serve_forever()
 
-    def _shutdown(self) -> None:
-        _logger.debug("shutdown http server in a seperate thread..")
-        super().shutdown()
-
-    def shutdown(self) -> None:
-        threading.Thread(target=self._shutdown, daemon=False).start()
+    def finish_request(self, request: socket.socket, client_address) -> None:
+        if not self.ssl:
+            super().finish_request(request, client_address)
+            return
+        try:
+            request.settimeout(self.ssl_handshake_timeout)
+            tls_request = self.ssl.wrap_socket(request, server_side=True)
+            tls_request.settimeout(None)
+        except OSError as e:
+            _logger.debug(f"TLS handshake with {client_address} fails: {e}")
+            return
+        try:
+            super().finish_request(tls_request, client_address)
+        finally:
+            # The original socket is detached by `wrap_socket`, close the wrapped one here.
+            self.shutdown_request(tls_request)
+
+    def shutdown(self) -> Dict[str, int]:
+        if threading.current_thread() is self.__serving_thread:
+            _logger.debug("shutdown http server in a seperate thread..")
+            threading.Thread(target=self.shutdown, daemon=False).start()
+            return None
+        try:
+            if self.__serving_thread:
+                # Stop accepting new connections first.
+                super().shutdown()
+            self.server_close()
+
+            in_flight = self.connections.start_draining()
+            deadline = time.time() + self.shutdown_timeout
+            while not self.connections.is_drained(in_flight) and time.time() < deadline:
+                time.sleep(0.05)
+            stats = self.connections.abort(in_flight)
+            if self.websocket_loop:
+                self.websocket_loop.stop()
+            _log_shutdown_stats(stats)
+            return stats
+        finally:
+            # A worker process waits for it to exit.
+            self.shutdown_finished.set()
 
 
 class CoroutineHTTPServer(RoutingConf):
 
-    def __init__(self, host: str = '', port: int = 9090, ssl: SSLContext = None, res_conf={}) -> None:
+    def __init__(self, host: str = '', port: int = 9090, ssl: SSLContext = None, res_conf={}, sock: socket.socket = None,
+                 event_loops: int = 1, reuse_port: bool = False, shutdown_timeout: float = 10,
+                 ssl_handshake_timeout: float = 10) -> None:
         RoutingConf.__init__(self, res_conf)
         self.host: str = host
         self.port: int = port
         self.ssl: SSLContext = ssl
+        self.ssl_handshake_timeout: float = ssl_handshake_timeout
+        # If a listening socket is given, host and port will be ignored.
+        self.sock: socket.socket = sock
+        # Every event loop runs in its own thread, which can use more than one core in free-threaded python.
+        self.event_loops: int = event_loops
+        self.reuse_port: bool = reuse_port
+        self.shutdown_timeout: float = shutdown_timeout
         self.server: Server = None
+        self.servers: List[Server] = []
+        self.__servers_lock = threading.Lock()
+        self.__stopped_events: List[threading.Event] = []
+        self.__shutdown_stats: Dict[str, int] = {"drained": 0, "aborted": 0}
+
+    @property
+    def ready(self) -> bool:
+        with self.__servers_lock:
+            return len(self.servers) >= self.event_loops
 
-    async def callback(self, reader: StreamReader, writer: StreamWriter):
+    async def callback(self, reader: StreamReader, writer: StreamWriter, connections: ConnectionTracker = None):
         handler = HttpProtocolHandler(reader, writer, routing_conf=self)
-        await handler.handle_request()
+        if connections:
+            connections.add(handler)
+        try:
+            await handler.handle_request()
+        except asyncio.exceptions.CancelledError:
+            _logger.debug("Request is aborted for the reason that the server is shutted down.")
+        finally:
+            if connections:
+                connections.remove(handler)
         _logger.debug("Connection ends, close the writer.")
         writer.close()
 
-    async def start_server(self):
-        self.server = await asyncio.start_server(
-            self.callback, host=self.host, port=self.port, ssl=self.ssl)
-        async with self.server:
-            try:
-                await self.server.serve_forever()
-            except asyncio.exceptions.CancelledError:
-                _logger.debug(
-                    "Some requests are lost for the reason that the server is shutted down.")
-            finally:
-                await self.server.wait_closed()
+    async def start_server(self, sock: socket.socket = None):
+        sock = sock or self.sock
+        connections = ConnectionTracker()
+        callback = functools.partial(self.callback, connections=connections)
+        if sock:
+            server = await asyncio.start_server(callback, sock=sock, ssl=self.ssl,
+                                                ssl_handshake_timeout=self._handshake_timeout)
+        else:
+            server = await asyncio.start_server(
+                callback, host=self.host, port=self.port, ssl=self.ssl, reuse_port=self.reuse_port,
+                ssl_handshake_timeout=self._handshake_timeout)
+        stopped = threading.Event()
+        with self.__servers_lock:
+            if not self.server:
+                self.server = server
+            self.servers.append(server)
+            self.__stopped_events.append(stopped)
+        try:
+            await server.serve_forever()
+        except asyncio.exceptions.CancelledError:
+            _logger.debug("Server stops accepting new connections.")
+        finally:
+            server.close()
+        try:
+            await self._drain_connections(connections)
+        finally:
+            stopped.set()
+
+    @property
+    def _handshake_timeout(self) -> float:
+        # asyncio does not accept `ssl_handshake_timeout` without ssl.
+        return self.ssl_handshake_timeout if self.ssl else None
+
+    async def _drain_connections(self, connections: ConnectionTracker):
+        in_flight = connections.start_draining()
+        deadline = time.time() + self.shutdown_timeout
+        while not connections.is_drained(in_flight) and time.time() < deadline:
+            await asyncio.sleep(0.05)
+        stats = connections.abort(in_flight)
+        with self.__servers_lock:
+            for k, v in stats.items():
+                self.__shutdown_stats[k] += v
+
+    def _loop_sockets(self) -> List[socket.socket]:
+        if self.reuse_port:
+            # The kernel balances the connections among the sockets.
+            return [_create_server_socket(self.host, self.port, reuse_port=True) for _ in range(self.event_loops)]
+        if not self.sock:
+            self.sock = _create_server_socket(self.host, self.port)
+        # Each loop closes its own socket when shutting down, so give every loop a duplicated one.
+        return [self.sock.dup() for _ in range(self.event_loops)]
 
     def start(self):
-        asyncio.run(self.start_server())
+        if self.event_loops <= 1:
+            asyncio.run(self.start_server())
+            return
+        threads = []
+        for idx, sock in enumerate(self._loop_sockets()):
+            t = threading.Thread(target=asyncio.run, args=(self.start_server(sock),), name=f"EventLoop-{idx}", daemon=True)
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
 
     def _shutdown(self):
         _logger.debug("Try to shutdown server.")
-        self.server.close()
-        loop = self.server.get_loop()
-        loop.call_soon_threadsafe(loop.stop)
-
-    def shutdown(self):
-        wait_time = 3
-        while wait_time:
-            sleep(1)
-            _logger.debug(f"couting to shutdown: {wait_time}")
-            wait_time = wait_time - 1
-            if wait_time == 0:
-                _logger.debug("shutdown server....")
-                self._shutdown()
+        with self.__servers_lock:
+            servers = list(self.servers)
+        for server in servers:
+            try:
+                # Closing the server will cancel the `serve_forever` task.
+                server.get_loop().call_soon_threadsafe(server.close)
+            except RuntimeError:
+                _logger.debug("Event loop is already closed.")
+
+    def shutdown(self) -> Dict[str, int]:
+        self._shutdown()
+        with self.__servers_lock:
+            loops = [server.get_loop() for server in self.servers]
+            stopped_events = list(self.__stopped_events)
+        try:
+            if asyncio.get_running_loop() in loops:
+                # Called in one of the event loops, it cannot wait for itself to be drained.
+                return None
+        except RuntimeError:
+            pass
+        for stopped in stopped_events:
+            stopped.wait()
+        stats = dict(self.__shutdown_stats)
+        _log_shutdown_stats(stats)
+        return stats
 
 
 class SimpleDispatcherHttpServer:
@@ -437,8 +688,8 @@ class SimpleDispatcherHttpServer:
     def map_controller(self, ctrl: ControllerFunction):
         self.server.map_controller(ctrl)
 
-    def map_websocket_handler(self, endpoint, handler_class):
-        self.server.map_websocket_handler(endpoint, handler_class)
+    def map_websocket_handler(self, endpoint, handler_class, options: WebsocketHandlerOptions = None):
+        self.server.map_websocket_handler(endpoint, handler_class, options)
 
     def map_error_page(self, code, func):
         self.server.map_error_page(code, func)
@@ -453,9 +704,20 @@ class SimpleDispatcherHttpServer:
                  keypass: str = "",
                  ssl_context: SSLContext = None,
                  resources: Dict[str, str] = {},
-                 prefer_corountine=False):
+                 prefer_corountine=False,
+                 workers: int = 1,
+                 reuse_port: bool = False,
+                 shutdown_timeout: float = 10,
+                 event_loops: int = 1,
+                 ssl_handshake_timeout: float = 10,
+                 ssl_session_tickets: int = None,
+                 websocket_event_loop: bool = False):
         self.host = host
         self.__ready = False
+        self.workers = workers
+        self.reuse_port = reuse_port
+        self.shutdown_timeout = shutdown_timeout
+        self.__master: PreforkMaster = None
 
         self.ssl = ssl
 
@@ -469,23 +731,31 @@ class SimpleDispatcherHttpServer:
                 ssl_ctx.load_cert_chain(
                     certfile=certfile, keyfile=keyfile, password=keypass)
                 self.ssl_ctx = ssl_ctx
+            if ssl_session_tickets is not None:
+                _config_session_tickets(self.ssl_ctx, ssl_session_tickets)
         else:
             self.ssl_ctx = None
 
         if prefer_corountine:
             _logger.info(f"Start server in corouting mode, listen to port: {self.host[1]}")
             self.server = CoroutineHTTPServer(
-                self.host[0], self.host[1], self.ssl_ctx, resources)
+                self.host[0], self.host[1], self.ssl_ctx, resources, event_loops=event_loops, reuse_port=reuse_port,
+                shutdown_timeout=shutdown_timeout, ssl_handshake_timeout=ssl_handshake_timeout)
+            if workers > 1:
+                # With SO_REUSEPORT, the master only holds the port, every worker listens to its own socket.
+                self.server.sock = _create_server_socket(self.host[0], self.host[1], reuse_port=reuse_port, listen=not reuse_port)
         else:
             _logger.info(f"Start server in threading mixed mode, listen to port {self.host[1]}")
-            self.server = ThreadingMixInHTTPServer(self.host, resources)
-            if self.ssl_ctx:
-                self.server.socket = self.ssl_ctx.wrap_socket(
-                    self.server.socket, server_side=True)
+            self.server = ThreadingMixInHTTPServer(self.host, resources, bind_and_activate=not reuse_port,
+                                                   shutdown_timeout=shutdown_timeout,
+                                                   ssl=self.ssl_ctx, ssl_handshake_timeout=ssl_handshake_timeout,
+                                                   websocket_event_loop=websocket_event_loop)
+            if reuse_port:
+                self.server.use_socket(_create_server_socket(self.host[0], self.host[1], reuse_port=True, listen=workers <= 1))
 
     @ property
     def ready(self):
-        return self.__ready
+        return self.__ready and (self.__master is not None or self.server.ready)
 
     def resources(self, res={}):
         self.server.res_conf = res
@@ -493,14 +763,34 @@ class SimpleDispatcherHttpServer:
     def start(self):
         try:
             self.__ready = True
-            self.server.start()
+            if self.workers > 1:
+                # Give the workers a little more time to exit after draining their connections.
+                self.__master = PreforkMaster(self.workers, self._run_worker, self.server.shutdown, self.shutdown_timeout + 3)
+                self.__master.start()
+            else:
+                self.server.start()
         except:
             self.__ready = False
             raise
 
+    def _run_worker(self):
+        if self.reuse_port:
+            if isinstance(self.server, CoroutineHTTPServer):
+                # The coroutine server will bind its own sockets with SO_REUSEPORT.
+                self.server.sock.close()
+                self.server.sock = None
+            else:
+                self.server.use_socket(_create_server_socket(self.host[0], self.host[1], reuse_port=True))
+        self.server.start()
+        if isinstance(self.server, ThreadingMixInHTTPServer):
+            # `serve_forever` returns before the connections are drained.
+            self.server.shutdown_finished.wait()
+
     def shutdown(self):
-        # shutdown it in a seperate thread.
-        self.server.shutdown()
+        if self.__master:
+            self.__master.shutdown()
+        else:
+            return self.server.shutdown()
 
 
 class WSGIProxy(RoutingConf):
@@ -22,13 +22,17 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import atexit
+import os
 import sys
-import queue
 import logging
-from threading import Thread
+from collections import deque
+from threading import Event, Thread, Lock
+from typing import Dict, List, Tuple
 
 _LOG_LEVEL_ = "INFO"
 __cache_loggers = {}
+__cache_loggers_lock = Lock()
 
 __formatter_ = logging.Formatter(
     fmt='[%(asctime)s]-[%(threadName)s]-[%(name)s:%(lineno)d] %(levelname)-4s: %(message)s',
@@ -41,7 +45,31 @@ _handler.setLevel(_LOG_LEVEL_)
 _handlers = []
 _handlers.append(_handler)
 
-_msg_cache = queue.Queue(10000)
+_QUEUE_SIZE = 10000
+
+_BATCH_SIZE = 1000
+
+_OVERFLOW_POLICIES = ("drop", "sample")
+
+_overflow_policy = "drop"
+
+_sample_every = 10
+
+# Records are appended by the logging threads and popped by the background thread without locks.
+_msg_cache = deque()
+
+_msg_wakeup = Event()
+
+_drain_lock = Lock()
+
+_overflow_lock = Lock()
+
+_stats = {"written": 0, "dropped": 0, "sampled_out": 0}
+
+# The number of records below WARNING that come when the queue is half full.
+_sampling = [0]
+
+_reported_dropped = 0
 
 
 class CachingLogger(logging.Logger):
@@ -50,7 +78,50 @@ class CachingLogger(logging.Logger):
         super().callHandlers(record)
 
     def callHandlers(self, record):
-        _msg_cache.put((self, record))
+        _enqueue(self, record)
+
+
+def _enqueue(logger: logging.Logger, record: logging.LogRecord):
+    size = len(_msg_cache)
+    if size >= _QUEUE_SIZE // 2 and not _keep_when_busy(record, size):
+        return
+    _msg_cache.append((logger, record))
+    if not _msg_wakeup.is_set():
+        _msg_wakeup.set()
+
+
+def _keep_when_busy(record: logging.LogRecord, size: int) -> bool:
+    # The background thread falls behind, never block the logging thread, drop or sample the records instead.
+    with _overflow_lock:
+        if size >= _QUEUE_SIZE:
+            _stats["dropped"] += 1
+            return False
+        if _overflow_policy == "sample" and record.levelno < logging.WARNING:
+            _sampling[0] += 1
+            if _sampling[0] % _sample_every:
+                _stats["sampled_out"] += 1
+                return False
+        return True
+
+
+def set_overflow_policy(policy: str = "drop", queue_size: int = 10000, sample_every: int = 10) -> None:
+    """
+    Records are queued and written in a background thread, at most `queue_size` records are queued.
+
+    With the `drop` policy, the new records are dropped when the queue is full. With the `sample` policy, once the
+    queue is half full, only one in every `sample_every` records below WARNING is kept, and the new records are dropped
+    when it is full. The dropped records are counted in `logging_stats()`, and reported in the log.
+    """
+    global _overflow_policy, _QUEUE_SIZE, _sample_every
+    assert policy in _OVERFLOW_POLICIES, f"Overflow policy should be one of {_OVERFLOW_POLICIES}"
+    assert queue_size > 0 and sample_every > 0
+    _overflow_policy = policy
+    _QUEUE_SIZE = queue_size
+    _sample_every = sample_every
+
+
+def logging_stats() -> Dict[str, int]:
+    return {"queued": len(_msg_cache), **_stats}
 
 
 def set_level(level: str) -> None:
@@ -63,6 +134,8 @@ def set_level(level: str) -> None:
         _LOG_LEVEL_ = lv
         for l in __cache_loggers.values():
             l.setLevel(lv)
+            # The loggers are not managed by the `logging.Manager`, which only clears the level caches of its own.
+            l._cache.clear()
 
 
 def add_handler(handler: logging.Handler) -> None:
@@ -88,20 +161,110 @@ def set_handler(handler: logging.Handler) -> None:
 
 
 def get_logger(tag: str = "pythone-simple-http-server") -> logging.Logger:
-    if tag not in __cache_loggers:
-        __cache_loggers[tag] = CachingLogger(tag, _LOG_LEVEL_)
-        for hdlr in _handlers:
-            __cache_loggers[tag].addHandler(hdlr)
+    if tag in __cache_loggers:
+        return __cache_loggers[tag]
+    with __cache_loggers_lock:
+        if tag not in __cache_loggers:
+            logger = CachingLogger(tag, _LOG_LEVEL_)
+            for hdlr in _handlers:
+                logger.addHandler(hdlr)
+            __cache_loggers[tag] = logger
     return __cache_loggers[tag]
 
 
+def _is_plain_stream_handler(hdlr: logging.Handler) -> bool:
+    # Handlers that override `emit`, like the `FileHandler` and the rotating handlers, handle the records one by one.
+    return type(hdlr).emit is logging.StreamHandler.emit
+
+
+def _write_batch(batch: List[Tuple[logging.Logger, logging.LogRecord]]):
+    texts: Dict[logging.StreamHandler, List[str]] = {}
+    last_records: Dict[logging.StreamHandler, logging.LogRecord] = {}
+    for logger, record in batch:
+        if not logger.handlers:
+            logger._call_handlers(record)
+            continue
+        for hdlr in logger.handlers:
+            if record.levelno < hdlr.level:
+                continue
+            if not _is_plain_stream_handler(hdlr):
+                hdlr.handle(record)
+            elif hdlr.filter(record):
+                try:
+                    texts.setdefault(hdlr, []).append(hdlr.format(record) + hdlr.terminator)
+                    last_records[hdlr] = record
+                except Exception:
+                    hdlr.handleError(record)
+    # All the records of a batch are written to a stream at once, and flushed once.
+    for hdlr, lines in texts.items():
+        hdlr.acquire()
+        try:
+            hdlr.stream.write("".join(lines))
+            hdlr.flush()
+        except Exception:
+            hdlr.handleError(last_records[hdlr])
+        finally:
+            hdlr.release()
+    _stats["written"] += len(batch)
+
+
+def _dropped_record() -> Tuple[logging.Logger, logging.LogRecord]:
+    global _reported_dropped
+    with _overflow_lock:
+        dropped = _stats["dropped"] - _reported_dropped
+        _reported_dropped = _stats["dropped"]
+    if not dropped:
+        return None
+    logger = get_logger("simple_http_server.logger")
+    return logger, logger.makeRecord(logger.name, logging.WARNING, __file__, 0,
+                                     f"{dropped} log records are dropped, the logging thread falls behind.", (), None)
+
+
+def flush() -> None:
+    """
+    Write all the queued records, it is called at exit.
+    """
+    with _drain_lock:
+        while _msg_cache:
+            batch = []
+            while _msg_cache and len(batch) < _BATCH_SIZE:
+                batch.append(_msg_cache.popleft())
+            dropped = _dropped_record()
+            if dropped:
+                batch.append(dropped)
+            _write_batch(batch)
+
+
 def _log_msg_from_queue():
     while True:
-        msg = _msg_cache.get()
-        msg[0]._call_handlers(msg[1])
+        _msg_wakeup.wait()
+        # Clear before draining, so the records appended after it will wake up this thread again.
+        _msg_wakeup.clear()
+        try:
+            flush()
+        except Exception:
+            # Never let the logging thread die.
+            pass
 
 
 def _log_msg_in_backgrond():
     Thread(target=_log_msg_from_queue, name="LoggingThread", daemon=True).start()
 
+
+def _restart_logging_in_child():
+    # Only the forking thread survives in the child process, the queue and its consuming thread should be rebuilt.
+    global _msg_cache, _msg_wakeup, _drain_lock, _overflow_lock, __cache_loggers_lock
+    _msg_cache = deque()
+    _msg_wakeup = Event()
+    _drain_lock = Lock()
+    _overflow_lock = Lock()
+    __cache_loggers_lock = Lock()
+    _log_msg_in_backgrond()
+
+
 _log_msg_in_backgrond()
+
+atexit.register(flush)
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_logging_in_child)
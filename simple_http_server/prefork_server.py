@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2018 Keijack Wu
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import os
+import signal
+import threading
+import time
+
+from typing import Callable, Dict
+
+from .logger import get_logger
+
+_logger = get_logger("simple_http_server.prefork_server")
+
+
+class PreforkMaster:
+    """
+    Fork several worker processes and supervise them.
+
+    The listening socket should be created before `start`, so all the workers can inherit it. Crashed
+    workers are restarted, SIGTERM/SIGINT stop all the workers gracefully and SIGHUP restarts them one
+    time.
+    """
+
+    RESPAWN_INTERVAL = 1
+
+    def __init__(self, workers: int,
+                 worker_target: Callable,
+                 worker_shutdown: Callable,
+                 shutdown_timeout: float = 10) -> None:
+        assert hasattr(os, "fork"), "Multiple worker processes mode is only supported on POSIX systems."
+        assert workers > 0
+        self.workers: int = workers
+        self.worker_target: Callable = worker_target
+        self.worker_shutdown: Callable = worker_shutdown
+        self.shutdown_timeout: float = shutdown_timeout
+        self.__children: Dict[int, float] = {}
+        self.__stopping = False
+        self.__stopped = threading.Event()
+        self.__master_thread: threading.Thread = None
+
+    @property
+    def worker_pids(self):
+        return tuple(self.__children.keys())
+
+    def _spawn_worker(self):
+        pid = os.fork()
+        if pid:
+            self.__children[pid] = time.time()
+            _logger.info(f"Worker process[#{pid}] is started.")
+            return
+        # worker process
+        code = 0
+        try:
+            self._install_worker_signals()
+            self.worker_target()
+        except BaseException:
+            _logger.exception("Worker process exits with error.")
+            code = 1
+        finally:
+            os._exit(code)
+
+    def _install_worker_signals(self):
+        def on_stop(signum, frame):
+            # The server should be shutted down outside the thread that runs it.
+            threading.Thread(target=self.worker_shutdown, daemon=True).start()
+        for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(sig, on_stop)
+
+    def _install_master_signals(self):
+        if threading.current_thread() is not threading.main_thread():
+            _logger.warning("The master is not running in the main thread, signals will not be handled.")
+            return
+
+        def on_stop(signum, frame):
+            _logger.info(f"Receive signal {signum}, stop all workers.")
+            self.__stopping = True
+
+        def on_restart(signum, frame):
+            _logger.info(f"Receive signal {signum}, restart all workers.")
+            self._signal_workers(signal.SIGTERM)
+
+        signal.signal(signal.SIGTERM, on_stop)
+        signal.signal(signal.SIGINT, on_stop)
+        signal.signal(signal.SIGHUP, on_restart)
+
+    def _signal_workers(self, sig):
+        for pid in list(self.__children.keys()):
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def _reap_workers(self):
+        while self.__children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.__children.clear()
+                return
+            if not pid:
+                return
+            if pid not in self.__children:
+                continue
+            started = self.__children.pop(pid)
+            if not self.__stopping:
+                _logger.warning(f"Worker process[#{pid}] exits with status {status}, restart it.")
+                if time.time() - started < self.RESPAWN_INTERVAL:
+                    # Avoid forking in a busy loop when workers crash at starting.
+                    time.sleep(self.RESPAWN_INTERVAL)
+                self._spawn_worker()
+
+    def start(self):
+        self.__master_thread = threading.current_thread()
+        self._install_master_signals()
+        _logger.info(f"Master process[#{os.getpid()}] starts {self.workers} workers.")
+        for _ in range(self.workers):
+            self._spawn_worker()
+        try:
+            while not self.__stopping:
+                self._reap_workers()
+                time.sleep(0.2)
+            self._stop_workers()
+        finally:
+            self.__stopped.set()
+
+    def _stop_workers(self):
+        _logger.info("Stopping all workers...")
+        self._signal_workers(signal.SIGTERM)
+        deadline = time.time() + self.shutdown_timeout
+        while self.__children and time.time() < deadline:
+            self._reap_workers()
+            time.sleep(0.1)
+        if self.__children:
+            _logger.warning(f"Workers {self.worker_pids} do not exit in {self.shutdown_timeout} seconds, kill them.")
+            self._signal_workers(signal.SIGKILL)
+            for pid in list(self.__children.keys()):
+                try:
+                    os.waitpid(pid, 0)
+                except ChildProcessError:
+                    pass
+            self.__children.clear()
+        _logger.info("All workers are stopped.")
+
+    def shutdown(self):
+        self.__stopping = True
+        if self.__master_thread and threading.current_thread() is not self.__master_thread:
+            self.__stopped.wait()
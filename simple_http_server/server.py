@@ -32,8 +32,9 @@ from ssl import PROTOCOL_TLS_SERVER, SSLContext
 from typing import Dict
 
 import simple_http_server.http_server as http_server
+import simple_http_server.http_request_handler as http_request_handler
 
-from simple_http_server import _get_filters, _get_request_mappings, _get_websocket_handlers, _get_error_pages, set_session_factory, _get_session_factory
+from simple_http_server import _get_filters, _get_request_mappings, _get_websocket_handlers, _get_websocket_handler_options, _get_error_pages, set_session_factory, _get_session_factory
 from simple_http_server._http_session_local_impl import LocalSessionFactory
 from simple_http_server import request_map
 from simple_http_server.logger import get_logger
@@ -112,7 +113,14 @@ def start(host: str = "",
           keypass: str = "",
           ssl_context: SSLContext = None,
           resources: Dict[str, str] = {},
-          prefer_coroutine=False) -> None:
+          prefer_coroutine=False,
+          workers: int = 1,
+          reuse_port: bool = False,
+          shutdown_timeout: float = 10,
+          event_loops: int = 1,
+          ssl_handshake_timeout: float = 10,
+          ssl_session_tickets: int = None,
+          websocket_event_loop: bool = False) -> None:
     with __lock:
         global _server
         if _server is not None:
@@ -128,7 +136,14 @@ def start(host: str = "",
                                                          keypass=keypass,
                                                          ssl_context=ssl_context,
                                                          resources=resources,
-                                                         prefer_corountine=prefer_coroutine)
+                                                         prefer_corountine=prefer_coroutine,
+                                                         workers=workers,
+                                                         reuse_port=reuse_port,
+                                                         shutdown_timeout=shutdown_timeout,
+                                                         event_loops=event_loops,
+                                                         ssl_handshake_timeout=ssl_handshake_timeout,
+                                                         ssl_session_tickets=ssl_session_tickets,
+                                                         websocket_event_loop=websocket_event_loop)
 
     filters = _get_filters()
     # filter configuration
@@ -141,9 +156,10 @@ def start(host: str = "",
         _server.map_controller(ctr)
 
     ws_handlers = _get_websocket_handlers()
+    ws_handler_options = _get_websocket_handler_options()
 
     for endpoint, clz in ws_handlers.items():
-        _server.map_websocket_handler(endpoint, clz)
+        _server.map_websocket_handler(endpoint, clz, ws_handler_options.get(endpoint))
 
     err_pages = _get_error_pages()
     for code, func in err_pages.items():
@@ -160,10 +176,13 @@ def is_ready() -> bool:
 def stop() -> None:
     with __lock:
         global _server
+        shutdown_timeout = 10
         if _server is not None:
             __logger.info("shutting down server...")
+            shutdown_timeout = _server.shutdown_timeout
             _server.shutdown()
             _server = None
+        http_request_handler._shutdown_process_pool(shutdown_timeout)
 
 
 @request_map("/favicon.ico")
@@ -283,9 +302,10 @@ def init_wsgi_proxy(resources: Dict[str, str] = {}, session_factory=None) -> htt
         proxy.map_controller(ctr)
 
     ws_handlers = _get_websocket_handlers()
+    ws_handler_options = _get_websocket_handler_options()
 
     for endpoint, clz in ws_handlers.items():
-        proxy.map_websocket_handler(endpoint, clz)
+        proxy.map_websocket_handler(endpoint, clz, ws_handler_options.get(endpoint))
 
     err_pages = _get_error_pages()
     for code, func in err_pages.items():
@@ -24,17 +24,29 @@ SOFTWARE.
 
 
 import asyncio
+import codecs
+import heapq
+import itertools
 import struct
+import threading
+import time
+import zlib
 from base64 import b64encode
 from hashlib import sha1
-from typing import Dict, Tuple
+from collections import deque
+from typing import Callable, Deque, Dict, List, Set, Tuple, Union
 from uuid import uuid4
 from socket import error as SocketError
 import errno
 
 
 from .logger import get_logger
-from simple_http_server import Headers, WebsocketRequest, WebsocketSession
+from simple_http_server import Headers, WebsocketHandlerOptions, WebsocketRequest, WebsocketSession
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 _logger = get_logger("simple_http_server.websocket_request_handler")
 
@@ -56,6 +68,8 @@ _logger = get_logger("simple_http_server.websocket_request_handler")
 '''
 
 FIN = 0x80
+RSV1 = 0x40
+RSV = 0x70
 OPCODE = 0x0f
 MASKED = 0x80
 PAYLOAD_LEN = 0x7f
@@ -69,6 +83,12 @@ OPCODE_CLOSE_CONN = 0x8
 OPCODE_PING = 0x9
 OPCODE_PONG = 0xA
 
+CLOSE_NORMAL = 1000
+CLOSE_GOING_AWAY = 1001
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_MESSAGE_TOO_BIG = 1009
+CLOSE_TRY_AGAIN_LATER = 1013
+
 OPTYPES = {
     OPCODE_TEXT: "TEXT",
     OPCODE_PING: "PING",
@@ -77,10 +97,491 @@ OPTYPES = {
 }
 
 
+# Below this size, the overhead of creating numpy arrays is more than the XOR itself.
+_NUMPY_UNMASK_MIN_SIZE = 1024
+
+
+def _unmask(payload: bytes, masks: bytes) -> bytes:
+    """
+    XOR the payload with the 4-byte mask key as a whole rather than byte by byte.
+    """
+    length = len(payload)
+    if not length:
+        return b""
+    if numpy is not None and length >= _NUMPY_UNMASK_MIN_SIZE:
+        data = bytearray(payload)
+        words = length // 4
+        # The mask key repeats every 4 bytes, so XOR the payload as 32-bit words with the key in the same byte order.
+        words_view = numpy.frombuffer(data, dtype=numpy.uint32, count=words)
+        words_view ^= numpy.frombuffer(masks, dtype=numpy.uint32)[0]
+        for i in range(words * 4, length):
+            data[i] ^= masks[i % 4]
+        return data
+    mask_bytes = (masks * (length // 4 + 1))[:length]
+    return (int.from_bytes(payload, "big") ^ int.from_bytes(mask_bytes, "big")).to_bytes(length, "big")
+
+
+def _is_control_frame(frame: bytes) -> bool:
+    return frame[0] & OPCODE >= OPCODE_CLOSE_CONN
+
+
+def _build_frame(payload: bytes, opcode: int, rsv: int = 0) -> bytes:
+    header = bytearray()
+    payload_length = len(payload)
+    opcode = rsv | opcode
+
+    # Normal payload
+    if payload_length <= 125:
+        header.append(FIN | opcode)
+        header.append(payload_length)
+
+    # Extended payload
+    elif payload_length >= 126 and payload_length <= 65535:
+        header.append(FIN | opcode)
+        header.append(PAYLOAD_LEN_EXT16)
+        header.extend(struct.pack(">H", payload_length))
+
+    # Huge extended payload
+    elif payload_length < 18446744073709551616:
+        header.append(FIN | opcode)
+        header.append(PAYLOAD_LEN_EXT64)
+        header.extend(struct.pack(">Q", payload_length))
+
+    else:
+        raise Exception(
+            "Message is too big. Consider breaking it into chunks.")
+
+    return bytes(header) + payload
+
+
+def _parse_extensions(header: str) -> List[Tuple[str, Dict[str, str]]]:
+    """
+    Parse `Sec-WebSocket-Extensions` to a list of (name, params), a parameter without value will be `None`.
+    """
+    extensions = []
+    for ext in header.split(","):
+        name, *params = [p.strip() for p in ext.split(";")]
+        if not name:
+            continue
+        ext_params = {}
+        for param in params:
+            if not param:
+                continue
+            k, sep, v = param.partition("=")
+            ext_params[k.strip().lower()] = v.strip().strip('"') if sep else None
+        extensions.append((name.lower(), ext_params))
+    return extensions
+
+
+class PerMessageDeflate:
+    """
+    The permessage-deflate extension of RFC 7692.
+    """
+
+    # The empty block that ends every compressed message, which is removed from the frames.
+    TAIL = b"\x00\x00\xff\xff"
+
+    def __init__(self, server_no_context_takeover: bool = False, server_max_window_bits: int = 15,
+                 min_size: int = 0) -> None:
+        self.server_no_context_takeover: bool = server_no_context_takeover
+        self.server_max_window_bits: int = server_max_window_bits
+        self.min_size: int = min_size
+        self.compressor = None
+        # Clients may use any window size, the biggest window can decompress all of them.
+        self.decompressor = zlib.decompressobj(-15)
+
+    @classmethod
+    def negotiate(cls, header: str, options: WebsocketHandlerOptions) -> Tuple["PerMessageDeflate", str]:
+        """
+        Accept the first acceptable permessage-deflate offer, return the extension and the response header value.
+        """
+        for name, params in _parse_extensions(header):
+            if name != "permessage-deflate":
+                continue
+            accepted = cls._accept(params, options)
+            if accepted:
+                return accepted
+        return None, ""
+
+    @classmethod
+    def _accept(cls, params: Dict[str, str], options: WebsocketHandlerOptions) -> Tuple["PerMessageDeflate", str]:
+        # Dropped frames would break the shared compressing context.
+        server_no_context_takeover = options.deflate_no_context_takeover or \
+            options.send_queue_policy == SEND_QUEUE_POLICY_DROP_OLDEST
+        window_bits = options.deflate_max_window_bits
+        response = ["permessage-deflate"]
+        for k, v in params.items():
+            if k == "server_no_context_takeover" and v is None:
+                server_no_context_takeover = True
+            elif k == "client_no_context_takeover" and v is None:
+                # Decompressing does not depend on whether the client takes over the context.
+                response.append("client_no_context_takeover")
+            elif k == "server_max_window_bits" and v and v.isdigit() and 9 <= int(v) <= 15:
+                # zlib cannot compress with a 256-byte window, so offers of 8 are declined.
+                window_bits = min(window_bits, int(v))
+            elif k == "client_max_window_bits" and (v is None or v.isdigit() and 8 <= int(v) <= 15):
+                pass
+            else:
+                _logger.debug(f"Decline permessage-deflate offer with parameter {k}={v}.")
+                return None
+        if server_no_context_takeover:
+            response.append("server_no_context_takeover")
+        if window_bits < 15:
+            response.append(f"server_max_window_bits={window_bits}")
+        return cls(server_no_context_takeover, window_bits, options.deflate_min_size), "; ".join(response)
+
+    def compress(self, data: bytes) -> bytes:
+        if self.compressor is None or self.server_no_context_takeover:
+            self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -self.server_max_window_bits)
+        data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data.endswith(self.TAIL):
+            data = data[:-len(self.TAIL)]
+        return data
+
+    def decompress(self, data: bytes, is_last: bool, max_length: int) -> bytes:
+        """
+        Decompress a frame of a message, return at most `max_length + 1` bytes, so that callers can check whether the
+        message is too big without inflating it all.
+        """
+        if is_last:
+            data = bytes(data) + self.TAIL
+        message = self.decompressor.decompress(data, max_length + 1)
+        if not self.decompressor.unconsumed_tail:
+            return message
+        # Be sure the result exceeds the limit.
+        return message + b"\x00"
+
+
+SEND_QUEUE_POLICY_BLOCK = "block"
+SEND_QUEUE_POLICY_DROP_OLDEST = "drop_oldest"
+SEND_QUEUE_POLICY_DISCONNECT = "disconnect"
+
+
+class WebsocketSendQueue:
+    """
+    The bounded outbound frame queue of a websocket session.
+
+    Frames can be put in any thread. In coroutine mode, they are written by a task in the event loop of the connection,
+    which awaits the transport to drain; in threading mode, they are written by a flusher thread of the session, which
+    is started by the first frame and lives until the queue is closed, so the senders, including the publishers of
+    the channels and the reaper, never wait for a slow socket. When the bytes in the queue exceed `max_size`, the policy decides what to do: `block` waits
+    for the space (it cannot block the event loop, so frames put in the loop thread are always accepted), `drop_oldest`
+    drops the oldest frames, and `disconnect` closes the connection.
+
+    If `coalesce` is set, the frames in the queue are joined into one write, up to `MAX_WRITE_SIZE` bytes. With a
+    `coalesce_delay`, the flusher waits that long for more frames before writing, unless `flush` is called.
+    """
+
+    MAX_WRITE_SIZE = 64 * 1024
+
+    def __init__(self, request_writer, max_size: int = 1024 * 1024, policy: str = SEND_QUEUE_POLICY_BLOCK,
+                 on_overflow: Callable = None, coalesce: bool = False, coalesce_delay: float = 0) -> None:
+        assert policy in (SEND_QUEUE_POLICY_BLOCK, SEND_QUEUE_POLICY_DROP_OLDEST, SEND_QUEUE_POLICY_DISCONNECT)
+        self.request_writer = request_writer
+        self.max_size: int = max_size
+        self.policy: str = policy
+        self.on_overflow: Callable = on_overflow
+        self.coalesce: bool = coalesce
+        self.coalesce_delay: float = coalesce_delay if coalesce else 0
+        self.frames: Deque[bytes] = deque()
+        self.size: int = 0
+        self.closed: bool = False
+        self.__cond = threading.Condition()
+        self.__space_waiters: List[asyncio.Future] = []
+        self.__writing: bool = False
+        self.__flusher: threading.Thread = None
+        self.__wakeup: asyncio.Event = None
+        # Whether a wake-up is scheduled in the event loop, frames put in other threads before it runs share it.
+        self.__wake_scheduled: bool = False
+        self.__flush_requested: bool = False
+        self.__flush_event: asyncio.Event = None
+        self.__flush_task: asyncio.Task = None
+
+        self.sent_frames: int = 0
+        self.sent_bytes: int = 0
+        self.writes: int = 0
+        self.dropped_frames: int = 0
+        self.dropped_bytes: int = 0
+        self.blocked: int = 0
+        self.high_water: int = 0
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queued_frames": len(self.frames),
+            "queued_bytes": self.size,
+            "high_water_bytes": self.high_water,
+            "sent_frames": self.sent_frames,
+            "sent_bytes": self.sent_bytes,
+            "writes": self.writes,
+            "dropped_frames": self.dropped_frames,
+            "dropped_bytes": self.dropped_bytes,
+            "blocked": self.blocked
+        }
+
+    @property
+    def buffered_size(self) -> int:
+        return self.size + self.request_writer.buffer_size
+
+    def _in_loop_thread(self) -> bool:
+        return self.request_writer.is_async and threading.get_ident() == self.request_writer.loop_thread_id
+
+    def start(self):
+        if self.request_writer.is_async:
+            self.__wakeup = asyncio.Event()
+            self.__flush_event = asyncio.Event()
+            self.__flush_task = asyncio.get_event_loop().create_task(self._flush_in_loop())
+
+    def put(self, frame: bytes, force: bool = False, block: bool = True) -> bool:
+        """
+        Put a frame into the queue, return False if it is not accepted. `force` ignores the size limit, and if `block`
+        is False, the frame will be rejected rather than waiting when the queue is full in `block` policy.
+        """
+        overflow = False
+        with self.__cond:
+            if self.closed:
+                return False
+            if not force and self.frames and self.size + len(frame) > self.max_size:
+                if self.policy == SEND_QUEUE_POLICY_DROP_OLDEST:
+                    self._drop_oldest(self.size + len(frame) - self.max_size)
+                elif self.policy == SEND_QUEUE_POLICY_DISCONNECT:
+                    overflow = True
+                elif not block:
+                    return False
+                elif not self._in_loop_thread():
+                    self.blocked += 1
+                    self.__cond.wait_for(lambda: self.closed or not self.frames or self.size + len(frame) <= self.max_size)
+                    if self.closed:
+                        return False
+            if not overflow:
+                self._append(frame)
+        if overflow:
+            if self.on_overflow:
+                self.on_overflow()
+            return False
+        self._wake()
+        return True
+
+    def _drop_oldest(self, size: int):
+        """
+        Drop the oldest data frames until `size` bytes are freed. Control frames are kept, for a dropped close frame
+        breaks the closing handshake and a dropped pong makes the peer think the connection is dead.
+        """
+        kept: List[bytes] = []
+        while self.frames and size > 0:
+            dropped = self.frames.popleft()
+            if _is_control_frame(dropped):
+                kept.append(dropped)
+                continue
+            size -= len(dropped)
+            self.size -= len(dropped)
+            self.dropped_frames += 1
+            self.dropped_bytes += len(dropped)
+        self.frames.extendleft(reversed(kept))
+
+    def block_for_space(self) -> bool:
+        """
+        Wait in `block` policy until the queue is not full without putting anything, return False if it is closed. It
+        never blocks the event loop.
+        """
+        if self.policy != SEND_QUEUE_POLICY_BLOCK or self._in_loop_thread():
+            return not self.closed
+        with self.__cond:
+            if self.frames and self.size >= self.max_size:
+                self.blocked += 1
+                self.__cond.wait_for(lambda: self.closed or not self.frames or self.size < self.max_size)
+            return not self.closed
+
+    async def wait_for_space(self):
+        """
+        Wait until the queue is not full, it is used by the async sending to apply backpressure.
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            with self.__cond:
+                if self.closed or not self.frames or self.size < self.max_size:
+                    return
+                waiter = loop.create_future()
+                self.__space_waiters.append(waiter)
+                self.blocked += 1
+            await waiter
+
+    def _append(self, frame: bytes):
+        self.frames.append(frame)
+        self.size += len(frame)
+        self.high_water = max(self.high_water, self.size)
+
+    def _pop(self) -> Tuple[bytes, int]:
+        """
+        Pop the data of the next write and the number of the frames in it.
+        """
+        with self.__cond:
+            if not self.frames:
+                self.__writing = False
+                return None, 0
+            self.__writing = True
+            frame = self.frames.popleft()
+            size = len(frame)
+            count = 1
+            if self.coalesce and self.frames:
+                batch = [frame]
+                while self.frames and size + len(self.frames[0]) <= self.MAX_WRITE_SIZE:
+                    batch.append(self.frames.popleft())
+                    size += len(batch[-1])
+                frame = b"".join(batch)
+                count = len(batch)
+            self.size -= size
+            self.__flush_requested = False
+            self._notify_space()
+            return frame, count
+
+    def _should_wait_for_more(self) -> bool:
+        return self.coalesce_delay > 0 and not self.__flush_requested and not self.closed \
+            and 0 < self.size < self.MAX_WRITE_SIZE
+
+    def flush(self):
+        """
+        Write the queued frames now without waiting for the coalescing delay. It can be called in any thread.
+        """
+        if not self.coalesce_delay:
+            return
+        with self.__cond:
+            self.__flush_requested = True
+            self.__cond.notify_all()
+        if self.request_writer.is_async and self.__flush_event:
+            if self._in_loop_thread():
+                self.__flush_event.set()
+            else:
+                self.request_writer.loop.call_soon_threadsafe(self.__flush_event.set)
+
+    def _notify_space(self):
+        self.__cond.notify_all()
+        waiters, self.__space_waiters = self.__space_waiters, []
+        for waiter in waiters:
+            waiter.get_loop().call_soon_threadsafe(_set_future_done, waiter)
+
+    def _wake(self):
+        if self.request_writer.is_async:
+            if self._in_loop_thread():
+                self.__wakeup.set()
+                return
+            # The writer is not thread-safe, so frames put in other threads are marshalled to the event loop.
+            with self.__cond:
+                if self.__wake_scheduled:
+                    return
+                self.__wake_scheduled = True
+            try:
+                self.request_writer.loop.call_soon_threadsafe(self._wake_in_loop)
+            except RuntimeError:
+                # The event loop is closed, the connection is gone.
+                self.close()
+            return
+        with self.__cond:
+            if self.__flusher is not None:
+                self.__cond.notify_all()
+                return
+            self.__flusher = threading.Thread(target=self._flush_in_thread, name="websocket-flusher", daemon=True)
+        self.__flusher.start()
+
+    def _wake_in_loop(self):
+        with self.__cond:
+            self.__wake_scheduled = False
+        self.__wakeup.set()
+
+    async def _flush_in_loop(self):
+        try:
+            while True:
+                if self._should_wait_for_more():
+                    self.__flush_event.clear()
+                    try:
+                        await asyncio.wait_for(self.__flush_event.wait(), self.coalesce_delay)
+                    except asyncio.TimeoutError:
+                        pass
+                frame, count = self._pop()
+                if frame is None:
+                    if self.closed:
+                        return
+                    self.__wakeup.clear()
+                    # Check again, the frames may be put before the event is cleared.
+                    if not self.frames:
+                        await self.__wakeup.wait()
+                    continue
+                self.request_writer.send(frame)
+                self.writes += 1
+                self.sent_frames += count
+                self.sent_bytes += len(frame)
+                await self.request_writer.drain()
+        except (OSError, RuntimeError) as e:
+            _logger.debug(f"Websocket connection is broken when sending: {e}")
+            self.close()
+
+    def _flush_in_thread(self):
+        try:
+            while True:
+                with self.__cond:
+                    if not self.frames:
+                        self.__writing = False
+                    self.__cond.wait_for(lambda: self.frames or self.closed)
+                    if self.closed:
+                        return
+                if self._should_wait_for_more():
+                    with self.__cond:
+                        self.__cond.wait_for(lambda: not self._should_wait_for_more(), self.coalesce_delay)
+                frame, count = self._pop()
+                if frame is None:
+                    continue
+                self.request_writer.send(frame)
+                self.writes += 1
+                self.sent_frames += count
+                self.sent_bytes += len(frame)
+        except OSError as e:
+            _logger.debug(f"Websocket connection is broken when sending: {e}")
+            self.close()
+
+    def clear(self):
+        with self.__cond:
+            self.dropped_frames += len(self.frames)
+            self.dropped_bytes += self.size
+            self.frames.clear()
+            self.size = 0
+            self._notify_space()
+
+    async def join(self, timeout: float = 1):
+        """
+        Wait for the frames in the queue to be sent.
+        """
+        deadline = time.time() + timeout
+        while (self.frames or self.__writing) and not self.closed and time.time() < deadline:
+            await asyncio.sleep(0.01)
+
+    def close(self):
+        with self.__cond:
+            self.closed = True
+            self.frames.clear()
+            self.size = 0
+            self.__writing = False
+            self._notify_space()
+        if self.__wakeup and self.request_writer.is_async:
+            if self._in_loop_thread():
+                self.__wakeup.set()
+            else:
+                try:
+                    self.request_writer.loop.call_soon_threadsafe(self.__wakeup.set)
+                except RuntimeError:
+                    pass
+
+
+def _set_future_done(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
 class WebsocketRequestHandler:
 
     GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
 
+    RECV_BUFFER_SIZE = 16 * 1024
+
     def __init__(self, http_protocol_handler) -> None:
         self.base_http_quest_handler = http_protocol_handler
         self.request_writer = http_protocol_handler.request_writer
@@ -94,6 +595,7 @@ class WebsocketRequestHandler:
         handler_class, path_values = self.routing_conf.get_websocket_handler(
             http_protocol_handler.request_path)
         self.handler = handler_class() if handler_class else None
+        self.options: WebsocketHandlerOptions = self.routing_conf.get_websocket_handler_options(handler_class)
         self.ws_request = WebsocketRequest()
         self.ws_request.headers = http_protocol_handler.headers
         self.ws_request.path = http_protocol_handler.request_path
@@ -106,6 +608,25 @@ class WebsocketRequestHandler:
             self.ws_request.cookies.load(self.ws_request.headers["Cookie"])
         self.session = WebsocketSessionImpl(self, self.ws_request)
         self.close_reason = ""
+        # The opcode and received frames of the fragmented message that is not finished.
+        self.fragments_opcode: int = None
+        self.fragments: List[bytes] = []
+        self.fragments_length: int = 0
+        self.fragments_decoder: codecs.IncrementalDecoder = None
+        self.fragments_compressed: bool = False
+        self.deflate: PerMessageDeflate = None
+        # Created when the first frame is read, and reused for the payloads that are not bigger than it.
+        self.recv_buffer: bytearray = None
+        # Frames must be sent in the order of compressing when the compressing context is taken over.
+        self.send_lock = threading.Lock()
+        self.send_queue = WebsocketSendQueue(self.request_writer, self.options.send_queue_size,
+                                             self.options.send_queue_policy, on_overflow=self._on_send_queue_overflow,
+                                             coalesce=self.options.coalesce_writes,
+                                             coalesce_delay=self.options.coalesce_delay)
+        # Watched by the reaper, in `time.monotonic()`.
+        self.last_read_time: float = time.monotonic()
+        self.ping_sent_time: float = None
+        self.reap_reason: str = None
 
     @property
     def response_headers(self):
@@ -147,11 +668,20 @@ class WebsocketRequestHandler:
 
         if op_code == OPCODE_TEXT and hasattr(self.handler, "on_text_message") and callable(self.handler.on_text_message):
             await self.await_func(self.handler.on_text_message(self.session, message))
+        elif op_code == OPCODE_BINARY and hasattr(self.handler, "on_binary_message") and callable(self.handler.on_binary_message):
+            await self.await_func(self.handler.on_binary_message(self.session, message))
         elif op_code == OPCODE_PING and hasattr(self.handler, "on_ping_message") and callable(self.handler.on_ping_message):
             await self.await_func(self.handler.on_ping_message(self.session, message))
         elif op_code == OPCODE_PONG and hasattr(self.handler, "on_pong_message") and callable(self.handler.on_pong_message):
             await self.await_func(self.handler.on_pong_message(self.session, message))
 
+    @property
+    def is_streaming(self) -> bool:
+        return hasattr(self.handler, "on_message_fragment") and callable(self.handler.on_message_fragment)
+
+    async def on_message_fragment(self, op_code, fragment, is_last: bool):
+        await self.await_func(self.handler.on_message_fragment(self.session, OPTYPES[op_code], fragment, is_last))
+
     async def on_open(self):
         if hasattr(self.handler, "on_open") and callable(self.handler.on_open):
             await self.await_func(self.handler.on_open(self.session))
@@ -161,13 +691,23 @@ class WebsocketRequestHandler:
             await self.await_func(self.handler.on_close(self.session, self.close_reason))
 
     async def handle_request(self):
-        while self.keep_alive:
-            if not self.handshake_done:
-                await self.handshake()
-            else:
-                await self.read_next_message()
+        self.send_queue.start()
+        try:
+            while self.keep_alive:
+                if not self.handshake_done:
+                    await self.handshake()
+                else:
+                    await self.read_next_message()
+        finally:
+            websocket_channels.leave_all(self)
+            websocket_reaper.remove(self)
 
+        if self.reap_reason:
+            self.close_reason = self.reap_reason
         await self.on_close()
+        # Send the frames left in the queue, including the close frame.
+        await self.send_queue.join()
+        self.send_queue.close()
 
     async def handshake(self):
         if self.handler:
@@ -181,6 +721,7 @@ class WebsocketRequestHandler:
                 self.send_header("Connection", "Upgrade")
                 self.send_header("Sec-WebSocket-Accept",
                                  self.calculate_response_key())
+                self.negotiate_extensions()
             if headers:
                 for h_name, h_val in headers.items():
                     self.send_header(h_name, h_val)
@@ -193,8 +734,17 @@ class WebsocketRequestHandler:
         self.request_writer.send(ws_res_headers)
         self.handshake_done = True
         if self.keep_alive == True:
+            websocket_reaper.add(self)
             await self.on_open()
 
+    def negotiate_extensions(self):
+        if not self.options.permessage_deflate or "Sec-WebSocket-Extensions" not in self.ws_request.headers:
+            return
+        offers = ", ".join(self.ws_request.headers.get_all("Sec-WebSocket-Extensions"))
+        self.deflate, ext = PerMessageDeflate.negotiate(offers, self.options)
+        if self.deflate:
+            self.send_header("Sec-WebSocket-Extensions", ext)
+
     def calculate_response_key(self):
         _logger.debug(
             f"Sec-WebSocket-Key: {self.ws_request.headers['Sec-WebSocket-Key']}")
@@ -204,23 +754,54 @@ class WebsocketRequestHandler:
         return response_key.decode('ASCII')
 
     async def read_bytes(self, num):
-        return await self.reader.read(num)
+        # `read` may return fewer bytes than requested, which breaks the framing.
+        return await self.reader.readexactly(num)
+
+    async def read_payload(self, num):
+        """
+        Read the payload of a frame. If the reader supports `readinto` (threading mode), small payloads are read into
+        the reusable buffer of the connection, and a memoryview of it is returned. `asyncio.StreamReader` has no
+        `readinto`, in coroutine mode `readexactly` copies the payload out of its buffer once.
+        """
+        if num > self.RECV_BUFFER_SIZE or not hasattr(self.reader, "readinto"):
+            return await self.read_bytes(num)
+        if self.recv_buffer is None or len(self.recv_buffer) < num:
+            self.recv_buffer = bytearray(min(max(num, 1024), self.RECV_BUFFER_SIZE))
+        view = memoryview(self.recv_buffer)[:num]
+        read = await self.reader.readinto(view)
+        if read < num:
+            raise asyncio.IncompleteReadError(bytes(view[:read]), num)
+        return view
 
     async def read_next_message(self):
         _logger.debug("read next message")
         try:
-            b1, b2 = await self.read_bytes(2)
+            await self._read_next_frame()
+        except asyncio.IncompleteReadError:
+            self.keep_alive = False
+            if self.reap_reason:
+                # The reading is ended by the reaper.
+                return
+            _logger.info("Client closed connection.")
+            self.close_reason = "Client closed connection."
+
+    async def _read_next_frame(self):
+        # Frames from clients are always masked, so the header has at least 6 bytes, which are read at one time. It
+        # is the whole header of a frame without the extended payload length.
+        try:
+            header = await self.read_bytes(6)
         except SocketError as e:  # to be replaced with ConnectionResetError for py3
             if e.errno == errno.ECONNRESET:
                 _logger.info("Client closed connection.")
                 self.keep_alive = False
                 self.close_reason = "Client closed connection."
                 return
-            b1, b2 = 0, 0
-        except ValueError as e:
-            b1, b2 = 0, 0
+            header = bytes(6)
+        self.last_read_time = time.monotonic()
+        b1, b2 = header[0], header[1]
 
         fin = b1 & FIN
+        rsv = b1 & RSV
         opcode = b1 & OPCODE
         masked = b2 & MASKED
         payload_length = b2 & PAYLOAD_LEN
@@ -235,42 +816,106 @@ class WebsocketRequestHandler:
             self.keep_alive = False
             self.close_reason = "Client is not masked."
             return
-        if opcode == OPCODE_CONTINUATION:
-            _logger.warn("Continuation frames are not supported.")
-            return
-        elif opcode == OPCODE_BINARY:
-            _logger.warn("Binary frames are not supported.")
-            return
-        elif opcode == OPCODE_TEXT:
-            opcode_handler = self.on_message
-        elif opcode == OPCODE_PING:
-            opcode_handler = self.on_message
-        elif opcode == OPCODE_PONG:
-            opcode_handler = self.on_message
-        else:
+        if opcode not in OPTYPES and opcode != OPCODE_CONTINUATION:
             _logger.warn(f"Unknown opcode {opcode}.")
             self.keep_alive = False
             self.close_reason = f"Unknown opcode {opcode}."
             return
+        if rsv and (rsv != RSV1 or not self.deflate or opcode not in (OPCODE_TEXT, OPCODE_BINARY)):
+            # RSV1 is only used by permessage-deflate in the first frame of a message.
+            self._close_for_error("Reserved bits must be 0.", CLOSE_PROTOCOL_ERROR)
+            return
+        if opcode in (OPCODE_PING, OPCODE_PONG) and (not fin or payload_length > 125):
+            self._close_for_error("Control frames must not be fragmented.", CLOSE_PROTOCOL_ERROR)
+            return
+        if opcode == OPCODE_CONTINUATION and self.fragments_opcode is None:
+            self._close_for_error("Continuation frame without a started message.", CLOSE_PROTOCOL_ERROR)
+            return
+        if opcode in (OPCODE_TEXT, OPCODE_BINARY) and self.fragments_opcode is not None:
+            self._close_for_error("New message before the fragmented message ends.", CLOSE_PROTOCOL_ERROR)
+            return
+
+        ext_size = 2 if payload_length == 126 else 8 if payload_length == 127 else 0
+        ext = header[2:] + await self.read_bytes(ext_size) if ext_size else header[2:]
+        if ext_size == 2:
+            payload_length = struct.unpack_from(">H", ext)[0]
+        elif ext_size == 8:
+            payload_length = struct.unpack_from(">Q", ext)[0]
+        masks = ext[ext_size:]
 
-        if payload_length == 126:
-            hb = await self.reader.read(2)
-            payload_length = struct.unpack(">H", hb)[0]
-        elif payload_length == 127:
-            qb = await self.reader.read(8)
-            payload_length = struct.unpack(">Q", qb)[0]
-
-        masks = await self.read_bytes(4)
-        message_bytes = bytearray()
-        payload = await self.read_bytes(payload_length)
-        for message_byte in payload:
-            message_byte ^= masks[len(message_bytes) % 4]
-            message_bytes.append(message_byte)
-        await opcode_handler(opcode, message_bytes.decode('utf8'))
+        if payload_length > self.options.max_frame_size:
+            self._close_for_error(f"Frame is bigger than {self.options.max_frame_size} bytes.", CLOSE_MESSAGE_TOO_BIG)
+            return
+
+        fragmented = opcode == OPCODE_CONTINUATION or (not fin and opcode in (OPCODE_TEXT, OPCODE_BINARY))
+        streaming = fragmented and self.is_streaming
+        # Streaming messages are not buffered, so only a single frame should not exceed the limit.
+        buffered_length = 0 if streaming else self.fragments_length
+        if buffered_length + payload_length > self.options.max_message_size:
+            self._close_for_error(f"Message is bigger than {self.options.max_message_size} bytes.",
+                                  CLOSE_MESSAGE_TOO_BIG)
+            return
+
+        payload = await self.read_payload(payload_length)
+        message_bytes = _unmask(payload, masks)
+
+        compressed = rsv == RSV1 or (opcode == OPCODE_CONTINUATION and self.fragments_compressed)
+        if compressed:
+            max_length = self.options.max_message_size - buffered_length
+            message_bytes = self.deflate.decompress(message_bytes, bool(fin), max_length)
+            if len(message_bytes) > max_length:
+                self._close_for_error(f"Message is bigger than {self.options.max_message_size} bytes.",
+                                      CLOSE_MESSAGE_TOO_BIG)
+                return
+
+        if not fragmented:
+            await self.on_message(opcode, self._decode_message(opcode, message_bytes))
+            return
+
+        if opcode != OPCODE_CONTINUATION:
+            self.fragments_opcode = opcode
+            self.fragments_compressed = compressed
+            if streaming and opcode == OPCODE_TEXT:
+                # A UTF-8 character may be split into two fragments.
+                self.fragments_decoder = codecs.getincrementaldecoder("utf-8")()
+        message_opcode = self.fragments_opcode
+        if streaming:
+            fragment = self.fragments_decoder.decode(message_bytes, final=bool(fin)) \
+                if message_opcode == OPCODE_TEXT else bytes(message_bytes)
+            await self.on_message_fragment(message_opcode, fragment, bool(fin))
+        else:
+            self.fragments.append(message_bytes)
+            self.fragments_length += len(message_bytes)
+
+        if fin:
+            message_bytes = b"".join(self.fragments)
+            self.fragments_opcode = None
+            self.fragments_decoder = None
+            self.fragments_compressed = False
+            self.fragments = []
+            self.fragments_length = 0
+            if not streaming:
+                await self.on_message(message_opcode, self._decode_message(message_opcode, message_bytes))
+
+    def _decode_message(self, opcode, message_bytes):
+        if opcode == OPCODE_BINARY:
+            return bytes(message_bytes)
+        return message_bytes.decode('utf8')
+
+    def _close_for_error(self, reason: str, code: int):
+        _logger.warning(reason)
+        self.close(reason, code)
+        self.close_reason = reason
 
     def send_message(self, message):
         self.send_text(message)
 
+    def send_binary(self, message: bytes):
+        if not isinstance(message, (bytes, bytearray, memoryview)):
+            _logger.warning(f"Can't send binary message, message has to be bytes. Given type is {type(message)}")
+            return False
+        self._send_message(bytes(message), OPCODE_BINARY)
+
     def send_ping(self, message):
         self.send_text(message, OPCODE_PING)
 
@@ -298,35 +943,58 @@ class WebsocketRequestHandler:
                 'Can\'t send message, message has to be a string or bytes. Given type is %s' % type(message))
             return False
 
-        header = bytearray()
-        payload = self._encode_to_UTF8(message)
-        payload_length = len(payload)
+        self._send_message(self._encode_to_UTF8(message), opcode)
+
+    def _send_message(self, payload: bytes, opcode: int):
+        if not self.deflate or opcode not in (OPCODE_TEXT, OPCODE_BINARY) or len(payload) < self.deflate.min_size:
+            self._send_frame(payload, opcode)
+            return
+        # Waiting for the space with the lock held would block the other senders, including the event loop that
+        # drains the queue, so the space is waited for first and the compressed frame is always accepted.
+        if not self.send_queue.block_for_space():
+            return
+        with self.send_lock:
+            self._send_frame(self.deflate.compress(payload), opcode, RSV1,
+                             force=self.send_queue.policy == SEND_QUEUE_POLICY_BLOCK)
 
-        # Normal payload
-        if payload_length <= 125:
-            header.append(FIN | opcode)
-            header.append(payload_length)
+    async def send_async(self, payload: bytes, opcode: int):
+        await self.send_queue.wait_for_space()
+        self._send_message(payload, opcode)
 
-        # Extended payload
-        elif payload_length >= 126 and payload_length <= 65535:
-            header.append(FIN | opcode)
-            header.append(PAYLOAD_LEN_EXT16)
-            header.extend(struct.pack(">H", payload_length))
+    def _send_frame(self, payload: bytes, opcode: int, rsv: int = 0, force: bool = False):
+        # Control frames are small and should not be dropped or delayed.
+        is_control = opcode >= OPCODE_CLOSE_CONN
+        self.send_queue.put(_build_frame(payload, opcode, rsv), force=force or is_control)
+        if is_control:
+            self.send_queue.flush()
 
-        # Huge extended payload
-        elif payload_length < 18446744073709551616:
-            header.append(FIN | opcode)
-            header.append(PAYLOAD_LEN_EXT64)
-            header.extend(struct.pack(">Q", payload_length))
+    def flush(self):
+        self.send_queue.flush()
 
+    def reap(self, reason: str):
+        """
+        Close the connection that is dead or idle, it can be called in any thread. The reading is ended with EOF, so
+        `on_close` will be called in the thread that handles the connection.
+        """
+        _logger.info(f"Reap websocket session[{self.session.id}]: {reason}")
+        self.reap_reason = reason
+        self.close(reason, CLOSE_GOING_AWAY)
+        if self.request_writer.is_async:
+            try:
+                self.request_writer.loop.call_soon_threadsafe(self.reader.feed_eof)
+            except RuntimeError:
+                pass
         else:
-            raise Exception(
-                "Message is too big. Consider breaking it into chunks.")
+            self.reader.feed_eof()
 
-        self.request_writer.send(header + payload)
+    def _on_send_queue_overflow(self):
+        _logger.warning(f"Send queue of websocket session[{self.session.id}] overflows, close it.")
+        self.send_queue.clear()
+        self.close("Send queue overflows.", CLOSE_TRY_AGAIN_LATER)
 
-    def close(self, reason=""):
-        self.send_text(reason, OPCODE_CLOSE_CONN)
+    def close(self, reason="", code=CLOSE_NORMAL):
+        # The payload of a close frame must start with a 2-byte status code.
+        self._send_frame(struct.pack(">H", code) + self._encode_to_UTF8(reason), OPCODE_CLOSE_CONN)
         self.keep_alive = False
         self.close_reason = "Server asked to close connection."
 
@@ -374,8 +1042,260 @@ class WebsocketSessionImpl(WebsocketSession):
     def send(self, message: str):
         self.__handler.send_message(message)
 
+    def send_binary(self, message: bytes):
+        self.__handler.send_binary(message)
+
+    async def send_async(self, message: Union[str, bytes]):
+        if isinstance(message, str):
+            await self.__handler.send_async(message.encode("utf-8"), OPCODE_TEXT)
+        else:
+            await self.__handler.send_async(bytes(message), OPCODE_BINARY)
+
+    @property
+    def send_queue_stats(self) -> Dict[str, int]:
+        return self.__handler.send_queue.stats
+
+    def flush(self):
+        self.__handler.flush()
+
+    @property
+    def channels(self) -> List[str]:
+        return websocket_channels.channels_of(self.__handler)
+
+    def join(self, channel: str):
+        websocket_channels.join(channel, self.__handler)
+
+    def leave(self, channel: str):
+        websocket_channels.leave(channel, self.__handler)
+
     def send_pone(self, message: str):
         self.__handler.send_pong(message)
 
     def close(self, reason: str):
         self.__handler.close(reason)
+
+
+class WebsocketChannels:
+    """
+    Sessions join named channels, a message published to a channel is encoded to a frame only once, and the frame is
+    written to all the members. Publishing can be called in any thread.
+    """
+
+    def __init__(self) -> None:
+        self.__channels: Dict[str, Set[WebsocketRequestHandler]] = {}
+        self.__lock = threading.Lock()
+        self.published: int = 0
+        self.delivered: int = 0
+        self.skipped: int = 0
+        self.closed: int = 0
+
+    def join(self, channel: str, handler: WebsocketRequestHandler):
+        with self.__lock:
+            self.__channels.setdefault(channel, set()).add(handler)
+
+    def leave(self, channel: str, handler: WebsocketRequestHandler):
+        with self.__lock:
+            members = self.__channels.get(channel)
+            if not members:
+                return
+            members.discard(handler)
+            if not members:
+                del self.__channels[channel]
+
+    def leave_all(self, handler: WebsocketRequestHandler):
+        with self.__lock:
+            for channel in [c for c, members in self.__channels.items() if handler in members]:
+                members = self.__channels[channel]
+                members.discard(handler)
+                if not members:
+                    del self.__channels[channel]
+
+    def channels_of(self, handler: WebsocketRequestHandler) -> List[str]:
+        with self.__lock:
+            return [c for c, members in self.__channels.items() if handler in members]
+
+    def members(self, channel: str) -> List[WebsocketRequestHandler]:
+        with self.__lock:
+            return list(self.__channels.get(channel, ()))
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {"published": self.published, "delivered": self.delivered, "skipped": self.skipped, "closed": self.closed}
+
+    def publish(self, channel: str, message: Union[str, bytes],
+                max_buffer_size: int = 1024 * 1024, close_slow_consumers: bool = False) -> int:
+        """
+        Send the message to all the members of the channel, return the number of the sessions that the message is
+        written to. Sessions whose write buffer exceeds `max_buffer_size` are skipped, or closed if
+        `close_slow_consumers` is set.
+        """
+        members = self.members(channel)
+        with self.__lock:
+            self.published += 1
+        if not members:
+            return 0
+        if isinstance(message, str):
+            frame = _build_frame(message.encode("utf-8"), OPCODE_TEXT)
+        else:
+            frame = _build_frame(bytes(message), OPCODE_BINARY)
+
+        delivered = skipped = closed = 0
+        for handler in members:
+            if not handler.keep_alive:
+                continue
+            if handler.send_queue.buffered_size > max_buffer_size:
+                if close_slow_consumers:
+                    _logger.info(f"Close the slow websocket session[{handler.session.id}] in channel {channel}.")
+                    self.leave_all(handler)
+                    handler.close("Consumer is too slow.", CLOSE_TRY_AGAIN_LATER)
+                    closed += 1
+                else:
+                    skipped += 1
+                continue
+            # Never block the publisher by one session.
+            if handler.send_queue.put(frame, block=False):
+                delivered += 1
+            else:
+                skipped += 1
+        with self.__lock:
+            self.delivered += delivered
+            self.skipped += skipped
+            self.closed += closed
+        return delivered
+
+
+class WebsocketReaper:
+    """
+    Send pings to the sessions that receive nothing for a while, and reap the sessions that do not answer in time or
+    are idle for too long. All sessions are checked in one daemon thread, which lives while there are sessions to watch.
+
+    The sessions are kept in a heap ordered by the time they should be checked next, so a tick only visits the due
+    ones. Reading data does not update the heap, a session that is checked too early is just pushed back with its new
+    deadline.
+    """
+
+    MIN_TICK = 0.05
+
+    def __init__(self) -> None:
+        self.__handlers: Set[WebsocketRequestHandler] = set()
+        self.__deadlines: List[Tuple[float, int, WebsocketRequestHandler]] = []
+        self.__counter = itertools.count()
+        self.__lock = threading.Lock()
+        self.__cond = threading.Condition(self.__lock)
+        self.__running: bool = False
+        self.pings_sent: int = 0
+        self.reaped_pong_timeout: int = 0
+        self.reaped_idle: int = 0
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "sessions": len(self.__handlers),
+            "pings_sent": self.pings_sent,
+            "reaped": self.reaped_pong_timeout + self.reaped_idle,
+            "reaped_pong_timeout": self.reaped_pong_timeout,
+            "reaped_idle": self.reaped_idle
+        }
+
+    def add(self, handler: WebsocketRequestHandler):
+        if not handler.options.ping_interval and not handler.options.idle_timeout:
+            return
+        with self.__lock:
+            self.__handlers.add(handler)
+            self._push(handler, self.next_check_time(handler))
+            self.__cond.notify()
+            if self.__running:
+                return
+            self.__running = True
+        threading.Thread(target=self._run, name="websocket-reaper", daemon=True).start()
+
+    def remove(self, handler: WebsocketRequestHandler):
+        with self.__lock:
+            # The entry in the heap is dropped when it is popped.
+            self.__handlers.discard(handler)
+            self.__cond.notify()
+
+    def _push(self, handler: WebsocketRequestHandler, deadline: float):
+        heapq.heappush(self.__deadlines, (deadline, next(self.__counter), handler))
+
+    def _pop_due(self) -> List[WebsocketRequestHandler]:
+        with self.__lock:
+            while True:
+                if not self.__handlers:
+                    self.__deadlines.clear()
+                    self.__running = False
+                    return None
+                while self.__deadlines and self.__deadlines[0][2] not in self.__handlers:
+                    heapq.heappop(self.__deadlines)
+                now = time.monotonic()
+                if self.__deadlines and self.__deadlines[0][0] <= now:
+                    due = []
+                    while self.__deadlines and self.__deadlines[0][0] <= now:
+                        handler = heapq.heappop(self.__deadlines)[2]
+                        if handler in self.__handlers:
+                            due.append(handler)
+                    return due
+                timeout = self.__deadlines[0][0] - now if self.__deadlines else None
+                self.__cond.wait(timeout if timeout is None else max(timeout, self.MIN_TICK))
+
+    def _run(self):
+        while True:
+            due = self._pop_due()
+            if due is None:
+                return
+            for handler in due:
+                try:
+                    deadline = self.check(handler, time.monotonic())
+                except Exception:
+                    _logger.exception(f"Error occurs when checking websocket session[{handler.session.id}].")
+                    deadline = time.monotonic() + self.MIN_TICK
+                if deadline is not None:
+                    with self.__lock:
+                        if handler in self.__handlers:
+                            self._push(handler, deadline)
+
+    def next_check_time(self, handler: WebsocketRequestHandler) -> float:
+        """
+        The earliest time that `check` may ping or reap the session. Data read later only makes the real one later.
+        """
+        options = handler.options
+        last_read = handler.last_read_time
+        ping_sent = handler.ping_sent_time
+        deadlines = []
+        if ping_sent is not None and last_read < ping_sent:
+            deadlines.append(ping_sent + options.ping_timeout)
+        elif options.ping_interval:
+            deadlines.append(max(last_read, ping_sent or 0) + options.ping_interval)
+        if options.idle_timeout:
+            deadlines.append(last_read + options.idle_timeout)
+        return min(deadlines)
+
+    def check(self, handler: WebsocketRequestHandler, now: float) -> float:
+        """
+        Ping or reap the session if it is due, return the time to check it next, or None if it is not watched anymore.
+        """
+        if not handler.keep_alive:
+            return None
+        options = handler.options
+        last_read = handler.last_read_time
+        ping_sent = handler.ping_sent_time
+        waiting_pong = ping_sent is not None and last_read < ping_sent
+        if waiting_pong and now - ping_sent > options.ping_timeout:
+            self.reaped_pong_timeout += 1
+            self.remove(handler)
+            handler.reap(f"No data is received in {options.ping_timeout} seconds after the ping.")
+            return None
+        elif options.idle_timeout and now - last_read > options.idle_timeout:
+            self.reaped_idle += 1
+            self.remove(handler)
+            handler.reap(f"No data is received in {options.idle_timeout} seconds.")
+            return None
+        elif options.ping_interval and not waiting_pong and now - max(last_read, ping_sent or 0) >= options.ping_interval:
+            handler.ping_sent_time = now
+            self.pings_sent += 1
+            handler.send_ping("")
+        return max(self.next_check_time(handler), now + self.MIN_TICK)
+
+
+websocket_channels = WebsocketChannels()
+websocket_reaper = WebsocketReaper()
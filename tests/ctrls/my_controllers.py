@@ -22,6 +22,8 @@ from simple_http_server import request_map, route
 from simple_http_server import controller
 from simple_http_server import error_message
 import os
+import asyncio
+import threading
 import simple_http_server.logger as logger
 
 
@@ -251,4 +253,24 @@ def my_other_error_page(code, message, explain=""):
 
 @request_map("abcde/**")
 def star(path_val=PathValue()):
-    return f"<html><head><title>path values</title></head><body>{path_val}</body></html>"
\ No newline at end of file
+    return f"<html><head><title>path values</title></head><body>{path_val}</body></html>"
+
+
+def _fib(n: int) -> int:
+    return n if n < 2 else _fib(n - 1) + _fib(n - 2)
+
+
+@request_map("/process/fib", run_in_process=True, process_timeout=10)
+def fib_in_process(n: int = 10):
+    return {"pid": os.getpid(), "result": _fib(n)}
+
+
+@request_map("/slow")
+async def slow(seconds: float = 1):
+    await asyncio.sleep(seconds)
+    return "done"
+
+
+@request_map("/thread")
+async def thread_name():
+    return threading.current_thread().name
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 
 
-from simple_http_server import WebsocketHandler, WebsocketRequest, WebsocketSession, websocket_handler
+from simple_http_server import WebsocketHandler, WebsocketRequest, WebsocketSession, websocket_handler, websocket_broadcast
+import json
+import threading
 import simple_http_server.logger as logger
 
 _logger = logger.get_logger("ws_test")
@@ -21,5 +23,97 @@ class WSHandler(WebsocketHandler):
         _logger.info(f">>{session.id}<< on text message: {message}")
         session.send(f"{session.request.path_values['path_val']}-{message}")
 
+    def on_binary_message(self, session: WebsocketSession, message: bytes):
+        session.send_binary(message[::-1])
+
     def on_close(self, session: WebsocketSession, reason: str):
         _logger.info(f">>{session.id}<< close::{reason}")
+
+
+@websocket_handler(endpoint="/ws_stream", max_message_size=16, max_frame_size=64)
+class WSStreamHandler(WebsocketHandler):
+
+    def on_open(self, session: WebsocketSession):
+        self.fragments = []
+
+    def on_message_fragment(self, session: WebsocketSession, message_type: str, fragment, is_last: bool):
+        self.fragments.append(fragment)
+        if is_last:
+            session.send(f"{message_type}|{len(self.fragments)}|{''.join(self.fragments)}")
+            self.fragments = []
+
+
+@websocket_handler(endpoint="/ws_limited", max_message_size=16)
+class WSLimitedHandler(WebsocketHandler):
+
+    def on_text_message(self, session: WebsocketSession, message: str):
+        session.send(message)
+
+
+@websocket_handler(endpoint="/ws_deflate", permessage_deflate=True, deflate_min_size=10)
+class WSDeflateHandler(WebsocketHandler):
+
+    def on_text_message(self, session: WebsocketSession, message: str):
+        session.send(message)
+
+
+@websocket_handler(endpoint="/ws_channel/{channel}")
+class WSChannelHandler(WebsocketHandler):
+
+    def on_open(self, session: WebsocketSession):
+        session.join(session.request.path_values["channel"])
+
+    def on_text_message(self, session: WebsocketSession, message: str):
+        websocket_broadcast(session.request.path_values["channel"], message)
+
+
+@websocket_handler(endpoint="/ws_async", send_queue_size=4096, send_queue_policy="drop_oldest")
+class WSAsyncHandler(WebsocketHandler):
+
+    async def on_text_message(self, session: WebsocketSession, message: str):
+        if message == "stats":
+            await session.send_async(json.dumps(session.send_queue_stats))
+        else:
+            await session.send_async(message.encode())
+
+
+@websocket_handler(endpoint="/ws_heartbeat", ping_interval=0.2, ping_timeout=0.3)
+class WSHeartbeatHandler(WebsocketHandler):
+
+    def on_text_message(self, session: WebsocketSession, message: str):
+        session.send(message)
+
+
+@websocket_handler(endpoint="/ws_idle", idle_timeout=0.3)
+class WSIdleHandler(WebsocketHandler):
+
+    def on_text_message(self, session: WebsocketSession, message: str):
+        session.send(message)
+
+
+@websocket_handler(endpoint="/ws_ticks", coalesce_writes=True, coalesce_delay=0.05)
+class WSTicksHandler(WebsocketHandler):
+
+    def on_text_message(self, session: WebsocketSession, message: str):
+        for i in range(int(message)):
+            session.send(f"tick-{i}")
+        session.flush()
+        session.send(json.dumps(session.send_queue_stats))
+        session.flush()
+
+
+@websocket_handler(endpoint="/ws_producers")
+class WSProducersHandler(WebsocketHandler):
+
+    def on_text_message(self, session: WebsocketSession, message: str):
+        producers, count = map(int, message.split(","))
+
+        def produce(producer: int):
+            for i in range(count):
+                if i % 2:
+                    session.send(f"{producer}-{i}")
+                else:
+                    session.send_binary(f"{producer}-{i}".encode())
+
+        for producer in range(producers):
+            threading.Thread(target=produce, args=(producer,), daemon=True).start()
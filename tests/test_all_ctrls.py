@@ -5,20 +5,100 @@ from typing import Dict
 from unittest.case import TestCase
 import websocket
 import unittest
+import threading
+import asyncio
+import uuid
 from threading import Thread
 from time import sleep
 import urllib.request
 import urllib.error
 import http.client
+import json
+import shutil
+import socket
+import ssl
+import subprocess
+import tempfile
+import time
+import zlib
 
 from simple_http_server.logger import get_logger, set_level
 import simple_http_server.server as server
+from simple_http_server import SESSION_COOKIE_NAME, AsyncSessionFactory, Session, SessionFactory, \
+    _get_session_factory, set_session_factory, websocket_reaper_stats
 
 set_level("DEBUG")
 
 _logger = get_logger("http_test")
 
 
+class _DictSession(Session):
+
+    def __init__(self, id: str = None, attrs: dict = None):
+        self._id = id or uuid.uuid4().hex
+        self._attrs = dict(attrs or {})
+        self._last_accessed_time = time.time()
+        self._invalidated = False
+        super().__init__()
+
+    @property
+    def id(self) -> str:
+        return self._id
+
+    @property
+    def last_accessed_time(self) -> float:
+        return 0 if self._invalidated else self._last_accessed_time
+
+    def get_attribute(self, name: str):
+        return self._attrs.get(name)
+
+    def set_attribute(self, name: str, value) -> None:
+        self._attrs[name] = value
+
+    def invalidate(self) -> None:
+        self._invalidated = True
+
+
+class _AsyncDictSessionFactory(AsyncSessionFactory):
+
+    def __init__(self):
+        self.sessions = {}
+        self.saves = 0
+
+    async def get_session(self, session_id: str, create: bool = False) -> Session:
+        await asyncio.sleep(0)
+        if session_id in self.sessions:
+            return _DictSession(session_id, self.sessions[session_id])
+        return _DictSession() if create else None
+
+    async def save(self, session: _DictSession) -> None:
+        await asyncio.sleep(0)
+        self.saves += 1
+        self.sessions[session.id] = session._attrs
+
+    async def invalidate(self, session: _DictSession) -> None:
+        self.sessions.pop(session.id, None)
+
+
+class _BlockingDictSessionFactory(SessionFactory):
+
+    def __init__(self):
+        self.sessions = {}
+        self.called_in_event_loop = []
+
+    def get_session(self, session_id: str, create: bool = False) -> Session:
+        try:
+            asyncio.get_running_loop()
+            self.called_in_event_loop.append(True)
+        except RuntimeError:
+            self.called_in_event_loop.append(False)
+        session = self.sessions.get(session_id)
+        if not session and create:
+            session = _DictSession()
+            self.sessions[session.id] = session
+        return session
+
+
 class ThreadingServerTest(unittest.TestCase):
 
     PORT = 9090
@@ -27,6 +107,8 @@ class ThreadingServerTest(unittest.TestCase):
 
     COROUTINE = False
 
+    WEBSOCKET_EVENT_LOOP = False
+
     @classmethod
     def start_server(clz):
         _logger.info("start server in background. ")
@@ -36,7 +118,8 @@ class ThreadingServerTest(unittest.TestCase):
         server.start(
             port=clz.PORT,
             resources={"/public/*": f"{root}/tests/static"},
-            prefer_coroutine=clz.COROUTINE)
+            prefer_coroutine=clz.COROUTINE,
+            websocket_event_loop=clz.WEBSOCKET_EVENT_LOOP)
 
     @classmethod
     def setUpClass(clz):
@@ -82,6 +165,46 @@ class ThreadingServerTest(unittest.TestCase):
         assert "X-Kj-Abc" in res.headers
         assert res.headers["X-Kj-Abc"] == "my-headers"
 
+    def test_session_cookie(self):
+        headers = self.visit("session", return_type="HEADERS")
+        cookie = headers["Set-Cookie"].split(";")[0]
+        assert cookie.startswith(f"{SESSION_COOKIE_NAME}=")
+
+        res = self.visit("session", headers={"Cookie": cookie}, return_type="RESPONSE")
+        assert "Set-Cookie" not in res.headers
+        assert "Hello, Session!" in res.read().decode()
+        res.close()
+
+        headers = self.visit("header_echo", headers={"Cookie": cookie}, return_type="HEADERS")
+        assert "Set-Cookie" not in headers
+
+        headers = self.visit("session?invalid=true", headers={"Cookie": cookie}, return_type="HEADERS")
+        assert "1970" in headers["Set-Cookie"]
+
+    def test_async_session_factory(self):
+        session_factory = _get_session_factory()
+        async_factory = _AsyncDictSessionFactory()
+        set_session_factory(async_factory)
+        try:
+            cookie = self.visit("session", return_type="HEADERS")["Set-Cookie"].split(";")[0]
+            assert async_factory.saves == 1 and len(async_factory.sessions) == 1
+            assert "Hello, Session!" in self.visit("session", headers={"Cookie": cookie})
+            self.visit("session?invalid=true", headers={"Cookie": cookie})
+            assert async_factory.sessions == {}
+        finally:
+            set_session_factory(session_factory)
+
+    def test_blocking_session_factory(self):
+        session_factory = _get_session_factory()
+        blocking_factory = _BlockingDictSessionFactory()
+        set_session_factory(blocking_factory)
+        try:
+            self.visit("session")
+        finally:
+            set_session_factory(session_factory)
+        # The event loop of a coroutine server is not blocked, it is called in an executor.
+        assert blocking_factory.called_in_event_loop == [not self.COROUTINE]
+
     def test_static(self):
         txt = self.visit("public/a.txt")
         assert txt == "hello world!"
@@ -120,6 +243,11 @@ class ThreadingServerTest(unittest.TestCase):
             _logger.info(error_msg)
             assert error_msg == '500-Internal Server Error-some error occurs!'
 
+    def test_run_in_process(self):
+        res = json.loads(self.visit("process/fib?n=20"))
+        assert res["result"] == 6765
+        assert res["pid"] != os.getpid()
+
     def test_ws(self):
         ws = websocket.WebSocket()
         path_val = "test"
@@ -130,7 +258,339 @@ class ThreadingServerTest(unittest.TestCase):
         ws.close()
         assert txt == f"{path_val}-{msg}"
 
+    def test_ws_binary(self):
+        ws = websocket.WebSocket()
+        ws.connect(f"ws://127.0.0.1:{self.PORT}/ws/test")
+        ws.send_binary(b"\x00\x01\xff")
+        opcode, data = ws.recv_data()
+        ws.close()
+        assert opcode == websocket.ABNF.OPCODE_BINARY
+        assert data == b"\xff\x01\x00"
+
+    def test_ws_fragments(self):
+        ws = websocket.WebSocket()
+        ws.connect(f"ws://127.0.0.1:{self.PORT}/ws/test")
+        ws.send_frame(websocket.ABNF.create_frame("hello ", websocket.ABNF.OPCODE_TEXT, fin=0))
+        ws.ping("in the middle")
+        ws.send_frame(websocket.ABNF.create_frame("websocket", websocket.ABNF.OPCODE_CONT, fin=1))
+        txt = ws.recv()
+        ws.close()
+        assert txt == "test-hello websocket"
+
+    def test_ws_streaming_fragments(self):
+        ws = websocket.WebSocket()
+        ws.connect(f"ws://127.0.0.1:{self.PORT}/ws_stream")
+        # Streaming messages are not limited by `max_message_size`, and UTF-8 characters can be split into fragments.
+        data = "中文".encode("utf-8") * 5
+        ws.send_frame(websocket.ABNF.create_frame(data[:4], websocket.ABNF.OPCODE_TEXT, fin=0))
+        ws.send_frame(websocket.ABNF.create_frame(data[4:16], websocket.ABNF.OPCODE_CONT, fin=0))
+        ws.send_frame(websocket.ABNF.create_frame(data[16:], websocket.ABNF.OPCODE_CONT, fin=1))
+        txt = ws.recv()
+        ws.close()
+        assert txt == f"TEXT|3|{'中文' * 5}"
+
+    def test_ws_frame_too_big(self):
+        ws = websocket.WebSocket()
+        ws.connect(f"ws://127.0.0.1:{self.PORT}/ws_stream")
+        # Streaming messages are not limited by `max_message_size`, but every frame is limited by `max_frame_size`.
+        ws.send_frame(websocket.ABNF.create_frame("x" * 65, websocket.ABNF.OPCODE_TEXT, fin=0))
+        opcode, data = ws.recv_data(control_frame=True)
+        ws.close()
+        assert opcode == websocket.ABNF.OPCODE_CLOSE
+        assert data[:2] == (1009).to_bytes(2, "big") and b"Frame is bigger" in data
+
+    def test_ws_trickled_frame(self):
+        ws = websocket.WebSocket()
+        ws.connect(f"ws://127.0.0.1:{self.PORT}/ws/test")
+        msg = "slow " * 60
+        frame = websocket.ABNF.create_frame(msg, websocket.ABNF.OPCODE_TEXT).format()
+        # The header, the extended length, the mask and the payload are all split into several reads.
+        for i in range(0, len(frame), 3):
+            ws.sock.sendall(frame[i:i + 3])
+            if i < 12 or i % 60 == 0:
+                sleep(0.01)
+        txt = ws.recv()
+        ws.close()
+        assert txt == f"test-{msg}"
+
+    def test_ws_send_from_threads(self):
+        producers, count = 16, 200
+        ws = websocket.WebSocket()
+        ws.connect(f"ws://127.0.0.1:{self.PORT}/ws_producers")
+        ws.settimeout(5)
+        ws.send(f"{producers},{count}")
+        received = {p: [] for p in range(producers)}
+        for _ in range(producers * count):
+            opcode, data = ws.recv_data()
+            producer, i = map(int, data.decode().split("-"))
+            assert opcode == (websocket.ABNF.OPCODE_TEXT if i % 2 else websocket.ABNF.OPCODE_BINARY)
+            received[producer].append(i)
+        ws.close()
+        # Frames are not corrupted or lost, and the order of every producer is kept.
+        for messages in received.values():
+            assert messages == list(range(count))
+
+    def test_ws_permessage_deflate(self):
+        ws = websocket.WebSocket()
+        ws.connect(f"ws://127.0.0.1:{self.PORT}/ws_deflate",
+                   header=["Sec-WebSocket-Extensions: permessage-deflate; client_max_window_bits"])
+        assert ws.getheaders()["sec-websocket-extensions"] == "permessage-deflate"
+        # websocket-client does not support compression, so send and read the frames by the raw socket.
+        msg = "compress me! " * 20
+        compressor = zlib.compressobj(wbits=-15)
+        payload = (compressor.compress(msg.encode()) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+        masks = os.urandom(4)
+        masked = bytes(b ^ masks[i % 4] for i, b in enumerate(payload))
+        ws.sock.sendall(bytes([0x80 | 0x40 | 0x1, 0x80 | len(payload)]) + masks + masked)
+        b1, b2 = ws.sock.recv(2)
+        data = b""
+        while len(data) < b2:
+            data += ws.sock.recv(b2 - len(data))
+        ws.close()
+        assert b1 == 0x80 | 0x40 | 0x1
+        assert len(data) < len(msg)
+        assert zlib.decompressobj(wbits=-15).decompress(data + b"\x00\x00\xff\xff").decode() == msg
+
+    def test_ws_broadcast(self):
+        members = []
+        for _ in range(3):
+            ws = websocket.WebSocket()
+            ws.connect(f"ws://127.0.0.1:{self.PORT}/ws_channel/news")
+            members.append(ws)
+        other = websocket.WebSocket()
+        other.connect(f"ws://127.0.0.1:{self.PORT}/ws_channel/sports")
+        other.settimeout(0.5)
+        # Wait for all sessions to join the channel.
+        sleep(0.1)
+        members[0].send("hello everyone")
+        for ws in members:
+            assert ws.recv() == "hello everyone"
+            ws.close()
+        with self.assertRaises(websocket.WebSocketTimeoutException):
+            other.recv()
+        other.close()
+
+    def _recv_raw_frame(self, ws: websocket.WebSocket):
+        b1, b2 = ws.sock.recv(2)
+        data = b""
+        while len(data) < b2:
+            data += ws.sock.recv(b2 - len(data))
+        return b1, data
+
+    def test_ws_heartbeat(self):
+        reaped = websocket_reaper_stats()["reaped_pong_timeout"]
+        ws = websocket.WebSocket()
+        ws.connect(f"ws://127.0.0.1:{self.PORT}/ws_heartbeat")
+        ws.settimeout(3)
+        # Read the raw frames, so the ping is not answered.
+        assert self._recv_raw_frame(ws) == (0x80 | 0x9, b"")
+        b1, data = self._recv_raw_frame(ws)
+        ws.close()
+        assert b1 == 0x80 | 0x8 and data[:2] == (1001).to_bytes(2, "big")
+        assert websocket_reaper_stats()["reaped_pong_timeout"] == reaped + 1
+
+    def test_ws_idle_timeout(self):
+        ws = websocket.WebSocket()
+        ws.connect(f"ws://127.0.0.1:{self.PORT}/ws_idle")
+        ws.settimeout(3)
+        ws.send("hello")
+        assert ws.recv() == "hello"
+        b1, data = self._recv_raw_frame(ws)
+        ws.close()
+        assert b1 == 0x80 | 0x8 and data[:2] == (1001).to_bytes(2, "big")
+
+    def test_ws_coalesced_writes(self):
+        ws = websocket.WebSocket()
+        ws.connect(f"ws://127.0.0.1:{self.PORT}/ws_ticks")
+        ws.settimeout(3)
+        ws.send("100")
+        for i in range(100):
+            assert ws.recv() == f"tick-{i}"
+        stats = json.loads(ws.recv())
+        ws.close()
+        assert stats["writes"] < 100
+
+    def test_ws_send_async(self):
+        ws = websocket.WebSocket()
+        ws.connect(f"ws://127.0.0.1:{self.PORT}/ws_async")
+        ws.send("bytes back")
+        opcode, data = ws.recv_data()
+        assert opcode == websocket.ABNF.OPCODE_BINARY and data == b"bytes back"
+        ws.send("stats")
+        stats = json.loads(ws.recv())
+        ws.close()
+        assert stats["sent_frames"] == 1 and stats["dropped_frames"] == 0
+
+    def test_ws_message_too_big(self):
+        ws = websocket.WebSocket()
+        ws.connect(f"ws://127.0.0.1:{self.PORT}/ws_limited")
+        ws.send_frame(websocket.ABNF.create_frame("0123456789", websocket.ABNF.OPCODE_TEXT, fin=0))
+        ws.send_frame(websocket.ABNF.create_frame("0123456789", websocket.ABNF.OPCODE_CONT, fin=1))
+        opcode, data = ws.recv_data(control_frame=True)
+        ws.close()
+        assert opcode == websocket.ABNF.OPCODE_CLOSE
+        assert data[:2] == (1009).to_bytes(2, "big")
+
 
 class CoroutineServerTest(ThreadingServerTest):
 
     COROUTINE = True
+
+
+class WebsocketEventLoopServerTest(ThreadingServerTest):
+
+    WEBSOCKET_EVENT_LOOP = True
+
+    def test_ws_sessions_do_not_hold_threads(self):
+        threads = threading.active_count()
+        sessions = []
+        for i in range(20):
+            ws = websocket.WebSocket()
+            ws.connect(f"ws://127.0.0.1:{self.PORT}/ws/test")
+            # A message is sent right after the upgrade, it may be read ahead by the connection thread.
+            ws.send(f"msg-{i}")
+            sessions.append(ws)
+        for i, ws in enumerate(sessions):
+            assert ws.recv() == f"test-msg-{i}"
+        sleep(0.2)
+        # The connection threads return after handing the sessions over, only the event loop thread is added.
+        assert threading.active_count() <= threads + 2
+        for ws in sessions:
+            ws.close()
+
+
+class GracefulShutdownTest(unittest.TestCase):
+
+    PORT = 9091
+
+    COROUTINE = False
+
+    def test_drain_in_flight_requests(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        server.scan(project_dir=root, base_dir="tests/ctrls", regx=r'.*controllers.*')
+        Thread(target=server.start, kwargs={"port": self.PORT, "prefer_coroutine": self.COROUTINE, "shutdown_timeout": 5},
+               daemon=True).start()
+        while not server.is_ready():
+            sleep(0.1)
+
+        results = []
+
+        def visit_slow():
+            with urllib.request.urlopen(f"http://127.0.0.1:{self.PORT}/slow?seconds=1") as res:
+                results.append(res.read().decode("utf-8"))
+        client = Thread(target=visit_slow)
+        client.start()
+        sleep(0.3)
+
+        begin = time.time()
+        server.stop()
+        client.join()
+        assert results == ["done"]
+        assert time.time() - begin < 5
+        # New connections are refused after shutting down.
+        with self.assertRaises(urllib.error.URLError):
+            urllib.request.urlopen(f"http://127.0.0.1:{self.PORT}/slow?seconds=0")
+
+
+class CoroutineGracefulShutdownTest(GracefulShutdownTest):
+
+    COROUTINE = True
+
+
+class MultipleEventLoopsTest(unittest.TestCase):
+
+    PORT = 9094
+
+    def test_reuse_port(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        server.scan(project_dir=root, base_dir="tests/ctrls", regx=r'.*controllers.*')
+        Thread(target=server.start, kwargs={"port": self.PORT, "prefer_coroutine": True, "event_loops": 2,
+                                            "reuse_port": True, "shutdown_timeout": 2},
+               daemon=True).start()
+        while not server.is_ready():
+            sleep(0.1)
+
+        names = []
+
+        def visit_thread():
+            for _ in range(10):
+                with urllib.request.urlopen(f"http://127.0.0.1:{self.PORT}/thread", timeout=5) as res:
+                    names.append(res.read().decode("utf-8"))
+        clients = [Thread(target=visit_thread) for _ in range(4)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        assert len(names) == 40
+        # Every loop listens to its own socket, the kernel balances the connections among them.
+        assert set(names) == {"EventLoop-0", "EventLoop-1"}
+
+        begin = time.time()
+        server.stop()
+        assert time.time() - begin < 2
+        with self.assertRaises(urllib.error.URLError):
+            urllib.request.urlopen(f"http://127.0.0.1:{self.PORT}/thread")
+
+
+class ProcessPoolShutdownTest(unittest.TestCase):
+
+    def test_do_not_wait_for_running_calls(self):
+        from simple_http_server import http_request_handler
+        pid = http_request_handler._submit_to_process_pool(os.getpid).result()
+        future = http_request_handler._submit_to_process_pool(time.sleep, [30])
+        while not future.running():
+            sleep(0.1)
+        # Wait for the call to be picked up by a worker.
+        sleep(0.5)
+        begin = time.time()
+        http_request_handler._shutdown_process_pool(1)
+        assert time.time() - begin < 5
+        assert http_request_handler._process_pool is None
+        # The worker that runs the call is terminated.
+        deadline = time.time() + 5
+        while http_request_handler._is_process_alive(pid) and time.time() < deadline:
+            sleep(0.1)
+        assert not http_request_handler._is_process_alive(pid)
+
+
+@unittest.skipIf(shutil.which("openssl") is None, "openssl is not found.")
+class TLSHandshakeTest(unittest.TestCase):
+
+    PORT = 9092
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        keyfile = os.path.join(self.tmp_dir.name, "key.pem")
+        certfile = os.path.join(self.tmp_dir.name, "cert.pem")
+        subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=127.0.0.1",
+                        "-keyout", keyfile, "-out", certfile], check=True, capture_output=True)
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        server.scan(project_dir=root, base_dir="tests/ctrls", regx=r'.*controllers.*')
+        Thread(target=server.start, kwargs={"port": self.PORT, "ssl": True, "keyfile": keyfile, "certfile": certfile,
+                                            "ssl_handshake_timeout": 1, "ssl_session_tickets": 2},
+               daemon=True).start()
+        while not server.is_ready():
+            sleep(0.1)
+
+    def tearDown(self):
+        server.stop()
+        self.tmp_dir.cleanup()
+
+    def visit(self) -> dict:
+        ctx = ssl.create_default_context()
+        ctx.check_hostname = False
+        ctx.verify_mode = ssl.CERT_NONE
+        with urllib.request.urlopen(f"https://127.0.0.1:{self.PORT}/index", context=ctx, timeout=5) as res:
+            return json.loads(res.read().decode("utf-8"))
+
+    def test_handshake(self):
+        assert self.visit()["message"] == "success"
+
+    def test_handshake_timeout(self):
+        # A client that never sends its hello does not block the others, and is closed after the timeout.
+        with socket.create_connection(("127.0.0.1", self.PORT)) as idle:
+            idle.settimeout(5)
+            begin = time.time()
+            assert self.visit()["message"] == "success"
+            assert idle.recv(1) == b""
+            assert time.time() - begin < 4
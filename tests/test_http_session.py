@@ -0,0 +1,422 @@
+# coding: utf-8
+
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from simple_http_server._http_session_cookie_impl import CookieSessionFactory
+from simple_http_server._http_session_local_impl import (LocalSessionFactory, LocalSessionHolder, LocalSessionImpl,
+                                                         ShardedLocalSessionHolder)
+from simple_http_server._http_session_shm_impl import ShmSessionFactory
+from simple_http_server._http_session_sqlite_impl import SqliteSessionFactory
+
+
+class LocalSessionHolderTest(unittest.TestCase):
+
+    def _create_sessions(self, holder: LocalSessionHolder, count: int, creation_time: float, interval: int = 60):
+        sessions = []
+        for i in range(count):
+            session = LocalSessionImpl(f"{creation_time}-{i}", creation_time, holder)
+            session.max_inactive_interval = interval
+            holder.cache_session(session)
+            sessions.append(session)
+        return sessions
+
+    def test_clear_expired_sessions_only(self):
+        holder = LocalSessionHolder()
+        now = time.time()
+        self._create_sessions(holder, 10, now - 120)
+        alive = self._create_sessions(holder, 1000, now)
+        assert holder._clear_time_out_session(now) == 10
+        assert len(holder) == 1000
+        assert holder.get_session(alive[0].id) is alive[0]
+
+    def test_accessed_session_is_rescheduled(self):
+        holder = LocalSessionHolder()
+        now = time.time()
+        session, = self._create_sessions(holder, 1, now - 120)
+        session._set_last_accessed_time(now)
+        assert holder._clear_time_out_session(now) == 0
+        assert holder.get_session(session.id) is session
+        assert holder._clear_time_out_session(now + 61) == 1
+        assert len(holder) == 0
+
+    def test_shortened_interval(self):
+        holder = LocalSessionHolder()
+        now = time.time()
+        session, = self._create_sessions(holder, 1, now, interval=3600)
+        session.max_inactive_interval = 10
+        assert holder._clear_time_out_session(now + 11) == 1
+
+    def test_invalidated_session(self):
+        holder = LocalSessionHolder()
+        now = time.time()
+        session, = self._create_sessions(holder, 1, now)
+        session.invalidate()
+        assert len(holder) == 0
+        assert holder._clear_time_out_session(now + 61) == 0
+
+
+class LocalSessionFactoryTest(unittest.TestCase):
+
+    def test_sessions_in_shards(self):
+        factory = LocalSessionFactory(shards=4)
+        sessions = [factory.get_session(None, create=True) for _ in range(100)]
+        holder: ShardedLocalSessionHolder = factory._LocalSessionFactory__session_holder
+        assert len(holder) == 100
+        assert all(len(shard) for shard in holder.shards)
+        # The shards are cleaned by the thread of the sharded holder.
+        assert all(shard._LocalSessionHolder__clearing_thread is None for shard in holder.shards)
+        for session in sessions:
+            assert factory.get_session(session.id) is session
+        sessions[0].invalidate()
+        assert factory.get_session(sessions[0].id) is None
+        assert len(holder) == 99
+
+    def test_create_in_threads(self):
+        factory = LocalSessionFactory()
+        ids = []
+
+        def create():
+            for _ in range(500):
+                ids.append(factory.get_session(None, create=True).id)
+
+        threads = [threading.Thread(target=create) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(set(ids)) == 4000
+        assert all(factory.get_session(sid) for sid in ids)
+
+    def test_evict_least_recently_accessed(self):
+        factory = LocalSessionFactory(shards=1, max_sessions=3)
+        first, second, third = [factory.get_session(None, create=True) for _ in range(3)]
+        assert factory.get_session(first.id) is first
+        fourth = factory.get_session(None, create=True)
+        assert factory.get_session(second.id) is None and not second.is_valid
+        for session in (first, third, fourth):
+            assert factory.get_session(session.id) is session
+        assert factory.stats["sessions"] == 3 and factory.stats["evicted_by_count"] == 1
+
+    def test_limit_of_all_shards(self):
+        factory = LocalSessionFactory(shards=8, max_sessions=10)
+        holder: ShardedLocalSessionHolder = factory._LocalSessionFactory__session_holder
+        assert sum(shard.max_sessions for shard in holder.shards) == 10
+        for _ in range(100):
+            factory.get_session(None, create=True)
+        assert len(holder) <= 10
+        # There are not more shards than the limit, or some of them would be unlimited.
+        holder = ShardedLocalSessionHolder(shards=16, max_sessions=5)
+        assert len(holder.shards) == 5 and all(shard.max_sessions == 1 for shard in holder.shards)
+
+    def test_evict_by_bytes(self):
+        factory = LocalSessionFactory(shards=1, max_bytes=10000)
+        old = factory.get_session(None, create=True)
+        old.set_attribute("data", "x" * 6000)
+        new = factory.get_session(None, create=True)
+        new.set_attribute("data", "x" * 1000)
+        assert factory.stats["evicted_by_bytes"] == 0
+        new.set_attribute("data", "x" * 6000)
+        assert factory.get_session(old.id) is None
+        assert factory.get_session(new.id) is new
+        assert factory.stats["evicted_by_bytes"] == 1
+        assert factory.stats["bytes"] == new.attributes_size
+
+
+class SqliteSessionFactoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "sessions.db")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_write_behind_and_reload(self):
+        factory = SqliteSessionFactory(self.path, flush_interval=60)
+        session = factory.get_session(None, create=True)
+        session.set_attribute("user", {"name": "keijack"})
+        other = SqliteSessionFactory(self.path, flush_interval=60)
+        # Not written yet.
+        assert other.get_session(session.id) is None
+        factory.flush()
+        loaded = other.get_session(session.id)
+        assert loaded.get_attribute("user") == {"name": "keijack"}
+        assert not loaded.is_new
+        other.close()
+        factory.close()
+        # The sessions survive restarting.
+        restarted = SqliteSessionFactory(self.path)
+        assert restarted.get_session(session.id).get_attribute("user") == {"name": "keijack"}
+        restarted.close()
+
+    def test_invalidate_and_expire(self):
+        factory = SqliteSessionFactory(self.path, flush_interval=60)
+        invalidated = factory.get_session(None, create=True)
+        expiring = factory.get_session(None, create=True)
+        expiring.max_inactive_interval = 10
+        kept = factory.get_session(None, create=True)
+        factory.flush()
+        invalidated.invalidate()
+        assert factory.get_session(invalidated.id) is None
+        factory.flush()
+        assert factory._delete_expired(time.time() + 11) == 1
+        conn = sqlite3.connect(self.path)
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert [r[0] for r in conn.execute("SELECT id FROM sessions")] == [kept.id]
+        conn.close()
+        factory.close()
+
+    def test_loaded_session_is_only_touched(self):
+        factory = SqliteSessionFactory(self.path, flush_interval=60)
+        session = factory.get_session(None, create=True)
+        session.set_attribute("user", "keijack")
+        factory.flush()
+        other = SqliteSessionFactory(self.path, flush_interval=60)
+        loaded = other.get_session(session.id)
+        assert loaded.get_attribute("user") == "keijack"
+        assert session.id not in other._SqliteSessionFactory__dirty
+        assert session.id in other._SqliteSessionFactory__touched
+        other.close()
+        factory.close()
+
+    def test_keep_changes_when_writing_fails(self):
+        factory = SqliteSessionFactory(self.path, flush_interval=60, cleaning_interval=0)
+        written = factory.get_session(None, create=True)
+        touched = factory.get_session(None, create=True)
+        invalidated = factory.get_session(None, create=True)
+        factory.flush()
+        time.sleep(0.01)
+        written.set_attribute("user", "keijack")
+        factory.get_session(touched.id)
+        invalidated.invalidate()
+        with mock.patch.object(factory, "_delete_expired", side_effect=sqlite3.OperationalError("database is locked")):
+            with self.assertRaises(sqlite3.OperationalError):
+                factory.flush()
+        recreated = factory.get_session(None, create=True)
+        factory.flush()
+        other = SqliteSessionFactory(self.path, flush_interval=60)
+        assert other.get_session(written.id).get_attribute("user") == "keijack"
+        assert other.get_session(recreated.id) is not None
+        assert other.get_session(invalidated.id) is None
+        other.close()
+        conn = sqlite3.connect(self.path)
+        assert conn.execute("SELECT last_accessed_time FROM sessions WHERE id = ?",
+                            (touched.id,)).fetchone()[0] == touched.last_accessed_time
+        conn.close()
+        factory.close()
+
+    def test_cookie_is_not_sent_again(self):
+        factory = SqliteSessionFactory(self.path, flush_interval=60, cache_ttl=0)
+        session = factory.get_session(None, create=True)
+        assert factory.session_cookie_value(session) == session.id
+        factory.flush()
+        loaded = factory.get_session(session.id)
+        assert loaded is not session
+        assert factory.session_cookie_value(loaded) is None
+        factory.close()
+
+    def test_add_cookie_expires_column(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute("CREATE TABLE sessions (id TEXT PRIMARY KEY, creation_time REAL NOT NULL, "
+                     "last_accessed_time REAL NOT NULL, max_inactive_interval INTEGER NOT NULL, "
+                     "expiry_time REAL NOT NULL, attributes BLOB NOT NULL)")
+        conn.commit()
+        conn.close()
+        factory = SqliteSessionFactory(self.path, flush_interval=60)
+        session = factory.get_session(None, create=True)
+        factory.session_cookie_value(session)
+        factory.flush()
+        other = SqliteSessionFactory(self.path, flush_interval=60)
+        assert other.get_session(session.id)._cookie_expires == session._cookie_expires > 0
+        other.close()
+        factory.close()
+
+    def test_recreate_after_invalidate(self):
+        factory = SqliteSessionFactory(self.path, flush_interval=60)
+        session = factory.get_session(None, create=True)
+        factory.flush()
+        session.invalidate()
+        recreated = factory.get_session(session.id, create=True)
+        recreated.set_attribute("user", "keijack")
+        factory.flush()
+        assert factory.get_session(session.id) is recreated
+        conn = sqlite3.connect(self.path)
+        assert [r[0] for r in conn.execute("SELECT id FROM sessions")] == [session.id]
+        conn.close()
+        factory.close()
+
+    def test_access_time_is_written(self):
+        factory = SqliteSessionFactory(self.path, flush_interval=60, cache_ttl=0)
+        session = factory.get_session(None, create=True)
+        factory.flush()
+        created = session.last_accessed_time
+        time.sleep(0.01)
+        factory.get_session(session.id)
+        factory.flush()
+        conn = sqlite3.connect(self.path)
+        assert conn.execute("SELECT last_accessed_time FROM sessions").fetchone()[0] > created
+        conn.close()
+        factory.close()
+
+
+def _set_in_another_process(path: str, session_id: str):
+    factory = ShmSessionFactory(path, capacity=64)
+    session = factory.get_session(session_id)
+    session.set_attribute("child", session.get_attribute("parent") + 1)
+    factory.close()
+
+
+class ShmSessionFactoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "sessions.shm")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_cookie_is_not_sent_again(self):
+        factory = ShmSessionFactory(self.path, capacity=64)
+        session = factory.get_session("", create=True)
+        assert factory.session_cookie_value(session) == session.id
+        session.set_attribute("user", "keijack")
+        # Every request gets a new session object, which reads the expiry time of the cookie from the table.
+        other = ShmSessionFactory(self.path, capacity=64)
+        loaded = other.get_session(session.id)
+        assert loaded is not session and loaded.get_attribute("user") == "keijack"
+        assert other.session_cookie_value(loaded) is None
+        loaded.max_inactive_interval = 3600
+        assert other.session_cookie_value(loaded) == session.id
+        assert factory.session_cookie_value(factory.get_session(session.id)) is None
+        other.close()
+        factory.close()
+
+    def test_share_between_processes(self):
+        factory = ShmSessionFactory(self.path, capacity=64)
+        session = factory.get_session("", create=True)
+        session.set_attribute("parent", 1)
+        process = multiprocessing.get_context("spawn").Process(
+            target=_set_in_another_process, args=(self.path, session.id))
+        process.start()
+        process.join(30)
+        assert process.exitcode == 0
+
+        loaded = factory.get_session(session.id)
+        assert not loaded.is_new
+        assert loaded.get_attribute("parent") == 1 and loaded.get_attribute("child") == 2
+        # Attributes set in other processes are kept.
+        session.set_attribute("another", 3)
+        assert session.get_attribute("child") == 2
+        factory.close()
+
+        with self.assertRaises(ValueError):
+            ShmSessionFactory(self.path, capacity=128)
+
+    def test_expire_and_invalidate(self):
+        factory = ShmSessionFactory(self.path, capacity=64)
+        session = factory.get_session("", create=True)
+        session.max_inactive_interval = 1
+        assert factory.get_session(session.id).max_inactive_interval == 1
+        time.sleep(1.1)
+        assert factory.get_session(session.id) is None
+
+        session = factory.get_session("", create=True)
+        session.invalidate()
+        assert factory.get_session(session.id) is None
+        assert len(factory) == 0
+        factory.close()
+
+    def test_invalidated_in_another_factory(self):
+        factory_a = ShmSessionFactory(self.path, capacity=64)
+        factory_b = ShmSessionFactory(self.path, capacity=64)
+        session = factory_a.get_session("", create=True)
+        session.set_attribute("user", "alice")
+        loaded = factory_b.get_session(session.id)
+        # Accessed by A later, it should not be undone by the update of B.
+        time.sleep(0.01)
+        accessed_time = factory_a.get_session(session.id).last_accessed_time
+        loaded.set_attribute("cart", 1)
+        id = session.id.encode()
+        assert factory_a._find(factory_a._bucket_of(id), id)[1][2] == accessed_time
+
+        session.invalidate()
+        loaded.set_attribute("cart", 2)
+        assert not loaded.is_valid
+        assert factory_a.get_session(session.id) is None
+        factory_a.close()
+        factory_b.close()
+
+    def test_capacity_and_slot_size(self):
+        factory = ShmSessionFactory(capacity=16, slot_size=256, bucket_slots=4)
+        sessions = [factory.get_session("", create=True) for _ in range(100)]
+        assert len(factory) <= 16
+        # The last session in its bucket is always kept.
+        assert factory.get_session(sessions[-1].id)
+        with self.assertRaises(ValueError):
+            sessions[-1].set_attribute("text", "x" * 256)
+        assert "text" not in factory.get_session(sessions[-1].id).attribute_names
+        factory.close()
+
+
+class CookieSessionFactoryTest(unittest.TestCase):
+
+    def test_signed_cookie(self):
+        factory = CookieSessionFactory(keys=["secret"])
+        session = factory.get_session("", create=True)
+        session.set_attribute("user", {"name": "keijack", "roles": ["admin"]})
+        value = factory.session_cookie_value(session)
+        assert value
+
+        loaded = factory.get_session(value)
+        assert loaded.id == session.id and not loaded.is_new
+        assert loaded.get_attribute("user") == {"name": "keijack", "roles": ["admin"]}
+        # Nothing is changed, so the cookie is not written again.
+        assert factory.session_cookie_value(loaded) is None
+
+        key_id, payload, signature = value.split(".")
+        assert factory.get_session(f"{key_id}.{payload}.{signature[::-1]}") is None
+        assert factory.get_session(f"{key_id}.j{payload[2:]}.{signature}") is None
+        assert factory.get_session(f"{key_id}.{payload}.{signature[:-1]}\u00e9") is None
+        assert CookieSessionFactory(keys=["another"]).get_session(value) is None
+
+    def test_rotate_keys(self):
+        value = CookieSessionFactory(keys=["old"]).session_cookie_value(
+            CookieSessionFactory(keys=["old"]).get_session("", create=True))
+        factory = CookieSessionFactory(keys=["new", "old"])
+        session = factory.get_session(value)
+        assert session
+        new_value = factory.session_cookie_value(session)
+        assert new_value and new_value.split(".")[0] != value.split(".")[0]
+        assert CookieSessionFactory(keys=["new"]).get_session(new_value).id == session.id
+
+    def test_compress_and_max_size(self):
+        factory = CookieSessionFactory(keys=["secret"], max_size=1024)
+        session = factory.get_session("", create=True)
+        session.set_attribute("text", "hello" * 150)
+        value = factory.session_cookie_value(session)
+        assert value.split(".")[1].startswith("z") and len(value) < 300
+        with self.assertRaises(ValueError):
+            session.set_attribute("text", os.urandom(1024).hex())
+        assert session.get_attribute("text") == "hello" * 150
+        with self.assertRaises(TypeError):
+            session.set_attribute("obj", object())
+        assert "obj" not in session.attribute_names
+
+    def test_expired_and_invalidated(self):
+        factory = CookieSessionFactory(keys=["secret"], max_inactive_interval=60)
+        session = factory.get_session("", create=True)
+        session._touch(time.time() - 120)
+        value = factory.encode(session)
+        assert factory.get_session(value) is None
+        assert factory.get_session(value, create=True).id != session.id
+
+        session = factory.get_session(factory.session_cookie_value(session))
+        session.invalidate()
+        assert not session.is_valid
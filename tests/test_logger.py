@@ -0,0 +1,65 @@
+# coding: utf-8
+
+import io
+import logging
+import unittest
+
+import simple_http_server.logger as logger
+
+
+class BatchedLoggingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stream = io.StringIO()
+        self.handler = logging.StreamHandler(self.stream)
+        self.handler.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+        logger.add_handler(self.handler)
+        self.logger = logger.get_logger("test_logger")
+
+    def tearDown(self):
+        logger.flush()
+        logger.remove_handler(self.handler)
+        logger.set_overflow_policy()
+
+    def _lines(self, level: str):
+        return [line for line in self.stream.getvalue().splitlines() if line.startswith(level)]
+
+    def test_write_in_batches(self):
+        for i in range(100):
+            self.logger.info(f"record {i}")
+        logger.flush()
+        assert self._lines("INFO") == [f"INFO record {i}" for i in range(100)]
+
+    def test_drop_when_queue_is_full(self):
+        logger.set_overflow_policy("drop", queue_size=10)
+        dropped = logger.logging_stats()["dropped"]
+        # Hold the background thread, so the queue is filled up.
+        with logger._drain_lock:
+            for i in range(50):
+                self.logger.info(f"record {i}")
+        logger.flush()
+        assert self._lines("INFO") == [f"INFO record {i}" for i in range(10)]
+        assert logger.logging_stats()["dropped"] - dropped == 40
+        assert "40 log records are dropped" in self.stream.getvalue()
+
+    def test_sample_when_queue_is_busy(self):
+        logger.set_overflow_policy("sample", queue_size=100, sample_every=10)
+        with logger._drain_lock:
+            for i in range(100):
+                self.logger.info(f"record {i}")
+            self.logger.error("error record")
+        logger.flush()
+        # The first 50 records are all kept, then one in every 10 records.
+        assert len(self._lines("INFO")) == 55
+        assert self._lines("ERROR") == ["ERROR error record"]
+
+    def test_set_level(self):
+        level = logger._LOG_LEVEL_
+        try:
+            logger.set_level("INFO")
+            assert not self.logger.isEnabledFor(logging.DEBUG)
+            logger.set_level("DEBUG")
+            # The cached result of the last check is cleared.
+            assert self.logger.isEnabledFor(logging.DEBUG)
+        finally:
+            logger.set_level(level)
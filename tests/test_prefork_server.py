@@ -0,0 +1,97 @@
+# coding: utf-8
+
+import os
+import signal
+import subprocess
+import sys
+import time
+import unittest
+import urllib.request
+
+from simple_http_server.prefork_server import PreforkMaster
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_APP = """
+import os
+import sys
+sys.path.insert(0, {root!r})
+import simple_http_server.server as server
+from simple_http_server import request_map
+
+
+@request_map("/pid")
+def pid():
+    return str(os.getpid())
+
+
+server.start(port={port}, workers=2, prefer_coroutine={coroutine}, shutdown_timeout={shutdown_timeout})
+"""
+
+
+class PreforkThreadingServerTest(unittest.TestCase):
+
+    PORT = 9190
+
+    COROUTINE = False
+
+    SHUTDOWN_TIMEOUT = 2
+
+    def setUp(self):
+        app = _APP.format(root=_ROOT, port=self.PORT, coroutine=self.COROUTINE, shutdown_timeout=self.SHUTDOWN_TIMEOUT)
+        self.master = subprocess.Popen([sys.executable, "-u", "-c", app],
+                                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            try:
+                self.visit_pid()
+                return
+            except OSError:
+                time.sleep(0.2)
+        self.fail("Server does not start in 10 seconds.")
+
+    def tearDown(self):
+        if self.master.poll() is None:
+            self.master.kill()
+            self.master.wait()
+        self.master.stdout.close()
+
+    def visit_pid(self) -> int:
+        with urllib.request.urlopen(f"http://127.0.0.1:{self.PORT}/pid", timeout=5) as res:
+            return int(res.read())
+
+    def stop_master(self) -> str:
+        begin = time.time()
+        self.master.send_signal(signal.SIGTERM)
+        output = self.master.communicate(timeout=self.SHUTDOWN_TIMEOUT + 10)[0].decode()
+        # The workers exit after draining, they are not killed at the deadline of the master.
+        assert time.time() - begin < self.SHUTDOWN_TIMEOUT + 3, output
+        assert "kill them" not in output, output
+        assert "All workers are stopped." in output, output
+        return output
+
+    def test_stop_by_sigterm(self):
+        self.visit_pid()
+        self.stop_master()
+        assert self.master.returncode == 0
+
+    def test_respawn_killed_worker(self):
+        killed = self.visit_pid()
+        os.kill(killed, signal.SIGKILL)
+        # The other worker keeps serving while the killed one is restarted.
+        deadline = time.time() + 10
+        while self.visit_pid() == killed and time.time() < deadline:
+            time.sleep(0.1)
+        time.sleep(PreforkMaster.RESPAWN_INTERVAL + 1)
+        assert self.visit_pid() != killed
+        output = self.stop_master()
+        assert f"Worker process[#{killed}] exits with status" in output, output
+        assert output.count("] is started.") == 3, output
+        assert self.master.returncode == 0
+
+
+class PreforkCoroutineServerTest(PreforkThreadingServerTest):
+
+    PORT = 9191
+
+    COROUTINE = True
@@ -0,0 +1,242 @@
+# coding: utf-8
+
+import os
+import threading
+import time
+import unittest
+from unittest import mock
+
+import simple_http_server.websocket_request_handler as ws_handler
+from simple_http_server import WebsocketHandlerOptions
+from simple_http_server.websocket_request_handler import PerMessageDeflate, WebsocketSendQueue
+
+
+def _unmask_byte_by_byte(payload: bytes, masks: bytes) -> bytes:
+    return bytes(b ^ masks[i % 4] for i, b in enumerate(payload))
+
+
+class UnmaskTest(unittest.TestCase):
+
+    SIZES = [0, 1, 3, 4, 10, 125, 1023, 1024, 1027, 65537]
+
+    def test_unmask(self):
+        masks = os.urandom(4)
+        for size in self.SIZES:
+            payload = os.urandom(size)
+            assert bytes(ws_handler._unmask(payload, masks)) == _unmask_byte_by_byte(payload, masks)
+
+    def test_unmask_without_numpy(self):
+        masks = os.urandom(4)
+        with mock.patch.object(ws_handler, "numpy", None):
+            for size in self.SIZES:
+                payload = os.urandom(size)
+                assert bytes(ws_handler._unmask(payload, masks)) == _unmask_byte_by_byte(payload, masks)
+
+
+class PerMessageDeflateTest(unittest.TestCase):
+
+    def test_negotiate(self):
+        options = WebsocketHandlerOptions(permessage_deflate=True)
+        deflate, ext = PerMessageDeflate.negotiate(
+            "permessage-deflate; client_max_window_bits", options)
+        assert deflate and ext == "permessage-deflate"
+
+        deflate, ext = PerMessageDeflate.negotiate(
+            "permessage-deflate; server_max_window_bits=10; client_no_context_takeover", options)
+        assert ext == "permessage-deflate; client_no_context_takeover; server_max_window_bits=10"
+
+        # The first offer is declined for the unknown parameter, the second one is accepted.
+        deflate, ext = PerMessageDeflate.negotiate(
+            "permessage-deflate; unknown=1, permessage-deflate; server_no_context_takeover", options)
+        assert ext == "permessage-deflate; server_no_context_takeover"
+
+        deflate, ext = PerMessageDeflate.negotiate("x-webkit-deflate-frame", options)
+        assert deflate is None
+
+    def test_compress_and_decompress(self):
+        options = WebsocketHandlerOptions(permessage_deflate=True)
+        server, _ = PerMessageDeflate.negotiate("permessage-deflate", options)
+        client, _ = PerMessageDeflate.negotiate("permessage-deflate", options)
+        for message in [b"hello" * 100, b"hello" * 100, b""]:
+            data = server.compress(message)
+            assert not data.endswith(PerMessageDeflate.TAIL)
+            assert client.decompress(data, True, 1024) == message
+
+    def test_decompress_limit(self):
+        options = WebsocketHandlerOptions(permessage_deflate=True)
+        deflate, _ = PerMessageDeflate.negotiate("permessage-deflate", options)
+        data = deflate.compress(b"\x00" * 1024 * 1024)
+        assert len(data) < 2048
+        assert len(deflate.decompress(data, True, 1024)) > 1024
+
+
+class _BlockingWriter:
+
+    is_async = False
+
+    buffer_size = 0
+
+    def __init__(self) -> None:
+        self.data = []
+        self.entered = threading.Event()
+        self.released = threading.Event()
+
+    def send(self, data: bytes):
+        self.entered.set()
+        self.released.wait()
+        self.data.append(data)
+
+
+class WebsocketSendQueueTest(unittest.TestCase):
+
+    def _wait_sent(self, queue: WebsocketSendQueue, count: int):
+        deadline = time.time() + 2
+        while queue.sent_frames < count and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_drop_oldest(self):
+        writer = _BlockingWriter()
+        queue = WebsocketSendQueue(writer, max_size=10, policy="drop_oldest")
+        queue.put(b"11111")
+        writer.entered.wait(1)
+        for frame in (b"22222", b"33333", b"44444"):
+            assert queue.put(frame)
+        writer.released.set()
+        self._wait_sent(queue, 3)
+        assert writer.data == [b"11111", b"33333", b"44444"]
+        assert queue.stats["dropped_frames"] == 1
+        assert queue.stats["high_water_bytes"] == 10
+
+    def test_drop_oldest_keeps_control_frames(self):
+        writer = _BlockingWriter()
+        data = [ws_handler._build_frame(str(i).encode() * 10, ws_handler.OPCODE_TEXT) for i in range(4)]
+        pong = ws_handler._build_frame(b"", ws_handler.OPCODE_PONG)
+        queue = WebsocketSendQueue(writer, max_size=30, policy="drop_oldest")
+        queue.put(data[0])
+        writer.entered.wait(1)
+        assert queue.put(pong) and queue.put(data[1]) and queue.put(data[2])
+        assert queue.put(data[3])
+        writer.released.set()
+        self._wait_sent(queue, 4)
+        assert writer.data == [data[0], pong, data[2], data[3]]
+        assert queue.stats["dropped_frames"] == 1 and queue.stats["dropped_bytes"] == len(data[1])
+
+    def test_disconnect(self):
+        writer = _BlockingWriter()
+        overflows = []
+        queue = WebsocketSendQueue(writer, max_size=10, policy="disconnect", on_overflow=lambda: overflows.append(1))
+        queue.put(b"11111")
+        writer.entered.wait(1)
+        assert queue.put(b"22222") and queue.put(b"33333")
+        assert not queue.put(b"44444")
+        assert overflows == [1]
+        writer.released.set()
+
+    def test_block(self):
+        writer = _BlockingWriter()
+        queue = WebsocketSendQueue(writer, max_size=10, policy="block")
+        queue.put(b"11111")
+        writer.entered.wait(1)
+        queue.put(b"22222")
+        queue.put(b"33333")
+        assert not queue.put(b"44444", block=False)
+        putter = threading.Thread(target=queue.put, args=(b"44444",))
+        putter.start()
+        putter.join(0.2)
+        assert putter.is_alive()
+        writer.released.set()
+        putter.join(1)
+        self._wait_sent(queue, 4)
+        assert writer.data == [b"11111", b"22222", b"33333", b"44444"]
+        assert queue.stats["blocked"] == 1
+
+    def test_one_flusher_thread(self):
+        writer = _BlockingWriter()
+        writer.released.set()
+        queue = WebsocketSendQueue(writer)
+        existing = set(threading.enumerate())
+        for i in range(20):
+            queue.put(str(i).encode())
+            self._wait_sent(queue, i + 1)
+        assert writer.data == [str(i).encode() for i in range(20)]
+        flushers = [t for t in set(threading.enumerate()) - existing if t.name == "websocket-flusher"]
+        assert len(flushers) == 1
+        queue.close()
+        flushers[0].join(1)
+        assert not flushers[0].is_alive()
+
+    def test_block_for_space(self):
+        writer = _BlockingWriter()
+        queue = WebsocketSendQueue(writer, max_size=10, policy="block")
+        queue.put(b"11111")
+        writer.entered.wait(1)
+        queue.put(b"2222222222")
+        waiter = threading.Thread(target=queue.block_for_space)
+        waiter.start()
+        waiter.join(0.2)
+        assert waiter.is_alive()
+        # Waiting for the space does not hold the queue, so a frame can still be forced in.
+        assert queue.put(b"33333", force=True)
+        writer.released.set()
+        waiter.join(1)
+        assert not waiter.is_alive()
+        assert queue.block_for_space()
+
+    def test_coalesce(self):
+        writer = _BlockingWriter()
+        queue = WebsocketSendQueue(writer, coalesce=True)
+        queue.put(b"11111")
+        writer.entered.wait(1)
+        queue.put(b"22222")
+        queue.put(b"33333")
+        writer.released.set()
+        self._wait_sent(queue, 3)
+        assert writer.data == [b"11111", b"2222233333"]
+        assert queue.stats["writes"] == 2
+
+    def test_coalesce_delay_and_flush(self):
+        writer = _BlockingWriter()
+        writer.released.set()
+        queue = WebsocketSendQueue(writer, coalesce=True, coalesce_delay=5)
+        queue.put(b"11111")
+        queue.put(b"22222")
+        time.sleep(0.1)
+        assert writer.data == []
+        queue.flush()
+        self._wait_sent(queue, 2)
+        assert writer.data == [b"1111122222"]
+
+
+class _FakeHandler:
+
+    def __init__(self, **options) -> None:
+        self.options = WebsocketHandlerOptions(**options)
+        self.keep_alive = True
+        self.last_read_time = time.monotonic()
+        self.ping_sent_time = None
+        self.pings = 0
+        self.reaped = threading.Event()
+
+    def send_ping(self, message):
+        self.pings += 1
+
+    def reap(self, reason: str):
+        self.keep_alive = False
+        self.reaped.set()
+
+
+class WebsocketReaperTest(unittest.TestCase):
+
+    def test_ping_and_reap(self):
+        reaper = ws_handler.WebsocketReaper()
+        quiet = _FakeHandler(ping_interval=0.1, ping_timeout=0.1)
+        idle = _FakeHandler(idle_timeout=60)
+        assert reaper.next_check_time(idle) == idle.last_read_time + 60
+        reaper.add(quiet)
+        reaper.add(idle)
+        assert quiet.reaped.wait(2)
+        assert quiet.pings == 1
+        assert reaper.stats["reaped_pong_timeout"] == 1
+        # The idle one is not due yet.
+        assert not idle.reaped.is_set() and reaper.stats["sessions"] == 1
+        reaper.remove(idle)